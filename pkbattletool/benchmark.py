@@ -0,0 +1,425 @@
+"""
+認識パイプラインの性能計測ツール
+
+カメラ(キャプチャボード)が無い環境でも、録画ファイル・画像フォルダ・生成画像を入力として計測できる
+結果はJSONで標準出力に出力する
+
+例：
+    python benchmark.py capture --source video --path battle.mp4 --fast --duration 10
+    python benchmark.py capture --source synthetic --duration 5
+    python benchmark.py capture --source synthetic --static --duration 5
+    python benchmark.py ocr --image screenshot/screenshot_240101120000.png --repeat 20
+    python benchmark.py segmentation --team screenshot/battleteam --icon icon/box
+    python benchmark.py recognition --corpus screenshot/battleteam --k 5
+"""
+
+import os, sys
+import json
+import collections
+import time
+import argparse
+from logging import getLogger, StreamHandler, WARNING, INFO, Formatter
+
+import numpy as np
+import pandas as pd
+import cv2
+
+from module import config
+from mylib import CameraCapture, OcrRunner, SyntheticSource, CameraFrameForge, create_frame_source, PkHash
+from mylib import ocr_engine
+
+def percentile_summary(values:list[float]) -> dict:
+    """計測値の分位点をまとめる
+
+    Args:
+        values (list[float]): 計測値(ミリ秒)
+
+    Returns:
+        dict: 件数と平均、p50/p90/p99/最大値
+    """
+    if len(values) == 0:
+        return {"count":0}
+    array = np.asarray(values, dtype=np.float64)
+    return {
+        "count":int(array.size),
+        "mean":round(float(array.mean()), 3),
+        "p50":round(float(np.percentile(array, 50)), 3),
+        "p90":round(float(np.percentile(array, 90)), 3),
+        "p99":round(float(np.percentile(array, 99)), 3),
+        "max":round(float(array.max()), 3)}
+
+def bench_capture(args:argparse.Namespace) -> dict:
+    """フレーム取得からOCR前処理までのスループットと遅延を計測する
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: 計測結果
+    """
+    logger = getLogger("Log").getChild("bench_capture")
+    if args.source == "synthetic" and args.static:
+        frame_source = SyntheticSource(fps=args.fps, realtime=not args.fast, static=True)
+    else:
+        frame_source = create_frame_source(args.source, camera_id=args.camera_id, path=args.path,
+                                           fps=args.fps, realtime=not args.fast)
+    camera_capture = CameraCapture(frame_source)
+    ocr_runner = OcrRunner(camera_capture)
+
+    latencylist:list[float] = [] # 取得から前処理完了を検知するまでの遅延(ms)
+    last_seq = -1
+
+    camera_capture.start_capture()
+    ocr_runner.start_ocr_thread()
+    start = time.time()
+    while time.time() - start < args.duration and camera_capture.is_capturing:
+        if not ocr_runner.region_history.buffers["level"].wait_for_frame(last_seq, timeout=0.1):
+            continue
+        for seq, timestamp, _ in ocr_runner.region_history.buffers["level"].get_since(last_seq):
+            latencylist.append((time.time() - timestamp) * 1000)
+            last_seq = seq
+    elapsed = time.time() - start
+    ocr_runner.stop_ocr_thread()
+    ocr_runner.ocr_thread.join()
+    camera_capture.stop_capture()
+    camera_capture.capture_thread.join()
+    camera_capture.release_camera()
+
+    captured = camera_capture.frame_buffer.latest_seq + 1
+    logger.info(f"Captured {captured} frames in {elapsed:.2f}s")
+    return {
+        "source":args.source,
+        "realtime":not args.fast,
+        "elapsed_sec":round(elapsed, 3),
+        "captured_frames":captured,
+        "duplicate_frames":camera_capture.duplicate_count,
+        "processed_frames":len(latencylist),
+        "capture_fps":round(captured / elapsed, 2),
+        "processed_fps":round(len(latencylist) / elapsed, 2),
+        "latency_ms":percentile_summary(latencylist),
+        "frame_buffer_bytes":camera_capture.frame_buffer.buffer.nbytes if camera_capture.frame_buffer.buffer is not None else 0,
+        "region_history_bytes":ocr_runner.region_history.nbytes()}
+
+def bench_ocr(args:argparse.Namespace) -> dict:
+    """OCRエンジンごとに、レベル表示とネームボックスの1回あたりの認識時間を計測する
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: 計測結果
+    """
+    logger = getLogger("Log").getChild("bench_ocr")
+    if args.image:
+        frame = cv2.resize(cv2.imread(args.image), (1920, 1080))
+    else:
+        # 画像の指定が無い場合は、レベル表示とポケモン名を描画した画像を使う
+        frame = np.zeros((1080, 1920, 3), dtype=np.uint8)
+        cv2.putText(frame, "Lv.50", (1545, 82), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 3)
+        cv2.putText(frame, "Garchomp", (1545, 132), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (255, 255, 255), 3)
+    frame_forge = CameraFrameForge(CameraCapture(SyntheticSource(width=1920, height=1080)))
+    grayscale_frame = frame_forge.cvt_bgr2gray(frame)
+    regions = {option:frame_forge.cvt_gray2binaly(frame_forge.crop_frame(grayscale_frame, option), option)
+               for option in ["level", "namebox"]}
+    langs = {"level":"eng", "namebox":"jpn+eng"}
+
+    result = {}
+    tesseract_path = config.get("DEFAULT","tesseract_path")
+    for backend in args.backend:
+        try:
+            if backend == "tesserocr":
+                if ocr_engine.tesserocr is None:
+                    raise RuntimeError("tesserocr is not installed")
+                engine = ocr_engine.TesserocrEngine(os.path.join(tesseract_path, "tessdata"), list(langs.values()))
+            else:
+                if tesseract_path not in os.environ["PATH"].split(os.pathsep):
+                    os.environ["PATH"] += os.pathsep + tesseract_path
+                engine = ocr_engine.PyocrEngine()
+        except Exception as e:
+            logger.error(f"Fault create {backend} : {e}")
+            result[backend] = {"error":str(e)}
+            continue
+
+        start = time.perf_counter()
+        engine.warmup(list(langs.values()))
+        result[backend] = {"warmup_ms":round((time.perf_counter() - start) * 1000, 3)}
+        for option, region in regions.items():
+            latencylist = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                text = engine.image_to_string(region, langs[option])
+                latencylist.append((time.perf_counter() - start) * 1000)
+            result[backend][option] = {"text":text.strip(), "latency_ms":percentile_summary(latencylist)}
+        engine.close()
+    return result
+
+def legacy_icon_rect(frame:np.ndarray) -> tuple[int, int, int, int]:
+    """輪郭ごとの外接矩形をまとめる、以前の切り抜き方法(比較用)
+
+    Args:
+        frame (np.ndarray): 6分割したポケモンのアイコン画像
+
+    Returns:
+        tuple[int, int, int, int]: (x1, y1, x2, y2). 輪郭が無い場合はNone
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    _, binary_img = cv2.threshold(gray, 170, 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(binary_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    rect = None
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if rect is None:
+            rect = [x, y, x + w, y + h]
+        else:
+            rect = [min(rect[0], x), min(rect[1], y), max(rect[2], x + w), max(rect[3], y + h)]
+    return tuple(rect) if rect is not None else None
+
+def rect_iou(rect1:tuple[int, int, int, int], rect2:tuple[int, int, int, int]) -> float:
+    """2つの矩形の重なり(IoU)
+
+    Args:
+        rect1 (tuple[int, int, int, int]): (x1, y1, x2, y2)
+        rect2 (tuple[int, int, int, int]): (x1, y1, x2, y2)
+
+    Returns:
+        float: 共通部分の面積/和集合の面積
+    """
+    width = max(0, min(rect1[2], rect2[2]) - max(rect1[0], rect2[0]))
+    height = max(0, min(rect1[3], rect2[3]) - max(rect1[1], rect2[1]))
+    intersection = width * height
+    union = (rect1[2] - rect1[0]) * (rect1[3] - rect1[1]) + (rect2[2] - rect2[0]) * (rect2[3] - rect2[1]) - intersection
+    return intersection / union if union > 0 else 1.0
+
+def load_images(folder:str) -> list[tuple[str, np.ndarray]]:
+    """フォルダ内の画像を名前順に読み込む
+
+    Args:
+        folder (str): 画像フォルダ
+
+    Returns:
+        list[tuple[str, np.ndarray]]: (ファイル名(拡張子なし)、画像)のリスト
+    """
+    imagelist = []
+    if not folder or not os.path.isdir(folder):
+        return imagelist
+    for filename in sorted(os.listdir(folder)):
+        if os.path.splitext(filename)[1].lower() not in (".png", ".jpg", ".jpeg", ".bmp", ".webp"):
+            continue
+        frame = cv2.imread(os.path.join(folder, filename))
+        if frame is not None:
+            imagelist.append((os.path.splitext(filename)[0], frame))
+    return imagelist
+
+def bench_segmentation(args:argparse.Namespace) -> dict:
+    """アイコンの切り抜きについて、以前の輪郭による方法と1枚あたりの時間と結果を比較する
+    icon/boxの画像はファイル名を識別キーとして、切り抜き後のdHash値の検索の正解率も求める
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: 計測結果
+    """
+    logger = getLogger("Log").getChild("bench_segmentation")
+    pkhash = PkHash()
+
+    # 入力(6分割した画像、識別キー(無い場合はNone))
+    slicelist:list[tuple[np.ndarray, str]] = []
+    for _, team_frame in load_images(args.team):
+        slicelist += [(cut_frame, None) for cut_frame in pkhash.SplitTeamFrame(team_frame)]
+    for key, icon_frame in load_images(args.icon):
+        slicelist.append((icon_frame, key))
+    if len(slicelist) == 0:
+        logger.warning(f"Not found images : {args.team}, {args.icon}")
+        return {"error":"no images"}
+
+    legacy_latency, latency = [], []
+    ioulist = []
+    legacy_empty, empty = 0, 0
+    legacy_icons, icons, labels = [], [], []
+    for cut_frame, key in slicelist:
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            legacy_rect = legacy_icon_rect(cut_frame)
+            legacy_latency.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            rect = pkhash.GetIconRect(cut_frame)
+            latency.append((time.perf_counter() - start) * 1000)
+
+        height, width = cut_frame.shape[:2]
+        if legacy_rect is None:
+            legacy_empty += 1
+        else:
+            ioulist.append(rect_iou(legacy_rect, rect))
+        if rect == (0, 0, width, height):
+            empty += 1
+        if key is not None:
+            # 以前の方法で輪郭が無い場合は、切り抜き画像全体を使う
+            x1, y1, x2, y2 = legacy_rect if legacy_rect is not None else (0, 0, width, height)
+            legacy_icons.append(cut_frame[y1:y2, x1:x2])
+            x1, y1, x2, y2 = rect
+            icons.append(cut_frame[y1:y2, x1:x2])
+            labels.append(key)
+
+    result = {
+        "slices":len(slicelist),
+        "repeat":args.repeat,
+        "legacy":{"latency_ms":percentile_summary(legacy_latency), "empty_slices":legacy_empty},
+        "projection":{"latency_ms":percentile_summary(latency), "empty_slices":empty},
+        "iou":percentile_summary(ioulist)}
+    if len(labels) > 0:
+        gallery = pkhash.GetGallery()
+        for name, iconlist in (("legacy", legacy_icons), ("projection", icons)):
+            candidatelist = gallery.nearest_batch(pkhash.CalcPerceptualDhashValues(iconlist), 1)
+            correct = sum(1 for key, candidates in zip(labels, candidatelist) if candidates and candidates[0][0] == key)
+            result[name]["top1_accuracy"] = round(correct / len(labels), 4)
+        result["labeled_slices"] = len(labels)
+    return result
+
+def bench_recognition(args:argparse.Namespace) -> dict:
+    """ラベル付きの手持ちポケモンの切り抜き画像で、アイコン認識の正解率と処理段階ごとの時間を計測する
+    正解はフォルダ内のlabels.csv(File,Slot1,...,Slot6の列、Slotは識別キー、空欄は評価しない)から読み込む
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: 計測結果
+    """
+    logger = getLogger("Log").getChild("bench_recognition")
+    label_path = os.path.join(args.corpus, args.labels)
+    if not os.path.exists(label_path):
+        logger.warning(f"Not found labels : {label_path}")
+        return {"error":f"not found {label_path}"}
+    label_df = pd.read_csv(label_path, dtype=str, keep_default_na=False)
+    slot_columns = [f"Slot{i}" for i in range(1, 7)]
+
+    pkhash = PkHash()
+    if args.rerank_count is not None:
+        pkhash.rerank_count = args.rerank_count
+    gallery = pkhash.GetGallery()
+    species = pkhash.GetSpecies()
+    rerank_count = pkhash.rerank_count if gallery.has_descriptor.any() else 0
+
+    stages = ["split", "segmentation", "dhash", "search", "rerank", "assign", "total"]
+    latency:dict[str, list[float]] = {stage:[] for stage in stages}
+    slots, top1, topk, species_top1, missing = 0, 0, 0, 0, 0
+    confusions = collections.Counter()
+    for row in label_df.itertuples(index=False):
+        frame = cv2.imread(os.path.join(args.corpus, row.File))
+        if frame is None:
+            logger.warning(f"Fault read {row.File}")
+            missing += 1
+            continue
+        for _ in range(args.repeat):
+            times = [time.perf_counter()]
+            cutframelist = pkhash.SplitTeamFrame(frame)
+            times.append(time.perf_counter())
+            outline_iconlist = [pkhash.GetImageByAllContours(cut_frame) for cut_frame in cutframelist]
+            times.append(time.perf_counter())
+            dhashes = pkhash.CalcPerceptualDhashValues(outline_iconlist)
+            times.append(time.perf_counter())
+            candidatelist = gallery.nearest_batch(dhashes, max(args.k, rerank_count))
+            times.append(time.perf_counter())
+            if rerank_count > 0:
+                phashes, hists = pkhash.CalcDescriptorValues(outline_iconlist)
+                candidatelist = gallery.rerank(candidatelist, phashes, hists.astype(np.float32) / np.float32(255), args.k)
+            times.append(time.perf_counter())
+            candidatelist, _, _ = pkhash.AssignTeam(candidatelist)
+            times.append(time.perf_counter())
+            for stage, begin, end in zip(stages, times[:-1], times[1:]):
+                latency[stage].append((end - begin) * 1000)
+            latency["total"].append((times[-1] - times[0]) * 1000)
+
+        for column, candidates in zip(slot_columns, candidatelist):
+            label = getattr(row, column, "")
+            if not label:
+                continue
+            slots += 1
+            predicted = candidates[0][0] if candidates else None
+            if predicted == label:
+                top1 += 1
+            elif predicted is not None:
+                confusions[(label, predicted)] += 1
+            if any(key == label for key, _, _ in candidates):
+                topk += 1
+            if predicted is not None and species.get(predicted, predicted) == species.get(label, label):
+                species_top1 += 1
+
+    return {
+        "teams":len(label_df) - missing,
+        "slots":slots,
+        "gallery_size":len(gallery.hashes),
+        "rerank_count":rerank_count,
+        "k":args.k,
+        "top1_accuracy":round(top1 / slots, 4) if slots else None,
+        f"top{args.k}_accuracy":round(topk / slots, 4) if slots else None,
+        "species_top1_accuracy":round(species_top1 / slots, 4) if slots else None,
+        "confusions":[{"label":label, "predicted":predicted, "count":count}
+                      for (label, predicted), count in confusions.most_common(args.confusions)],
+        "latency_ms":{stage:percentile_summary(values) for stage, values in latency.items()}}
+
+def positive_int(value:str) -> int:
+    """1以上の整数の引数(計測回数が0だと計測結果が無い)
+
+    Args:
+        value (str): 引数の文字列
+
+    Returns:
+        int: 引数の値
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be 1 or more : {value}")
+    return number
+
+def main():
+    # ログ設定(計測結果を見やすくするため警告以上のみ表示)
+    logger = getLogger("Log")
+    handler = StreamHandler()
+    logger.setLevel(INFO)
+    handler.setLevel(WARNING)
+    handler.setFormatter(Formatter('%(asctime)s | %(levelname)s | %(name)s - %(message)s'))
+    logger.addHandler(handler)
+
+    # 引数の設定
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    parser_capture = subparsers.add_parser("capture", help="フレーム取得から前処理までの計測")
+    parser_capture.add_argument("--source", choices=["camera", "video", "images", "synthetic"], default="synthetic", help="フレームの供給元")
+    parser_capture.add_argument("--path", default="", help="動画ファイルまたは画像フォルダのパス")
+    parser_capture.add_argument("--camera-id", type=int, default=0, help="カメラID")
+    parser_capture.add_argument("--fps", type=float, default=30.0, help="供給するフレームレート(images, synthetic)")
+    parser_capture.add_argument("--fast", action="store_true", help="fpsに合わせず可能な限り速く供給する")
+    parser_capture.add_argument("--static", action="store_true", help="静止画面を生成する(synthetic)")
+    parser_capture.add_argument("--duration", type=float, default=10.0, help="計測時間(秒)")
+    parser_capture.set_defaults(func=bench_capture)
+
+    parser_ocr = subparsers.add_parser("ocr", help="OCRエンジンごとの認識時間の計測")
+    parser_ocr.add_argument("--image", default="", help="1920x1080のスクリーンショット(省略時は生成画像)")
+    parser_ocr.add_argument("--backend", nargs="+", choices=["tesserocr", "pyocr"], default=["tesserocr", "pyocr"], help="計測するOCRエンジン")
+    parser_ocr.add_argument("--repeat", type=positive_int, default=20, help="領域ごとの計測回数")
+    parser_ocr.set_defaults(func=bench_ocr)
+
+    parser_segmentation = subparsers.add_parser("segmentation", help="アイコンの切り抜きの時間と結果の比較")
+    parser_segmentation.add_argument("--team", default=os.path.join(config.get("DEFAULT","screenshot_folder"), "battleteam"), help="手持ちポケモンの切り抜き画像のフォルダ(6分割して使う)")
+    parser_segmentation.add_argument("--icon", default="icon/box", help="6分割したアイコン画像のフォルダ(ファイル名を識別キーとする)")
+    parser_segmentation.add_argument("--repeat", type=positive_int, default=10, help="1枚あたりの計測回数")
+    parser_segmentation.set_defaults(func=bench_segmentation)
+
+    parser_recognition = subparsers.add_parser("recognition", help="アイコン認識の正解率と処理段階ごとの時間の計測")
+    parser_recognition.add_argument("--corpus", default=os.path.join(config.get("DEFAULT","screenshot_folder"), "battleteam"), help="手持ちポケモンの切り抜き画像のフォルダ")
+    parser_recognition.add_argument("--labels", default="labels.csv", help="正解のCSV(File,Slot1,...,Slot6の列)のファイル名")
+    parser_recognition.add_argument("--k", type=int, default=5, help="1匹あたりの候補の数")
+    parser_recognition.add_argument("--rerank-count", type=int, default=None, help="並べ直す候補の数(0は並べ直さない. 省略時は設定ファイルの値)")
+    parser_recognition.add_argument("--repeat", type=positive_int, default=1, help="1枚あたりの計測回数")
+    parser_recognition.add_argument("--confusions", type=int, default=20, help="出力する誤認識の組み合わせの数")
+    parser_recognition.set_defaults(func=bench_recognition)
+
+    args = parser.parse_args()
+    result = args.func(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
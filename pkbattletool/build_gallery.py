@@ -0,0 +1,193 @@
+"""
+ラベル付きのアイコン画像のフォルダから、参照画像の一覧(resources/hash_gallery.csv)をまとめて作成するツール
+
+識別キーはファイルの親フォルダ名(例：icon/6/xxx.png)、またはファイル名(例：icon/box/6.png)から決める
+どちらも図鑑データの識別キーに無い画像は読み飛ばす
+輪郭切り抜き・dHash値・並べ直し用の特徴量の算出はプロセスを分けて並列に行い、書き込みは最後に1回だけ行う
+
+例：
+    python build_gallery.py icon/box
+    python build_gallery.py screenshot/icon/labeled --outlined --replace --dedup-distance 2
+"""
+
+import os, sys
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from logging import getLogger, StreamHandler, WARNING, INFO, Formatter
+
+import numpy as np
+import cv2
+
+from module import pkcsv, pkgallery
+from mylib import PkHash, pack_dhash
+
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".webp")
+
+_pkhash:PkHash = None # ワーカープロセスごとの処理
+
+def init_worker() -> None:
+    """
+    ワーカープロセスの初期化(処理を1回だけ作成する)
+    """
+    global _pkhash
+    # ワーカーでは並列化しない
+    cv2.setNumThreads(1)
+    _pkhash = PkHash()
+
+def hash_image(item:tuple[str, bool]) -> tuple[str, str, str, str]:
+    """画像を読み込み、輪郭切り抜きとdHash値・特徴量を算出する(ワーカープロセスで実行する)
+
+    Args:
+        item (tuple[str, bool]): (画像のパス、輪郭切り抜き済みか)
+
+    Returns:
+        tuple[str, str, str, str]: (画像のパス、dHash値、pHash値、色ヒストグラム). 読み込めない場合はNone
+    """
+    path, outlined = item
+    frame = cv2.imread(path)
+    if frame is None or frame.size == 0:
+        return None
+    outline_frame = frame if outlined else _pkhash.GetImageByAllContours(frame)
+    dhash = _pkhash.CalcPerceptualDhash(outline_frame)
+    phash, hist = _pkhash.CalcDescriptors(outline_frame)
+    return path, dhash, phash, hist
+
+def find_images(paths:list[str], keys:set) -> tuple[list[tuple[str, str]], list[str]]:
+    """フォルダ内の画像を探し、識別キーを決める
+
+    Args:
+        paths (list[str]): 画像またはフォルダのパスのリスト
+        keys (set): 図鑑データの識別キー
+
+    Returns:
+        list[tuple[str, str]]: (画像のパス、識別キー)のリスト(パスの順)
+        list[str]: 識別キーが決まらなかった画像のパスのリスト
+    """
+    filelist = []
+    for path in paths:
+        if os.path.isfile(path):
+            filelist.append(path)
+            continue
+        for root, _, filenames in os.walk(path):
+            filelist += [os.path.join(root, filename) for filename in filenames
+                         if os.path.splitext(filename)[1].lower() in image_extensions]
+
+    imagelist, unlabeled = [], []
+    for path in sorted(filelist):
+        # 親フォルダ名を優先し、無ければファイル名
+        parent = os.path.basename(os.path.dirname(path))
+        stem = os.path.splitext(os.path.basename(path))[0]
+        if parent in keys:
+            imagelist.append((path, parent))
+        elif stem in keys:
+            imagelist.append((path, stem))
+        else:
+            unlabeled.append(path)
+    return imagelist, unlabeled
+
+def dedup_samples(samplelist:list[tuple[str, str, str, str, str]], existing:dict[str, list[str]], max_distance:int) -> list[tuple[str, str, str, str, str]]:
+    """同じ識別キーでdHash値の距離がmax_distance以下の参照画像は、先に見つかったもののみ残す
+
+    Args:
+        samplelist (list[tuple[str, str, str, str, str]]): (識別キー、dHash値、元画像、pHash値、色ヒストグラム)のリスト
+        existing (dict[str, list[str]]): 識別キーごとの既に登録されているdHash値
+        max_distance (int): 同じとみなすdHash値の距離. 負の値は重複を除かない
+
+    Returns:
+        list[tuple[str, str, str, str, str]]: 重複を除いた参照画像のリスト(元の順)
+    """
+    if max_distance < 0:
+        return samplelist
+    kept = {key:np.fromiter((pack_dhash(dhash) for dhash in hashlist), dtype=np.uint64) for key, hashlist in existing.items()}
+    resultlist = []
+    for sample in samplelist:
+        key, dhash = sample[0], pack_dhash(sample[1])
+        hashes = kept.get(key, np.empty(0, dtype=np.uint64))
+        if len(hashes) > 0 and np.bitwise_count(np.bitwise_xor(hashes, dhash)).min() <= max_distance:
+            continue
+        kept[key] = np.append(hashes, dhash)
+        resultlist.append(sample)
+    return resultlist
+
+def build_gallery(args:argparse.Namespace) -> dict:
+    """参照画像の一覧を作成する
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: 処理結果
+    """
+    logger = getLogger("Log").getChild("build_gallery")
+    start = time.perf_counter()
+
+    keys = set(pkcsv.get_df().index.astype(str))
+    imagelist, unlabeled = find_images(args.paths, keys)
+    for path in unlabeled:
+        logger.warning(f"Not found key : {path}")
+    labels = dict(imagelist)
+
+    # 輪郭切り抜きとハッシュ値の算出(プロセスを分けて並列に行う)
+    items = [(path, args.outlined) for path, _ in imagelist]
+    hashed = []
+    if len(items) > 0:
+        workers = args.workers or os.cpu_count() or 1
+        chunksize = max(1, len(items) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            hashed = [result for result in executor.map(hash_image, items, chunksize=chunksize) if result is not None]
+    hash_sec = time.perf_counter() - start
+    if len(hashed) < len(items):
+        logger.warning(f"Fault read {len(items) - len(hashed)} images")
+
+    samplelist = [(labels[path], dhash, os.path.relpath(path), phash, hist) for path, dhash, phash, hist in hashed]
+    existing:dict[str, list[str]] = {}
+    if not args.replace:
+        gallery_df = pkgallery.get_df()
+        for key, dhash in zip(gallery_df["Key"].tolist(), gallery_df["Hash"].tolist()):
+            existing.setdefault(key, []).append(dhash)
+    samplelist = dedup_samples(samplelist, existing, args.dedup_distance)
+
+    # 一覧の書き込み(一時ファイルを置き換える1回のみ. 追加の場合も変更履歴をCSVにまとめる)
+    if not args.dry_run and (len(samplelist) > 0 or args.replace):
+        pkgallery.add_samples(samplelist, replace=args.replace)
+        pkgallery.save()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Build gallery : {len(samplelist)} samples in {elapsed:.2f}s")
+    return {
+        "images":len(imagelist) + len(unlabeled),
+        "unlabeled":len(unlabeled),
+        "hashed":len(hashed),
+        "added":len(samplelist),
+        "duplicates":len(hashed) - len(samplelist),
+        "keys":len(set(sample[0] for sample in samplelist)),
+        "gallery_size":len(pkgallery.get_df()),
+        "dry_run":args.dry_run,
+        "hash_sec":round(hash_sec, 3),
+        "elapsed_sec":round(elapsed, 3)}
+
+def main():
+    # ログ設定
+    logger = getLogger("Log")
+    handler = StreamHandler()
+    logger.setLevel(INFO)
+    handler.setLevel(WARNING)
+    handler.setFormatter(Formatter('%(asctime)s | %(levelname)s | %(name)s - %(message)s'))
+    logger.addHandler(handler)
+
+    # 引数の設定
+    parser = argparse.ArgumentParser(description="ラベル付きのアイコン画像から参照画像の一覧を作成する")
+    parser.add_argument("paths", nargs="+", help="アイコン画像またはフォルダ(親フォルダ名かファイル名を識別キーとする)")
+    parser.add_argument("--outlined", action="store_true", help="輪郭切り抜き済みの画像(screenshot/icon/outlineなど)")
+    parser.add_argument("--replace", action="store_true", help="既存の参照画像を全て置き換える(省略時は追加)")
+    parser.add_argument("--dedup-distance", type=int, default=0, help="同じ識別キーで、dHash値の距離がこれ以下の画像は追加しない(負の値は全て追加)")
+    parser.add_argument("--workers", type=int, default=0, help="プロセス数(0はCPU数)")
+    parser.add_argument("--dry-run", action="store_true", help="一覧を書き込まない")
+
+    args = parser.parse_args()
+    result = build_gallery(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
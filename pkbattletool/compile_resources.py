@@ -0,0 +1,75 @@
+"""
+リソースのCSVを解析済みのキャッシュ(resources/cache/*.npz)にコンパイルするツール
+
+キャッシュは初回の読み込み時にも自動で作成されるが、配布前やCSVを編集した後に実行しておくと起動時の解析を省ける
+CSVの更新日時とサイズが変わったキャッシュは、読み込み時に自動で作り直される
+
+例：
+    python compile_resources.py
+    python compile_resources.py --check
+"""
+
+import os, sys
+import json
+import time
+import argparse
+from logging import getLogger, StreamHandler, WARNING, INFO, Formatter
+
+from module import pkcsv
+from module.pkcsv.compiled import cache_path, load_compiled
+
+def compile_resources(args:argparse.Namespace) -> dict:
+    """リソースのCSVをコンパイルする
+
+    Args:
+        args (argparse.Namespace): コマンドライン引数
+
+    Returns:
+        dict: CSVごとの処理結果
+    """
+    logger = getLogger("Log").getChild("compile_resources")
+    resources = {
+        pkcsv.PkCSV.filename:lambda: pkcsv._util.RoadCSV(rebuild=True)}
+    result = {}
+    for source, compile_source in resources.items():
+        is_fresh = load_compiled(source) is not None
+        if not args.check and (args.force or not is_fresh):
+            compile_source()
+            is_fresh = load_compiled(source) is not None
+        # 読み込みにかかる時間
+        start = time.perf_counter()
+        if is_fresh:
+            load_compiled(source)
+        load_ms = (time.perf_counter() - start) * 1000
+        filename = cache_path(source)
+        result[source] = {
+            "cache":filename,
+            "fresh":is_fresh,
+            "size":os.path.getsize(filename) if os.path.exists(filename) else 0,
+            "load_ms":round(load_ms, 2) if is_fresh else None}
+        logger.info(f"{source} -> {filename} : fresh={is_fresh}")
+    return result
+
+def main():
+    # ログ設定
+    logger = getLogger("Log")
+    handler = StreamHandler()
+    logger.setLevel(INFO)
+    handler.setLevel(WARNING)
+    handler.setFormatter(Formatter('%(asctime)s | %(levelname)s | %(name)s - %(message)s'))
+    logger.addHandler(handler)
+
+    # 引数の設定
+    parser = argparse.ArgumentParser(description="リソースのCSVを解析済みのキャッシュにコンパイルする")
+    parser.add_argument("--force", action="store_true", help="キャッシュが新しくても作り直す")
+    parser.add_argument("--check", action="store_true", help="キャッシュが新しいかのみ調べる(作成しない)")
+
+    args = parser.parse_args()
+    result = compile_resources(args)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    # --checkで古いキャッシュがあれば失敗とする
+    if args.check and not all(item["fresh"] for item in result.values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
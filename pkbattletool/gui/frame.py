@@ -30,6 +30,7 @@ import tkinter as tk
 import Levenshtein
 
 import threading
+import queue
 
 import time
 
@@ -41,16 +42,18 @@ rcParams["font.sans-serif"] = ["Meiryo"]
 
 from logging import getLogger
 
-from module import config, pkcsv
-from mylib import CameraCapture, SearchDB, PkTypeCompatibility, PkHash, CameraFrameForge, OcrRunner
+from module import config, pkcsv, pkgallery
+from module.pkcsv import SpeciesRecord
+from mylib import CameraCapture, SearchDB, PkTypeCompatibility, PkHash, HashGallery, CameraFrameForge, OcrRunner, OcrScheduler, ImageWriter
 
 class PkInfo_OCR(tk.Frame):
-    def __init__(self, master:tk.Tk, ocr_runner: OcrRunner, **kwargs):
+    def __init__(self, master:tk.Tk, ocr_runner: OcrRunner, ocr_scheduler: OcrScheduler, **kwargs):
         """OCRでポケモン名を認識して表示するフレーム
 
         Args:
             master[tk.Tk]: フレームを表示する親ウィンドウ
             ocr_runner[OcrRunner]:OCRを管理するクラス
+            ocr_scheduler[OcrScheduler]:OCRをワーカーで実行するクラス
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("PkInfo_OCR")
@@ -60,6 +63,8 @@ class PkInfo_OCR(tk.Frame):
 
         # OCR制御
         self.ocr_runner = ocr_runner
+        self.ocr_scheduler = ocr_scheduler
+        self.result_queue = queue.Queue() # OCR結果の受け取り
 
         self.font = ("MS ゴシック", 15)
 
@@ -91,7 +96,9 @@ class PkInfo_OCR(tk.Frame):
         self.button_searchdb.grid(row=4,column=2,padx=2,pady=2,sticky=tk.W+tk.E+tk.N+tk.S)
 
         self.task_id = None
+        self.poll_task_id = None
         self.func_check_leveltext()
+        self.func_poll_ocr_result()
 
     def close(self) -> None:
         """
@@ -99,47 +106,53 @@ class PkInfo_OCR(tk.Frame):
         """
         self.ocr_runner.stop_ocr_thread()
         self.after_cancel(self.task_id)
+        self.after_cancel(self.poll_task_id)
         self.logger.info("Close PkInfo-OCR")
 
     def func_check_leveltext(self) -> None:
         """
-        レベル表示のテキストをOCRで検知した場合に、ポケモン名のOCRを実行する
+        レベル表示のOCRをワーカーに依頼する
+        結果はfunc_poll_ocr_resultで受け取る
         """
         logger = self.logger.getChild("func_check_leveltext")
         logger.debug("Run check_leveltext")
         try:
             if self.ocr_runner.is_ocr_running: # カメラが有効の場合
                 logger.debug("Camera is True")
+                # 前回のOCRが終わっていない場合は依頼しない
+                if not self.ocr_scheduler.is_pending("level") and not self.ocr_scheduler.is_pending("namebox"):
+                    self.ocr_scheduler.submit("level", self.result_queue)
+        except Exception as e:
+            logger.error(f"Fault check leveltext : {e}")
+        finally:
+            self.task_id = self.after(1000, self.func_check_leveltext)
 
-                # OCRを実行する共通のフレームリスト
-                grayscale_framelist = self.ocr_runner.get_grayscale_framelist()
-                level_masked_frame = self.ocr_runner.get_masked_frame(grayscale_framelist, "level")
-                level_text = self.ocr_runner.get_ocr_text(level_masked_frame, "level")
-
-                try:
+    def func_poll_ocr_result(self) -> None:
+        """
+        ワーカーから届いたOCR結果を処理する
+        レベル表示のテキストを検知した場合に、ポケモン名のOCRを依頼する
+        """
+        logger = self.logger.getChild("func_poll_ocr_result")
+        try:
+            while True:
+                result = self.result_queue.get_nowait()
+                if result["option"] == "level":
+                    level_text = result["text"]
                     logger.debug("Read OCR(level) : %s", level_text)
-                except Exception as e:
-                    logger.exception(e)
-
-                if level_text != None:
-                    if "Lv" in level_text:
+                    if level_text is not None and "Lv" in level_text:
                         logger.info("Detected Namebox")
-                        name_masked_frame = self.ocr_runner.get_masked_frame(grayscale_framelist, "namebox")
-                        name_text = self.ocr_runner.get_ocr_text(name_masked_frame, "namebox")
-                        logger.debug(f"Read OCR(pokemonbame) : {name_text}")
-                        if name_text is not None or name_text != "":
-                            self.func_search_name(name_text)
-                
-                # grayscale_framelist = self.ocr_runner.get_grayscale_framelist()
-                # name_masked_frame = self.ocr_runner.get_masked_frame(grayscale_framelist, "namebox")
-                # name_text = self.ocr_runner.get_ocr_text(name_masked_frame, "namebox")
-                # logger.debug(f"Read OCR(pokemonbame) : {name_text}")
-                # if name_text is not None or name_text != "":
-                #     self.func_search_name(name_text)
+                        self.ocr_scheduler.submit("namebox", self.result_queue)
+                elif result["option"] == "namebox":
+                    name_text = result["text"]
+                    logger.debug(f"Read OCR(pokemonbame) : {name_text}")
+                    if name_text is not None and name_text != "":
+                        self.func_search_name(name_text)
+        except queue.Empty:
+            pass
         except Exception as e:
-            logger.error(f"Fault check leveltext : {e}")
+            logger.error(f"Fault poll ocr result : {e}")
         finally:
-            self.task_id = self.after(1000, self.func_check_leveltext)
+            self.poll_task_id = self.after(50, self.func_poll_ocr_result)
 
     # UI表記の更新
     def func_update_status(self, name:str, index:str, type1:str, type2:str)  -> None:
@@ -171,18 +184,14 @@ class PkInfo_OCR(tk.Frame):
         """
         logger = self.logger.getChild("func_search_name")
         logger.info(f"Run func_search_name : {text}")
-        result_df:pd.DataFrame = pkcsv._util.Name_search2csv(text)
-        if result_df.empty:
+        # 選出画面で認識した相手のチームを先に調べる
+        record:SpeciesRecord = pkcsv._util.Name_search2record(text, pkcsv.get_team())
+        if record is None:
             logger.debug("No matching name found")
             return
-        logger.debug(f"Found name: {text} -> {result_df.at[result_df.index[0], 'Name']}")
+        logger.debug(f"Found name: {text} -> {record['Name']}")
         try:
-            if isinstance(result_df, pd.DataFrame):
-                name = result_df.at[result_df.index[0],"Name"]
-                index = result_df.index[0]
-                type1 = result_df.at[result_df.index[0],"Type1"]
-                type2 = result_df.at[result_df.index[0],"Type2"]
-                self.func_update_status(name, index, type1, type2)
+            self.func_update_status(record["Name"], record["Key"], record["Type1"], record["Type2"])
         except Exception as e:
             logger.error(f"Fault search")
             logger.exception(e)
@@ -307,20 +316,33 @@ class CanvasGame(tk.Frame):
     def func_thread(self) -> None:
         logger = self.logger.getChild("func_thread")
         logger.info("Run func_thread")
+        last_seq = -1 # 描画済みフレームの連番
+        frame_buffer = self.camera_capture.frame_buffer
         while self.is_thread:
+            # 新しいフレームが届いた時だけ描画する
+            if not frame_buffer.wait_for_frame(last_seq, timeout=0.1):
+                continue
+            last_seq = frame_buffer.latest_seq
             if self.camera_capture.is_capturing:
                 self.func_update_canvas()
-            time.sleep(0.01)
 
     def func_update_canvas(self) -> None:
         """キャンバスを更新する
         """
         logger = self.logger.getChild("func_update_canvas")
         logger.debug("Run func_update_canvas")
-        frame = self.camera_capture.get_frame()
+        frame_buffer = self.camera_capture.frame_buffer
+        entry = frame_buffer.get_latest()
+        if entry is None:
+            return
+        seq, _, frame = entry
 
         try:
             frame = cv2.resize(frame, (self.width, self.height))
+            # 縮小中にキャプチャがスロットを上書きした場合は、崩れた画像を描画せずに次のフレームを待つ
+            if not frame_buffer.is_valid(seq):
+                logger.debug(f"Discard overwritten frame({seq})")
+                return
 
             self.photo = ImageTk.PhotoImage(image=Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)))
             self.canvas_img.create_image(0, 0, anchor=tk.NW, image=self.photo)
@@ -340,19 +362,24 @@ class CanvasGame(tk.Frame):
         self.canvas_img.create_image(0, 0, anchor=tk.NW, image=self.photo)
 
 class CanvasPkBox(tk.Frame):
-    def __init__(self, master:tk.Tk, camera_capture:CameraCapture, ocr_runner:OcrRunner,**kwargs):
+    def __init__(self, master:tk.Tk, camera_capture:CameraCapture, ocr_runner:OcrRunner, ocr_scheduler:OcrScheduler, image_writer:ImageWriter, **kwargs):
         """対戦開始時の相手の手持ちリストを撮影、表示するフレーム
 
         Args:
             master (tk.Tk): フレームを表示する親ウィンドウ
             camera_capture (CameraCapture): カメラキャプチャー
             ocr_runner (OcrRunner): OCR管理クラス
+            ocr_scheduler (OcrScheduler): OCRをワーカーで実行するクラス
+            image_writer (ImageWriter): 画像の保存キュー
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("CanvasPkBox")
         self.logger.info("Called CanvasPkBox")
 
         self.ocr_runner = ocr_runner
+        self.ocr_scheduler = ocr_scheduler
+        self.image_writer = image_writer
+        self.result_queue = queue.Queue() # OCR結果の受け取り
 
         self.pkhash = PkHash()
         self.frame_forge = CameraFrameForge(camera_capture)
@@ -364,11 +391,17 @@ class CanvasPkBox(tk.Frame):
         self.iconlist = [] # 定型アイコン
         self.keylist = []
         self.dislist = []
+        self.candidatelist = [] # 候補リスト(識別キー、ハミング距離、参照画像の番号)
+        self.candidate_count = int(config.get("DEFAULT","hash_candidate_count",fallback="5"))
         self.cutframelist = []
         self.outline_iconlist = [] # 輪郭切り抜きアイコン
         self.box_frame = None
         self.crop_frame = None
         self.cash_frame = None
+        self.source_name = None # 表示中のチームリストの保存ファイル名
+        # 対戦の終わりを検知できないため、選出画面から一定時間(秒)が過ぎたら相手のチームを照合の候補から外す
+        self.team_expire_time = int(config.get("DEFAULT","team_expire_time",fallback="1320"))
+        self.team_time = None # 相手のチームを認識した時刻
 
         # ウェジット作成
         self.canvas_frame = tk.Frame(self, width=250)
@@ -376,7 +409,8 @@ class CanvasPkBox(tk.Frame):
 
         # サブウェジット作成
         for _ in range(0,6):
-            pksub = SubFrame_PkBox(self.canvas_frame)
+            pksub = SubFrame_PkBox(self.canvas_frame, self.image_writer)
+            pksub.on_select = self.func_publish_team
             pksub.pack(anchor=tk.NW)
             self.pkbox_subframe_list.append(pksub)
 
@@ -384,38 +418,57 @@ class CanvasPkBox(tk.Frame):
         self.canvas_frame.pack(fill=tk.BOTH, expand=True)
         self.button_save_pkbox.pack(padx=5, pady=5, fill=tk.BOTH, expand=True)
 
+        self.task_id = None
+        self.poll_task_id = None
         self.update_pkbox()
+        self.func_poll_ocr_result()
 
     def update_pkbox(self)  -> None:
         """
-        カメラ映像からポケモンリストの画像の取得
-        CanvasPkBox.updateを実行
+        選出画面のOCRをワーカーに依頼する
+        OCRと同じタイミングのフレームからポケモンリストの画像も切り抜く
         """
-        # FIXME:テキスト取得から画像の取得まで時間がかかることで、画面変化のタイミングでリストが更新される場合がある
-        # FIXME: 処理に時間がかかってmainloopが一瞬止まる
         logger = self.logger.getChild("update_pkbox")
         logger.debug("Run update_pkbox")
         if self.ocr_runner.is_ocr_running: # カメラが有効だった場合
+            # 前回のOCRが終わっていない場合は依頼しない
+            if not self.ocr_scheduler.is_pending("rankbattle"):
+                self.ocr_scheduler.submit("rankbattle", self.result_queue, crop_option="pokemonbox")
+        else:
+            # キャプチャを止めた場合は対戦も終わっているとみなす
+            self.func_clear_team()
+        if self.team_time is not None and time.time() - self.team_time > self.team_expire_time:
+            logger.info("Team expired")
+            self.func_clear_team()
 
-            framelist = self.ocr_runner.get_framelist()
-            grayscale_framelist = self.ocr_runner.get_grayscale_framelist()
-
-            masked_frame = self.ocr_runner.get_masked_frame(grayscale_framelist, "rankbattle")
-            text = self.ocr_runner.get_ocr_text(masked_frame, "rankbattle")
-
-            # 文字列の類似度計算
-            if text is not None:
-                # TODO:カジュアルバトルにも対応させる
-                similar_val = Levenshtein.distance(text, "ランクバトル")
-                logger.debug(f"OCR read {text}({similar_val})")
-            else:
-                similar_val = 99
+        self.task_id = self.after(5000, self.update_pkbox)
 
-            if similar_val < 3:
-                crop_frame = self.frame_forge.crop_frame(framelist[0], "pokemonbox")
-                self.func_save_pkbox(crop_frame)
+    def func_poll_ocr_result(self) -> None:
+        """
+        ワーカーから届いたOCR結果を処理する
+        選出画面を検知した場合にポケモンリストを更新する
+        """
+        logger = self.logger.getChild("func_poll_ocr_result")
+        try:
+            while True:
+                result = self.result_queue.get_nowait()
+                text = result["text"]
+                # 文字列の類似度計算
+                if text is not None:
+                    # TODO:カジュアルバトルにも対応させる
+                    similar_val = Levenshtein.distance(text, "ランクバトル")
+                    logger.debug(f"OCR read {text}({similar_val})")
+                else:
+                    similar_val = 99
 
-        self.after(5000, self.update_pkbox)
+                if similar_val < 3 and result["crop_frame"] is not None:
+                    self.func_save_pkbox(result["crop_frame"])
+        except queue.Empty:
+            pass
+        except Exception as e:
+            logger.error(f"Fault poll ocr result : {e}")
+        finally:
+            self.poll_task_id = self.after(50, self.func_poll_ocr_result)
 
     def func_save_pkbox(self, crop_frame: np.ndarray)  -> None:
         """画面内の相手のチームリストを撮影し、キャンパスに描画する
@@ -441,39 +494,31 @@ class CanvasPkBox(tk.Frame):
             self.logger.debug("Cash_frame is None" if self.cash_frame is None else "Team image is not similar")
 
             date = datetime.datetime.now().strftime("%y%m%d%H%M%S")
-            folder_path = f"{self.screenshot_folder_path}/battleteam"
-            filename = f"battleteam_{date}.png"
-            try:
-                if os.path.exists(folder_path):
-                    self.logger.info(f"Already {folder_path}")
-                else:
-                    os.makedirs(folder_path)
-                    self.logger.info(f"Success makedirs {folder_path}")
-                    
-            except:
-                self.logger.error(f"Fault makedir {folder_path}")
-            cv2.imwrite(f"{folder_path}\{filename}",self.crop_frame)
+            # 保存する画像(保存先フォルダ、ファイル名、画像)
+            saveitems = [(f"{self.screenshot_folder_path}/battleteam", f"battleteam_{date}", self.crop_frame)]
             self.cash_frame = self.crop_frame # キャッシュのコピー
+            self.source_name = f"battleteam_{date}"
+            # 新しい選出画面では前の対戦の相手のチームを使わない
+            self.func_clear_team()
+            self.team_time = time.time()
 
-            # フレーム内のポケモンの認識結果のキーと、類似度のリストを取得
+            # フレーム内のポケモンの認識結果の候補リストを取得
             # try:
-            self.keylist, self.dislist, self.cutframelist, self.outline_iconlist = self.pkhash.RecognitionPokemonImages(self.crop_frame)
+            self.candidatelist, self.cutframelist, self.outline_iconlist = self.pkhash.RecognitionPokemonCandidates(self.crop_frame, self.candidate_count)
 
             # アイコン画像の保存
             for i in range(0,6):
-                if not os.path.exists(f"{self.screenshot_folder_path}/icon/outline"):
-                    os.makedirs(f"{self.screenshot_folder_path}/icon/outline")
-                if not os.path.exists(f"{self.screenshot_folder_path}/icon/binary"):
-                    os.makedirs(f"{self.screenshot_folder_path}/icon/binary")
-
-                cv2.imwrite(f"{self.screenshot_folder_path}/icon/outline/{date}_{i}.png",self.outline_iconlist[i])
+                saveitems.append((f"{self.screenshot_folder_path}/icon/outline", f"{date}_{i}", self.outline_iconlist[i]))
                 gray = cv2.cvtColor(self.outline_iconlist[i], cv2.COLOR_BGR2GRAY)
                 _, binary_img = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
-                cv2.imwrite(f"{self.screenshot_folder_path}/icon/binary/{date}_{i}.png",binary_img)
-                self.logger.debug(f"Write icon/outline/{date}_{i}.png")
+                saveitems.append((f"{self.screenshot_folder_path}/icon/binary", f"{date}_{i}", binary_img))
 
-            # 表示の更新
-            self.func_reload_pkbox()
+            # 書き出しは保存キューのスレッドでまとめて行う
+            self.image_writer.save_batch(saveitems)
+            self.logger.debug(f"Request save battleteam_{date}")
+
+            # 表示の更新(認識結果はそのまま使う)
+            self.func_update_subframes()
 
     def func_reload_pkbox(self) -> None:
         """
@@ -481,35 +526,71 @@ class CanvasPkBox(tk.Frame):
         """
         self.logger.debug("Run func_reload_pkbox")
         try:
-            self.keylist, self.dislist, self.cutframelist, self.outline_iconlist = self.pkhash.RecognitionPokemonImages(self.crop_frame)
+            self.candidatelist, self.cutframelist, self.outline_iconlist = self.pkhash.RecognitionPokemonCandidates(self.crop_frame, self.candidate_count)
         except:
-            self.logger.error("Fault RecognitionPokemonImages")
+            self.logger.error("Fault RecognitionPokemonCandidates")
             return
+        self.func_update_subframes()
+
+    def func_update_subframes(self) -> None:
+        """
+        認識結果をサブフレームに反映する
+        """
+        self.logger.debug("Run func_update_subframes")
+        self.keylist = [candidates[0][0] if candidates else None for candidates in self.candidatelist]
+        self.dislist = [candidates[0][1] if candidates else 64 for candidates in self.candidatelist]
         for i in range(0,6):
-            pokemon_series = pkcsv.get_series(self.keylist[i])
-            self.pkbox_subframe_list[i].key = self.keylist[i]
-            self.pkbox_subframe_list[i].pokemon_name = pokemon_series["Name"]
             self.pkbox_subframe_list[i].cut_frame = self.cutframelist[i]
             self.pkbox_subframe_list[i].outline_iconframe  = self.outline_iconlist[i]
-            self.pkbox_subframe_list[i].pokemon_form = pokemon_series["Form"]
-            self.pkbox_subframe_list[i].search_distance = self.dislist[i]
-            self.pkbox_subframe_list[i].update_subpkbox()
+            self.pkbox_subframe_list[i].source = f"{self.source_name}:{i}" if self.source_name is not None else None
+            self.pkbox_subframe_list[i].set_candidates(self.candidatelist[i])
+        self.func_publish_team()
+
+    def func_publish_team(self) -> None:
+        """
+        表示中の相手のチームを、ポケモン名の照合の候補として設定する
+        各枠は選んだ候補のみとし、確かでない枠は2番目の候補まで含める
+        """
+        if self.team_time is None: # 期限切れの後に選び直した場合
+            self.team_time = time.time()
+        keys = []
+        for subframe in self.pkbox_subframe_list:
+            if subframe.key is None:
+                continue
+            keys.append(subframe.key)
+            if not subframe.is_confident() and len(subframe.candidates) > 1:
+                keys.append(subframe.candidates[1][0])
+        pkcsv.set_team(keys)
+        self.logger.getChild("func_publish_team").debug(f"Publish team : {keys}")
+
+    def func_clear_team(self) -> None:
+        """
+        ポケモン名の照合の候補から相手のチームを外す
+        """
+        if self.team_time is None:
+            return
+        self.team_time = None
+        pkcsv.set_team([])
+        self.logger.getChild("func_clear_team").debug("Clear team")
 
     def close(self) -> None:
         """
         終了時の処理
         """
         self.ocr_runner.stop_ocr_thread()
+        self.after_cancel(self.task_id)
+        self.after_cancel(self.poll_task_id)
 
 class SubFrame_PkBox(tk.Frame):
     # TODO: ポケモンの画像から、データベースの検索やポケ徹の検索ができるようにする
     # TODO: タイプを確認できるようにする
     # TODO: 名前などを表示していない状態でも、空間サイズを固定
-    def __init__(self, master:tk.Frame, **kwargs):
+    def __init__(self, master:tk.Frame, image_writer:ImageWriter, **kwargs):
         """ポケモンの画像と名前をセットにしたサブフレーム
 
         Args:
             master (tk.Frame): フレームを表示する親ウィンドウ
+            image_writer (ImageWriter): 画像の保存キュー
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("SubFrame_PkBox")
@@ -518,6 +599,7 @@ class SubFrame_PkBox(tk.Frame):
         # print("create_SubFrame_PkBox")
 
         self.root = master
+        self.image_writer = image_writer
 
         self.key = None # ポケモンの識別ID
         self.pokemon_name = "" # ポケモン名
@@ -527,6 +609,14 @@ class SubFrame_PkBox(tk.Frame):
         self.outline_iconframe = None # ポケモンの輪郭切り取り画像
 
         self.search_distance = 0 # 検索時の類似度
+        self.search_margin = 0 # 2番目の候補との距離の差
+        self.candidates = [] # 候補リスト(識別キー、ハミング距離、参照画像の番号)
+        self.is_selected = False # 候補を手動で選択した
+        # 認識結果を採用する条件(距離が上限以下、かつ2番目の候補との差が下限以上)
+        self.max_distance = int(config.get("DEFAULT","hash_max_distance",fallback="8"))
+        self.min_margin = int(config.get("DEFAULT","hash_min_margin",fallback="1"))
+        self.source = None # アイコンの元画像(チームリストのファイル名:番号)
+        self.on_select = None # 候補を手動で選択した時に呼ぶ関数
 
         self.source_image = None # キャンバス描画用
         self.photo_image = None # キャンバス描画用
@@ -557,8 +647,10 @@ class SubFrame_PkBox(tk.Frame):
         self.clickmenu = ClickMenu(self)
 
         self.context_menu = tk.Menu(self, tearoff=0)
-        self.context_menu.add_command(label="Hashを追加",command=lambda:self.clickmenu.addHashData(self.cut_frame))
-        self.context_menu.add_command(label="Hashを更新",command=lambda:self.clickmenu.updateHashData(self.key, self.cut_frame))
+        self.context_menu.add_command(label="Hashを追加",command=lambda:self.clickmenu.addHashData(self.cut_frame, self.source))
+        self.context_menu.add_command(label="Hashを更新",command=lambda:self.clickmenu.updateHashData(self.key, self.cut_frame, self.source))
+        self.candidate_menu = tk.Menu(self.context_menu, tearoff=0)
+        self.context_menu.add_cascade(label="候補", menu=self.candidate_menu)
         self.context_menu.add_command(label="DBを検索", command=lambda:self.clickmenu.searchDB(self.pokemon_name))
         self.context_menu.add_command(label="詳細を表示", command=lambda:self.clickmenu.viewInfo(self.key, self.cut_frame))
 
@@ -609,6 +701,68 @@ class SubFrame_PkBox(tk.Frame):
         # canvasにイメージを作成する部分
         self.canvas_pokemon.create_image(0, 0, anchor=tk.NW, image=self.photo_image)
 
+    def set_candidates(self, candidates:list[tuple[str, int, int]]) -> None:
+        """認識結果の候補を設定し、最も近い候補を表示する
+
+        Args:
+            candidates (list[tuple[str, int, int]]): (識別キー、ハミング距離、参照画像の番号)のリスト(距離の近い順)
+        """
+        self.logger.debug("Run set_candidates")
+        self.candidates = candidates
+        self.search_margin = HashGallery.margin(candidates)
+        self.is_selected = False
+
+        # 候補メニューの作成
+        self.candidate_menu.delete(0, tk.END)
+        for index, (key, distance, _) in enumerate(candidates):
+            pokemon_record = pkcsv.get_record(key)
+            label = pokemon_record["Name"] if pokemon_record["Form"] is None else f"{pokemon_record['Name']}({pokemon_record['Form']})"
+            self.candidate_menu.add_command(label=f"{label} : {distance}", command=lambda index=index:self.select_candidate(index))
+
+        if len(candidates) > 0:
+            self.select_candidate(0, is_selected=False)
+        else:
+            self.clear_candidate()
+
+    def clear_candidate(self) -> None:
+        """
+        認識できなかった枠の結果を消す(前のチームの結果を残さない)
+        """
+        self.logger.debug("Run clear_candidate")
+        self.key = None
+        self.pokemon_name = ""
+        self.pokemon_form = ""
+        self.search_distance = 0
+        self.reload_subpkbox()
+        self.label_value_name["text"] = ""
+        self.label_value_form["text"] = ""
+        self.label_value_distance["text"] = ""
+
+    def select_candidate(self, index:int, is_selected:bool=True) -> None:
+        """候補を選択して表示する
+
+        Args:
+            index (int): 候補の番号
+            is_selected (bool, optional): 手動で選択した. Defaults to True.
+        """
+        self.logger.debug(f"Run select_candidate({index})")
+        key, distance, _ = self.candidates[index]
+        pokemon_record = pkcsv.get_record(key)
+        self.key = key
+        self.pokemon_name = pokemon_record["Name"]
+        self.pokemon_form = pokemon_record["Form"]
+        self.search_distance = distance
+        self.is_selected = is_selected
+        self.update_subpkbox()
+        if is_selected and self.on_select is not None:
+            self.on_select()
+
+    def is_confident(self) -> bool:
+        """
+        認識結果を採用できるか(手動で選択した、または距離と2番目の候補との差が条件を満たす)
+        """
+        return self.is_selected or (self.search_distance <= self.max_distance and self.search_margin >= self.min_margin)
+
     def update_subpkbox(self) -> None:
         """
         手持ちポケモンの一覧を更新する
@@ -616,18 +770,18 @@ class SubFrame_PkBox(tk.Frame):
         self.logger.debug("Run update_subpkbox")
         self.reload_subpkbox()
 
-        if self.search_distance > 8:
+        if not self.is_confident():
            self.label_value_name["text"]=f"({self.pokemon_name})"
         else:
             self.label_value_name["text"]=self.pokemon_name
-            # 画像保存
-            cv2.imwrite(f"icon/box/{self.key}.png",self.cut_frame)
-            self.logger.debug(f"Write icon/box/{self.key}.png")
-        if pd.isna(self.pokemon_form):
+            # 画像保存(参照用の画像のため保存形式はpngに固定)
+            self.image_writer.save("icon/box", self.key, self.cut_frame, image_format="png")
+            self.logger.debug(f"Request save icon/box/{self.key}.png")
+        if self.pokemon_form is None:
             self.label_value_form["text"]=""
         else:
             self.label_value_form["text"]=self.pokemon_form
-        self.label_value_distance["text"]=self.search_distance
+        self.label_value_distance["text"]=f"{self.search_distance} (差{self.search_margin})"
 
 class ClickMenu:
     # TODO: ウィンドウを開く位置をメインウィンドウに合わせる
@@ -644,25 +798,26 @@ class ClickMenu:
 
         self.sub_window = None
         self.pkhash = PkHash()
-        self.pokemon_df = pkcsv.get_df()
 
         self.image_frame = None
         self.image_photo = None
 
         self.searchdb = SearchDB()
 
-    def addHashData(self, cut_frame:np.ndarray) -> None:
-        """ csvにHashを追加する
+    def addHashData(self, cut_frame:np.ndarray, source:str=None) -> None:
+        """ 参照画像にHashを追加する
 
         Args:
             cut_frame (np.ndarray): アイコンの切抜き画像
+            source (str, optional): アイコンの元画像. Defaults to None.
         """
         self.logger.debug("Run addHashData")
         self.cut_frame = cut_frame
         self.outline_frame = self.pkhash.GetImageByAllContours(self.cut_frame)
 
-        # Dhash値の算出
+        # Dhash値の算出(並べ直し用のpHash値と色ヒストグラムも保存する)
         self.dhash = self.pkhash.CalcPerceptualDhash(self.outline_frame)
+        self.phash, self.hist = self.pkhash.CalcDescriptors(self.outline_frame)
 
         width = 400
         height = 200
@@ -702,10 +857,13 @@ class ClickMenu:
             # name = self.entry_name.get()
             # form = self.entry_form.get()
             # print(self.dic[index])
+            if not pkcsv.has_key(key):
+                self.logger.error(f"Not found key : {key}")
+                return
 
-            self.pokemon_df.loc[key,"Hash"] = self.dhash
-            pkcsv.write_csv(self.pokemon_df)
-            self.logger.debug(f"dHash has Addedd {self.pokemon_df.loc[key]['Name']}")
+            # 既存の参照画像は残し、新しい参照画像として追加する
+            pkgallery.add_sample(key, self.dhash, source, self.phash, self.hist)
+            self.logger.debug(f"dHash has Addedd {pkcsv.get_record(key)['Name']}")
 
             self.logger.debug("Destroy sub_window")
             self.sub_window.destroy()
@@ -713,12 +871,12 @@ class ClickMenu:
         def search_key() -> None:
             try:
                 key = self.entry_key.get()
-                result_df = self.pokemon_df.loc[str(key)]
+                pokemon_record = pkcsv.get_record(str(key))
                 self.entry_name.delete(0,tk.END)
-                self.entry_name.insert(0,result_df["Name"])
+                self.entry_name.insert(0,pokemon_record["Name"])
                 self.entry_form.delete(0,tk.END)
-                if result_df["Form"] != None:
-                    self.entry_form.insert(0,result_df["Form"])
+                if pokemon_record["Form"] != None:
+                    self.entry_form.insert(0,pokemon_record["Form"])
             except:
                 self.logger.error("Fault to search unique-num")
 
@@ -738,25 +896,27 @@ class ClickMenu:
         self.button_search.grid(row=0, column=3)
         self.button_enter.grid(row=5, column=1, columnspan=2)
 
-    def updateHashData(self, key:str, cut_frame:np.ndarray) -> None:
-        """csvの個別更新
+    def updateHashData(self, key:str, cut_frame:np.ndarray, source:str=None) -> None:
+        """参照画像の追加(認識結果のキーに、アイコンを参照画像として追加する)
 
         Args:
             key (str): ポケモンの識別キー
             cut_frame (np.ndarray): ポケモンのアイコン
+            source (str, optional): アイコンの元画像. Defaults to None.
         """
         self.logger.debug("Run updateHashData")
         self.cut_frame = cut_frame
         self.outline_frame = self.pkhash.GetImageByAllContours(self.cut_frame)
 
-        # Dhash値の算出
+        # Dhash値の算出(並べ直し用のpHash値と色ヒストグラムも保存する)
         self.dhash = self.pkhash.CalcPerceptualDhash(self.outline_frame)
+        self.phash, self.hist = self.pkhash.CalcDescriptors(self.outline_frame)
 
         self.logger.debug(f"Update key:{key}")
 
-        self.pokemon_df.loc[key,"Hash"] = self.dhash
-        pkcsv.write_csv(self.pokemon_df)
-        self.logger.debug(f"dHash has Update {self.pokemon_df.at[key,'Name']}")
+        # 既存の参照画像は上書きせず、追加する
+        pkgallery.add_sample(key, self.dhash, source, self.phash, self.hist)
+        self.logger.debug(f"dHash has Update {pkcsv.get_record(key)['Name']}")
 
     def searchDB(self, pokemon_name:str) -> None:
         """
@@ -797,13 +957,13 @@ class ClickMenu:
 
 class PokemnImageInfo(tk.Frame):
 
-    def __init__(self, master:tk.Frame, frame:np.ndarray, pokemon_series:pd.Series, **kwargs):
+    def __init__(self, master:tk.Frame, frame:np.ndarray, pokemon_series:SpeciesRecord, **kwargs):
         """ポケモンの画像と基本情報を表示するフレーム
 
         Args:
             master (tk.Frame): 親フレーム
             frame (np.ndarray): アイコン画像
-            pokemon_series (pd.Series): ポケモンの情報を格納したSeries
+            pokemon_series (SpeciesRecord): ポケモンの情報を格納したレコード
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("PokemonImageInfo")
@@ -886,12 +1046,12 @@ class PokemnImageInfo(tk.Frame):
             row=4,column=2,sticky=tk.W)
 
 class PokemonStatus(tk.Frame):
-    def __init__(self, master:tk.Frame, pokemon_series:pd.Series, **kwargs):
+    def __init__(self, master:tk.Frame, pokemon_series:SpeciesRecord, **kwargs):
         """ポケモンの種族値フレーム
 
         Args:
             master (_type_): オヤフレーム
-            pokemon_series (_type_): ポケモンの情報を格納したSeries
+            pokemon_series (SpeciesRecord): ポケモンの情報を格納したレコード
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("PokemonStatus")
@@ -964,12 +1124,12 @@ class PokemonStatus(tk.Frame):
         )
 
 class WeakType(tk.Frame):
-    def __init__(self, master:tk.Frame, pokemon_series:pd.Series, **kwargs):
+    def __init__(self, master:tk.Frame, pokemon_series:SpeciesRecord, **kwargs):
         """タイプ相性のフレーム
 
         Args:
             master (tk.Frame): 親フレーム
-            pokemon_series (pd.Series): ポケモンの情報を格納したSeries
+            pokemon_series (SpeciesRecord): ポケモンの情報を格納したレコード
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("Log").getChild("WeakType")
@@ -1014,13 +1174,13 @@ class WeakType(tk.Frame):
 
 # 参考元：https://qiita.com/kotai2003/items/45953b4d037a62b2042c
 class StatusGraph(tk.Frame):
-    def __init__(self, master:tk.Tk, pokemon_series:pd.Series, **kwargs):
+    def __init__(self, master:tk.Tk, pokemon_series:SpeciesRecord, **kwargs):
         """
         種族値をグラフ表示するフレーム_
         
         Args:
             master (tk.Tk): 親フレーム
-            pokemon_series (pd.Series): ポケモンの情報を格納したSeries
+            pokemon_series (SpeciesRecord): ポケモンの情報を格納したレコード
         """
         super().__init__(master, **kwargs)
         self.logger = getLogger("log").getChild("StatusGraph")
@@ -1030,7 +1190,7 @@ class StatusGraph(tk.Frame):
 
         fig = plt.Figure(figsize=(6,3), dpi=100)
         ax = fig.add_subplot(1,1,1)
-        self.pokemon_series["HP":"Spe"].rename({
+        pd.Series(self.pokemon_series.stats()).rename({
             "Atk":"こうげき",
             "Def":"ぼうぎょ",
             "SpA":"とくこう",
@@ -1066,7 +1226,7 @@ class PokemonInfoBaseFrame(tk.Frame):
         self.root = master
         self.root.withdraw() # ウィンドウの非表示
         self.frame = frame
-        self.pokemon_series = pkcsv.get_series(key)
+        self.pokemon_series = pkcsv.get_record(key)
 
         # 基本情報フレーム
         self.frame_baseinfo = PokemnImageInfo(self, self.frame, self.pokemon_series, bd=2, relief=tk.SOLID)
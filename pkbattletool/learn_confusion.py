@@ -0,0 +1,79 @@
+"""
+ログの「Found name: X -> Y」(OCRの結果→照合したポケモン名)から、文字の誤認識のコストの表(resources/ocr_confusion.csv)を作成するツール
+
+ログに現れない組み合わせは、既存の表の値(手動で設定した初期値など)を残す
+
+例：
+    python learn_confusion.py logs
+    python learn_confusion.py logs/log_240101120000.txt --prior 5 --dry-run
+"""
+
+import os, sys
+import json
+import argparse
+from logging import getLogger, StreamHandler, WARNING, INFO, Formatter
+
+import pandas as pd
+
+from module import pkcsv
+from module.pkcsv.namematch import learn_confusions
+
+def read_logs(paths:list[str]) -> list[str]:
+    """ログファイルの行を読み込む
+
+    Args:
+        paths (list[str]): ログファイルまたはフォルダのパスのリスト
+
+    Returns:
+        list[str]: ログの行
+    """
+    filelist = []
+    for path in paths:
+        if os.path.isdir(path):
+            filelist += [os.path.join(path, filename) for filename in sorted(os.listdir(path)) if filename.endswith(".txt")]
+        else:
+            filelist.append(path)
+    lines = []
+    for filename in filelist:
+        with open(filename, encoding="utf-8", errors="replace") as f:
+            lines += f.readlines()
+    return lines
+
+def main():
+    # ログ設定
+    logger = getLogger("Log")
+    handler = StreamHandler()
+    logger.setLevel(INFO)
+    handler.setLevel(WARNING)
+    handler.setFormatter(Formatter('%(asctime)s | %(levelname)s | %(name)s - %(message)s'))
+    logger.addHandler(handler)
+
+    # 引数の設定
+    parser = argparse.ArgumentParser(description="ログから文字の誤認識のコストの表を作成する")
+    parser.add_argument("paths", nargs="*", default=["logs"], help="ログファイルまたはフォルダ")
+    parser.add_argument("--prior", type=int, default=2, help="回数が少ない組み合わせのコストを1に近づける値")
+    parser.add_argument("--dry-run", action="store_true", help="表を書き込まない")
+    args = parser.parse_args()
+
+    filename = pkcsv._util.confusion_filename
+    confusion_df = learn_confusions(read_logs(args.paths), prior=args.prior)
+    # ログに現れない組み合わせは既存の値を残す
+    if os.path.exists(filename):
+        current_df = pd.read_csv(filename, dtype={"Read":"str","Correct":"str","Count":"int","Cost":"float"},
+                                 encoding="utf-8", keep_default_na=False)
+        learned = set(zip(confusion_df["Read"], confusion_df["Correct"]))
+        kept_df = current_df[[pair not in learned for pair in zip(current_df["Read"], current_df["Correct"])]]
+        confusion_df = pd.concat([confusion_df, kept_df], ignore_index=True)
+
+    if not args.dry_run:
+        tmp_filename = f"{filename}.tmp"
+        confusion_df.to_csv(tmp_filename, mode="w", encoding="utf-8", index=False)
+        os.replace(tmp_filename, filename)
+    print(json.dumps({
+        "pairs":len(confusion_df),
+        "learned":int((confusion_df["Count"] > 0).sum()),
+        "dry_run":args.dry_run,
+        "top":confusion_df.head(10).to_dict(orient="records")}, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,8 @@ import tkinter as tk
 import os,sys
 from logging import getLogger, Logger, StreamHandler, INFO, DEBUG, Formatter, FileHandler
 
-from mylib import OcrRunner, CameraCapture
+from mylib import OcrRunner, OcrScheduler, CameraCapture, ImageWriter
+from module import pkgallery
 from gui import MenuBar, PkInfo_OCR, CanvasGame, CaptureControl, CanvasPkBox
 
 import datetime
@@ -15,12 +16,14 @@ class MainWindow(tk.Frame):
         self.logger.info("Called MainWindow")
         self.root = master
         
-        self.camera_capture = CameraCapture()
+        self.image_writer = ImageWriter() # 画像の保存キュー
+        self.camera_capture = CameraCapture(image_writer=self.image_writer)
         self.ocr_runner = OcrRunner(self.camera_capture)
+        self.ocr_scheduler = OcrScheduler(self.ocr_runner)
 
         # フレームウェジットの作成
         # ポケモン情報簡易表示
-        self.frame_pkinfo = PkInfo_OCR(self, self.ocr_runner, bd=1, relief=tk.SOLID)
+        self.frame_pkinfo = PkInfo_OCR(self, self.ocr_runner, self.ocr_scheduler, bd=1, relief=tk.SOLID)
         self.frame_pkinfo.grid(row=0, column=0, padx=5, pady=5, sticky=tk.W+tk.E)
         
         # ゲーム画面
@@ -32,7 +35,7 @@ class MainWindow(tk.Frame):
         self.frame_capturecontrol.grid(row=0, column=1, padx=5, pady=5, sticky=tk.W+tk.E+tk.N+tk.S)
         
         # 相手の手持ち一覧
-        self.frame_canvaspkbox = CanvasPkBox(self, self.camera_capture, self.ocr_runner, bd=2, relief=tk.SOLID)
+        self.frame_canvaspkbox = CanvasPkBox(self, self.camera_capture, self.ocr_runner, self.ocr_scheduler, self.image_writer, bd=2, relief=tk.SOLID)
         self.frame_canvaspkbox.grid(row=0, column=2, rowspan=3, padx=5, pady=5, sticky=tk.W+tk.E+tk.N+tk.S)
     
         self.grid()
@@ -46,7 +49,10 @@ class MainWindow(tk.Frame):
         self.frame_capturecontrol.close()
         self.frame_pkinfo.close()
         self.frame_canvaspkbox.close()
+        self.ocr_scheduler.close()
         self.ocr_runner.close()
+        self.image_writer.close()
+        pkgallery.save() # 参照画像の認識回数を保存
         self.logger.info("Close MainWindow")
 
 class Application(tk.Tk):
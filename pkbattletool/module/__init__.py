@@ -1,2 +1,3 @@
 from .config import *
-from .pkcsv import *
\ No newline at end of file
+from .pkcsv import *
+from .pkgallery import *
\ No newline at end of file
@@ -33,7 +33,28 @@ class ConfigIni(configparser.ConfigParser):
                 "screenshot_folder": "\\screenshot",
                 "display_fps" : 30,
                 "display_width" : 640,
-                "display_height" : 360}
+                "display_height" : 360,
+                "frame_source" : "camera",
+                "frame_source_path" : "",
+                "frame_source_realtime" : True,
+                "frame_diff_threshold" : 2,
+                "frame_force_interval" : 500,
+                "image_format" : "png",
+                "image_png_compression" : 1,
+                "image_quality" : 90,
+                "image_queue_size" : 32,
+                "image_queue_policy" : "drop",
+                "ocr_workers" : 2,
+                "ocr_backend" : "auto",
+                "ocr_cache_size" : 128,
+                "ocr_cache_tolerance" : 0.0,
+                "hash_candidate_count" : 5,
+                "hash_max_distance" : 8,
+                "hash_min_margin" : 1,
+                "hash_workers" : 0,
+                "hash_rerank_count" : 10,
+                "gallery_compact_count" : 100,
+                "team_expire_time" : 1320}
         
     def print_conf(self):
         self.logger.getChild("print_conf").debug("Run print_conf")
@@ -90,8 +111,10 @@ class ConfigIni(configparser.ConfigParser):
 _util = ConfigIni()
 
 # 設定値の取得
-def get(section,key):
-    return _util.get(section,key)
+def get(section,key,fallback=None):
+    if fallback is None:
+        return _util.get(section,key)
+    return _util.get(section,key,fallback=fallback)
 
 # 設定の更新
 def update(section,key,value):
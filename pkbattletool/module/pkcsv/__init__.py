@@ -1,106 +1,427 @@
 import os, sys
+import threading
+import numpy as np
 import pandas as pd
 import Levenshtein
 from logging import getLogger
 
+from .namematch import normalize_name, weighted_distance, load_confusion_costs
+from .compiled import read_compiled
+from .species import SpeciesRecord, build_records
+
 class PkCSV:
+    filename = f"resources/pokedb_SV.csv" # csvデータファイル
+
     def __init__(self):
         self.logger = getLogger("Log").getChild("PkCSV")
         self.logger.debug("Hello PkCSV")
         
-        # csvデータファイル
-        self.filename = f"resources/pokedb_SV.csv"
+        self.confusion_filename = f"resources/ocr_confusion.csv" # OCRの誤認識のコストの表
         
         self.pokemon_df = None
+        self.records:list[SpeciesRecord] = [] # 図鑑のデータフレームの行の順のレコード
+        self.key_records:dict[str, SpeciesRecord] = {} # 識別キー→レコード
+        self.version:int = 0 # 書き込みのたびに増やす(キャッシュの更新判定に使う)
+
+        # ポケモン名の索引(読み込み時に作成する)
+        self.name_index:dict[str, list[str]] = {} # ポケモン名→識別キーのリスト(図鑑の順)
+        self.name_positions:dict[str, list[int]] = {} # ポケモン名→図鑑のデータフレームの行番号のリスト
+        self.key_positions:dict[str, int] = {} # 識別キー→図鑑のデータフレームの行番号
+        self.key_norms:dict[str, str] = {} # 識別キー→正規化したポケモン名
+        self.name_list:list[str] = [] # ポケモン名(重複なし、図鑑の順)
+        self.norm_list:list[str] = [] # 正規化したポケモン名(name_listと同じ順)
+        self.norm_index:dict[str, str] = {} # 正規化したポケモン名→ポケモン名(図鑑の順で最初のもの)
+        self.name_lengths:np.ndarray = None # 正規化したポケモン名の文字数
+        self.ratio_scales:dict[int, np.ndarray] = {} # 検索する文字数→2 / (正規化したポケモン名の文字数 + 検索する文字数)
+        self.char_index:dict[str, list[np.ndarray]] = {} # 文字→n個目:その文字をn+1個以上含む正規化したポケモン名の番号
+
+        # 類似検索の設定
+        self.match_count:int = 8 # 誤認識のコストで並べ直す候補の数
+        self.match_slack:int = 2 # 並べ直す候補に加える数(類似度の順がコストの順と少し異なる場合のため)
+        self.max_cost_ratio:float = 0.4 # 誤認識のコストを使った編集距離/文字数がこれを超える場合は見つからないとする
+
+        # 対戦中の相手のチーム(選出画面で認識した識別キー. 名前の照合で先に調べる)
+        self.team_keys:list[str] = []
 
         # csvの読み込み
         self.RoadCSV()
+        self.confusion_costs:dict[str, dict[str, float]] = load_confusion_costs(self.confusion_filename)
+        self.logger.debug(f"Load {self.confusion_filename} : {sum(len(row) for row in self.confusion_costs.values())} pairs")
 
-    def RoadCSV(self):
+    def RoadCSV(self, rebuild:bool=False):
         """
         CSVをロード
         欠損値はNone
+        解析済みのキャッシュ(resources/cache/pokedb_SV.npz)があればそちらを読み込む(CSVが更新されていれば作り直す)
+
+        Arg:
+            rebuild[bool] : キャッシュがあっても作り直す
         """
-        self.pokemon_df = pd.read_csv(self.filename, index_col="Key", dtype={
+        self.pokemon_df = read_compiled(self.filename, self.ParseCSV, rebuild)
+        self.logger.debug("Load pokedb_SV.csv")
+        self.records = build_records(self.pokemon_df)
+        # 同じ識別キーの行が複数ある場合は最初の行
+        self.key_records = {}
+        for record in self.records:
+            self.key_records.setdefault(record.Key, record)
+        self.BuildNameIndex()
+
+    @staticmethod
+    def ParseCSV(filename:str) -> pd.DataFrame:
+        """
+        CSVを解析する
+
+        Arg:
+            filename[str] : 図鑑データのCSV
+        Return:
+            dataframe
+        """
+        return pd.read_csv(filename, index_col="Key", dtype={
             "Key":"object","Index":"int","Name":"str","Form":"str","Type1":"str","Type2":"str",
             "Ability1":"str","Ability2":"str","HAbility":"str","HP":"int","Atk":"int","Def":"int",
             "SpA":"int","SpD":"int","Spe":"int","Tot":"int","Hash":"str"},encoding = "shift-jis",keep_default_na=False).replace({"":None})
-        self.logger.debug("Load pokedb_SV.csv")
+
+    def BuildNameIndex(self):
+        """
+        ポケモン名の索引を作成する
+        完全一致用の辞書と、類似検索用の正規化したポケモン名の文字の転置索引
+        """
+        name_index:dict[str, list[str]] = {}
+        name_positions:dict[str, list[int]] = {}
+        for position, (key, name) in enumerate(zip(self.pokemon_df.index, self.pokemon_df["Name"].tolist())):
+            if name is None:
+                continue
+            name_index.setdefault(name, []).append(key)
+            name_positions.setdefault(name, []).append(position)
+        name_list = list(name_index.keys())
+        norm_list = [normalize_name(name) for name in name_list]
+        norm_index:dict[str, str] = {}
+        for name, norm in zip(name_list, norm_list):
+            norm_index.setdefault(norm, name)
+
+        # 文字の転置索引(全ての名前の文字を(文字、名前の番号)の順に並べ、同じ組を数える)
+        name_lengths = np.array([len(norm) for norm in norm_list], dtype=np.int64)
+        codes = np.frombuffer("".join(norm_list).encode("utf-32-le"), dtype=np.uint32).astype(np.int64)
+        pairs, counts = np.unique(codes * max(len(norm_list), 1) + np.repeat(np.arange(len(norm_list)), name_lengths), return_counts=True)
+        pair_codes, pair_ids = np.divmod(pairs, max(len(norm_list), 1))
+        char_codes, char_starts = np.unique(pair_codes, return_index=True)
+        # 含む数ごとに分けておくと、共通する文字の数(少ない方の数)を重みなしの数え上げで求められる
+        char_index = {chr(code):[name_ids[char_counts >= count].astype(np.intp) for count in range(1, int(char_counts.max()) + 1)]
+                      for code, name_ids, char_counts in zip(char_codes.tolist(), np.split(pair_ids, char_starts[1:]), np.split(counts, char_starts[1:]))}
+
+        self.name_index = name_index
+        self.name_positions = name_positions
+        self.key_positions = {key:position for position, key in enumerate(self.pokemon_df.index)}
+        self.key_norms = {key:norm for name, norm in zip(name_list, norm_list) for key in name_index[name]}
+        self.name_list = name_list
+        self.norm_list = norm_list
+        self.norm_index = norm_index
+        self.name_lengths = name_lengths.astype(np.float64)
+        self.ratio_scales = {}
+        self.char_index = char_index
+        self.logger.debug(f"Build name index : {len(name_list)} names, {len(char_index)} chars")
+
+    def get_rows(self, positions:list[int]) -> pd.DataFrame:
+        """
+        行番号のデータフレームを取得する(連続する行は範囲で切り出す方が速い)
+
+        Arg:
+            positions[list[int]] : 図鑑のデータフレームの行番号のリスト
+        Return:
+            dataframe
+        """
+        if positions[-1] - positions[0] == len(positions) - 1:
+            return self.pokemon_df.iloc[positions[0]:positions[-1] + 1]
+        return self.pokemon_df.iloc[positions]
+
+    def scan_name(self, name:str, k:int=1) -> list[tuple[int, str, int, float]]:
+        """
+        類似するポケモン名を類似度の高い順にk個求める(正規化したポケモン名で比べる)
+        共通する文字の数から類似度の上限を求め、上限の高い順に、k番目の類似度を超え得る名前のみ計算する
+        (類似度の上位k個は全件を比べた場合と同じ. k番目と同じ値の名前は図鑑の順にならない場合がある)
+
+        Arg:
+            name[str] : 検索したいポケモン名
+            k[int] : 求める名前の数
+        Return:
+            list[tuple[int, str, int, float]] : (名前の番号、ポケモン名、編集距離、類似度)のリスト(類似度の高い順、同じ場合は図鑑の順). 共通する文字が無ければ空
+        """
+        name = normalize_name(name) if name else ""
+        if not name or len(self.name_list) == 0:
+            return []
+        # 共通する文字の数(文字ごとに少ない方の数)
+        idlist = []
+        for char in set(name):
+            if char in self.char_index:
+                idlist += self.char_index[char][:name.count(char)]
+        # どの名前とも共通する文字が無ければ、似た名前は無い
+        if not idlist:
+            return []
+        common = np.bincount(np.concatenate(idlist), minlength=len(self.name_list))
+        # 類似度(1 - 挿入削除の距離 / 文字数の合計)の上限. 挿入削除の距離は文字数の合計 - 共通する文字の数 x 2以上
+        scale = self.ratio_scales.get(len(name))
+        if scale is None:
+            scale = self.ratio_scales.setdefault(len(name), 2 / (self.name_lengths + len(name)))
+        upper_ratios = common * scale
+
+        # 多くの場合は上限の上位(kの3倍)の中で止まるため、先にそれだけを並べる
+        k = max(k, 1)
+        size = min(k * 3, len(self.name_list))
+        name_ids = np.argpartition(upper_ratios, len(self.name_list) - size)[len(self.name_list) - size:]
+        name_ids = name_ids[np.argsort(-upper_ratios[name_ids], kind="stable")]
+        best = [] # 上位k個の(類似度、-名前の番号)(昇順)
+        is_rest = False
+        while True:
+            is_stopped = False
+            for name_id, upper_ratio in zip(name_ids.tolist(), upper_ratios[name_ids].tolist()):
+                # 共通する文字が無い名前と、k番目を超えられない名前は計算しない
+                if upper_ratio == 0.0 or (len(best) >= k and upper_ratio <= best[0][0]):
+                    is_stopped = True
+                    break
+                score = (Levenshtein.ratio(name, self.norm_list[name_id]), -name_id)
+                if len(best) < k:
+                    best.append(score)
+                elif score > best[0]:
+                    best[0] = score
+                else:
+                    continue
+                best.sort()
+            if is_stopped or is_rest or len(best) < k:
+                break
+            # 上位で止まらなかった場合は、残りの名前からk番目を超え得るものを並べる
+            upper_ratios[name_ids] = 0.0
+            name_ids = np.flatnonzero(upper_ratios > best[0][0])
+            name_ids = name_ids[np.argsort(-upper_ratios[name_ids], kind="stable")]
+            is_rest = True
+        # 編集距離は残った候補のみ計算する
+        return [(-name_id, self.name_list[-name_id], Levenshtein.distance(name, self.norm_list[-name_id]), ratio)
+                for ratio, name_id in sorted(best, reverse=True)]
+
+    def search_name(self, name:str, k:int=5) -> list[tuple[str, int, float]]:
+        """
+        類似するポケモン名を類似度の高い順に探す
+
+        Arg:
+            name[str] : 検索したいポケモン名
+            k[int] : 返す候補の数
+        Return:
+            list[tuple[str, int, float]] : (ポケモン名、編集距離、類似度)のリスト(類似度の高い順、同じ場合は図鑑の順)
+        """
+        return [(candidate, distance, ratio) for _, candidate, distance, ratio in self.scan_name(name, k)]
     
     def WriteCSV(self, new_df):
-        new_df.to_csv(self.filename, mode="w", encoding="shift-jis")
+        """
+        CSVに書き込み、読み込み直す(書き込み途中で終了しても壊れないよう、一時ファイルを置き換える)
+        書き込めない場合(Shift-JISにできない文字など)は元のCSVのまま
+
+        Arg:
+            new_df[DataFrame] : 図鑑のデータフレーム
+        """
+        tmp_filename = f"{self.filename}.tmp"
+        try:
+            new_df.to_csv(tmp_filename, mode="w", encoding="shift-jis")
+        except Exception:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        os.replace(tmp_filename, self.filename)
+        self.RoadCSV()
+        self.version += 1
     
-    def Name_search2csv(self, name:str) -> pd.DataFrame:
+    def set_team(self, keys:list[str]):
+        """
+        対戦中の相手のチームを設定する
+
+        Arg:
+            keys[list[str]] : 識別キーのリスト(優先する順. 図鑑に無いキーと重複は除く)
+        """
+        self.team_keys = [key for key in dict.fromkeys(keys) if key in self.key_positions]
+        self.logger.getChild("set_team").debug(f"Set team : {self.team_keys}")
+
+    def match_candidates(self, name:str, candidate_keys:list[str], fuzzy:bool=True) -> list[int]:
+        """
+        ポケモン名を候補の識別キーのポケモン名とのみ照合する
+
+        Arg:
+            name[str] : ポケモンの名前
+            candidate_keys[list[str]] : 候補の識別キーのリスト(優先する順)
+            fuzzy[bool] : 一致しない場合に、誤認識のコストを使った編集距離で照合する
+        Return:
+            list[int] : 合致した識別キーの行番号. 見つからなければNone
         """
-        ポケモン名をcsvファイルと照合し、合致するデータフレームを返す
+        norm = normalize_name(name)
+        candidates = [(key, self.key_norms[key]) for key in candidate_keys if key in self.key_norms]
+        for key, norm_candidate in candidates:
+            if norm_candidate == norm:
+                return [self.key_positions[key]]
+        if not fuzzy:
+            return None
+        scores = []
+        for order, (key, norm_candidate) in enumerate(candidates):
+            cost = weighted_distance(norm, norm_candidate, self.confusion_costs)
+            if cost <= self.max_cost_ratio * max(len(norm), len(norm_candidate)):
+                scores.append((cost, order, norm_candidate, key))
+        if len(scores) == 0:
+            return None
+        scores.sort()
+        # 別の名前が同じコストの場合は決められない
+        if len(scores) > 1 and scores[1][0] == scores[0][0] and scores[1][2] != scores[0][2]:
+            return None
+        return [self.key_positions[scores[0][3]]]
+
+    def find_name(self, name:str, candidate_keys:list[str]=None) -> list[int]:
+        """
+        ポケモン名を図鑑と照合し、合致する行番号を返す
+        候補の識別キーがあれば先に候補のみと照合し、見つからなければ図鑑全体と照合する
         名前が見つからなければ、類似度検索をする
-        
+
         Arg:
             name[str] :  ポケモンの名前
+            candidate_keys[list[str]] : 候補の識別キーのリスト(対戦中の相手のチームなど). Defaults to None.
         Return:
-            dataframe|None
+            list[int] : 図鑑のデータフレームの行番号のリスト. 見つからなければ空
         """
-        logger = self.logger.getChild("Name_search2csv")
+        logger = self.logger.getChild("find_name")
         logger.info(f"Call Search to csv-data : {name}")
-        
+
         if name is None:
+            return []
+        # 候補の中で見つかれば、そのまま返す(図鑑に同じ名前がある場合は候補と一致する場合のみ)
+        if candidate_keys:
+            positions = self.match_candidates(name, candidate_keys, fuzzy=name not in self.name_positions)
+            if positions is not None:
+                logger.info(f"{name} was found in candidates")
+                return positions
+        # 図鑑のデータフレーム内に名前が見つかれば、そのまま返す
+        if name in self.name_positions:
+            logger.info(f"{name} was found")
+            return self.name_positions[name]
+        # 正規化(全角半角、ひらがな、小書き文字、似た漢字)すると一致する
+        norm_name = self.norm_index.get(normalize_name(name))
+        if norm_name is not None:
+            logger.info(f"{name} was found as {norm_name}")
+            return self.name_positions[norm_name]
+        # 見つからなければ、類似検索をかける
+        logger.info(f"{name} was not found")
+        return self.analyze_name(name)
+
+    def Name_search2csv(self, name:str, candidate_keys:list[str]=None) -> pd.DataFrame:
+        """
+        ポケモン名をcsvファイルと照合し、合致するデータフレームを返す(照合はfind_name)
+        
+        Arg:
+            name[str] :  ポケモンの名前
+            candidate_keys[list[str]] : 候補の識別キーのリスト(対戦中の相手のチームなど). Defaults to None.
+        Return:
+            dataframe : 見つからなければ空のデータフレーム
+        """
+        positions = self.find_name(name, candidate_keys)
+        if len(positions) == 0:
             return pd.DataFrame()
-        else:
-            # 図鑑のデータフレーム内に名前が見つかれば、そのまま返す
-            if name in self.pokemon_df["Name"].values:
-                result_df = self.pokemon_df[self.pokemon_df["Name"]==name]
-                logger.info(f"{name} was found")
-                return result_df
-            # 見つからなければ、類似検索をかける
-            else:
-                logger.info(f"{name} was not found")
-                return self.analyze_name(name)
+        return self.get_rows(positions)
+
+    def Name_search2record(self, name:str, candidate_keys:list[str]=None) -> SpeciesRecord:
+        """
+        ポケモン名を図鑑と照合し、最初に合致したレコードを返す(照合はfind_name. データフレームを作らない)
+
+        Arg:
+            name[str] :  ポケモンの名前
+            candidate_keys[list[str]] : 候補の識別キーのリスト(対戦中の相手のチームなど). Defaults to None.
+        Return:
+            SpeciesRecord : 見つからなければNone
+        """
+        positions = self.find_name(name, candidate_keys)
+        if len(positions) == 0:
+            return None
+        return self.records[positions[0]]
     
-    def analyze_name(self,name:str) -> pd.DataFrame:
+    def analyze_name(self,name:str) -> list[int]:
         """
-        与えられたポケモン名をcsvと照合し、類似する名前のデータフレームを返す
+        与えられたポケモン名をcsvと照合し、類似する名前の行番号を返す
         
         Arg:
             name[str]: 検索したいポケモン名
         Return:
-            dataframe|None
+            list[int] : 図鑑のデータフレームの行番号のリスト. 見つからなければ空
         """
         logger = self.logger.getChild("analyze_name")
         logger.info("Call analyze_name")
-        if name is not None and name != "":
-            logger.debug(f"Analyze name is \"{name}\"")
-            
-            min_distance = 99
-            max_ratio = 0
-            min_distance_Key = None
-            max_ratio_Key = None
-
-            for index, row in self.pokemon_df.iterrows():
-                # 編集距離の計算
-                name_distance = Levenshtein.distance(name, row.Name)
-                if min_distance > name_distance:
-                    min_distance = name_distance
-                    min_distance_Key = index
-                # 類似度の計算
-                name_ratio = Levenshtein.ratio(name, row.Name)
-                if max_ratio < name_ratio:
-                    max_ratio = name_ratio
-                    max_ratio_Key = index
-
-            # 編集距離と類似度分析でのインデックスが一致
-            if min_distance_Key == max_ratio_Key:
-                return self.pokemon_df.loc[[min_distance_Key]]
-            else:
-                return pd.DataFrame()
-
-
-_util = PkCSV()
+        if name is None or name == "":
+            return []
+        logger.debug(f"Analyze name is \"{name}\"")
+
+        # 類似度の上位の候補のみを、誤認識のコストを使った編集距離で並べ直す(共通する文字が無ければ候補は無い)
+        norm = normalize_name(name)
+        candidates = self.scan_name(name, k=self.match_count + self.match_slack)
+        if len(candidates) == 0:
+            return []
+        # 上限か、見つかった最小のコストを超える候補は途中で打ち切る(同じコストは決められない判定に使う)
+        limit = self.max_cost_ratio * max(len(norm), *(len(self.norm_list[name_id]) for name_id, _, _, _ in candidates))
+        scores = []
+        for name_id, candidate, _, ratio in candidates:
+            cost = weighted_distance(norm, self.norm_list[name_id], self.confusion_costs, limit)
+            if cost <= limit:
+                scores.append((cost, -ratio, name_id, candidate))
+                limit = cost
+        if len(scores) == 0:
+            logger.debug("No name within max cost")
+            return []
+        scores.sort()
+        best_cost, _, _, best_name = scores[0]
+        logger.debug(f"Nearly name \"{best_name}\" : cost={best_cost:.2f}")
+        if best_cost > self.max_cost_ratio * max(len(norm), len(self.norm_list[scores[0][2]])):
+            return []
+        # コストと類似度がどちらも同じ候補がある場合は決められない
+        if len(scores) > 1 and scores[1][:2] == scores[0][:2]:
+            return []
+        return self.name_positions[best_name][:1]
+
+_instance:PkCSV = None
+_instance_lock = threading.Lock()
+
+def _get_util() -> PkCSV:
+    """
+    初回に呼ばれたときに読み込む(importしただけでは読み込まない)
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                _instance = PkCSV()
+    return _instance
+
+def __getattr__(name):
+    # pkcsv._utilは初回の参照で読み込む
+    if name == "_util":
+        return _get_util()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def get_df():
-    return _util.pokemon_df
+    return _get_util().pokemon_df
 
 def get_series(key):
-    return _util.pokemon_df.loc[key]
+    return _get_util().pokemon_df.loc[key]
+
+def get_record(key):
+    return _get_util().key_records[key]
+
+def has_key(key):
+    return key in _get_util().key_records
 
 def write_csv(new_df):
-    _util.WriteCSV(new_df)
\ No newline at end of file
+    _get_util().WriteCSV(new_df)
+
+def get_version():
+    return _get_util().version
+
+def search_name(name, k=5):
+    return _get_util().search_name(name, k)
+
+def set_team(keys):
+    _get_util().set_team(keys)
+
+def get_team():
+    return _get_util().team_keys
+
+def get_keys(name):
+    return _get_util().name_index.get(name, [])
\ No newline at end of file
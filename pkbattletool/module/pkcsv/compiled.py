@@ -0,0 +1,142 @@
+"""
+リソースのCSVをコンパイルしたキャッシュ(NumPyの.npz)
+
+CSVの解析は起動のたびに行うと遅いため、解析したデータフレームを列ごとの配列として保存しておき、次回からはそちらを読み込む
+キャッシュには元のCSVの更新日時とサイズを記録し、どちらかが変わっていれば読み直して作り直す
+
+read_compiled : キャッシュがあれば読み込み、無いか古ければCSVを解析してキャッシュを作成する
+save_compiled : データフレームをキャッシュに保存する
+load_compiled : キャッシュを読み込む(無いか古ければNone)
+"""
+
+import os, sys
+from typing import Callable
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+# キャッシュを置くフォルダ
+cache_dir:str = "resources/cache"
+# 保存形式を変えたら増やす(古い形式のキャッシュは作り直す)
+format_version:int = 1
+
+def cache_path(source:str) -> str:
+    """元のCSVに対応するキャッシュのパス
+
+    Args:
+        source (str): 元のCSVのパス
+
+    Returns:
+        str: キャッシュのパス(例：resources/cache/pokedb_SV.npz)
+    """
+    return os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(source))[0]}.npz")
+
+def source_stamp(source:str) -> np.ndarray:
+    """キャッシュの更新判定に使う値
+
+    Args:
+        source (str): 元のCSVのパス
+
+    Returns:
+        np.ndarray: (保存形式、更新日時(ns)、サイズ)
+    """
+    stat = os.stat(source)
+    return np.array([format_version, stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+def save_compiled(df:pd.DataFrame, source:str) -> str:
+    """データフレームをキャッシュに保存する(書き込み途中で終了しても壊れないよう、一時ファイルを置き換える)
+    読み込みを速くするため、数値の列は型ごとに1つの2次元配列、文字列の列は区切り文字(\\0)でつないだ
+    1つのUTF-8のバイト列と欠損値(None)のマスクにまとめる(pickleは使わない)
+
+    Args:
+        df (pd.DataFrame): 保存するデータフレーム(インデックスも保存する)
+        source (str): 元のCSVのパス
+
+    Returns:
+        str: キャッシュのパス
+    """
+    filename = cache_path(source)
+    frame = df.reset_index()
+    columns = [str(column) for column in frame.columns]
+    dtypes = [str(df.index.dtype), *(str(dtype) for dtype in df.dtypes)] # reset_indexで型が変わらないよう元の型
+    is_numeric = [pd.api.types.is_numeric_dtype(dtype) for dtype in frame.dtypes]
+    arrays = {"stamp":source_stamp(source), "columns":np.array(columns, dtype=str), "dtypes":np.array(dtypes, dtype=str),
+              "index_name":np.array([df.index.name or ""], dtype=str)}
+    # 数値の列(型ごと)
+    for dtype in sorted(set(dtype for dtype, numeric in zip(dtypes, is_numeric) if numeric)):
+        arrays[f"numeric_{dtype}"] = np.column_stack([frame[column].to_numpy() for column, column_dtype in zip(columns, dtypes) if column_dtype == dtype])
+    # 文字列の列(列の順につなぐ)
+    texts = [np.asarray(frame[column], dtype=object) for column, numeric in zip(columns, is_numeric) if not numeric]
+    masks = np.array([pd.isna(values) for values in texts], dtype=bool).reshape(len(texts), len(frame))
+    text = "\0".join("" if is_na else str(value) for values, mask in zip(texts, masks) for value, is_na in zip(values, mask))
+    arrays["text"] = np.frombuffer(text.encode("utf-8"), dtype=np.uint8)
+    arrays["mask"] = masks
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_filename = f"{filename}.tmp.npz"
+    np.savez(tmp_filename, **arrays)
+    os.replace(tmp_filename, filename)
+    return filename
+
+def load_compiled(source:str) -> pd.DataFrame:
+    """キャッシュを読み込む
+
+    Args:
+        source (str): 元のCSVのパス
+
+    Returns:
+        pd.DataFrame: 保存したデータフレーム. キャッシュが無いか、元のCSVから古くなっている場合はNone
+    """
+    filename = cache_path(source)
+    if not os.path.exists(filename):
+        return None
+    with np.load(filename) as arrays:
+        if not np.array_equal(arrays["stamp"], source_stamp(source)):
+            return None
+        columns, dtypes = arrays["columns"].tolist(), arrays["dtypes"].tolist()
+        index_name = arrays["index_name"][0] or None
+        numerics = {dtype:iter(arrays[f"numeric_{dtype}"].T) for dtype in set(dtypes) if f"numeric_{dtype}" in arrays}
+        masks = arrays["mask"]
+        text = arrays["text"].tobytes().decode("utf-8")
+    texts = iter(zip(np.array(text.split("\0"), dtype=object).reshape(masks.shape), masks) if masks.size > 0 else [])
+    data = {}
+    for column, dtype in zip(columns, dtypes):
+        if dtype in numerics:
+            data[column] = next(numerics[dtype])
+        else:
+            values, mask = next(texts)
+            values[mask] = None
+            data[column] = values
+    index = pd.Index(data.pop(columns[0]), dtype=dtypes[0], name=index_name)
+    return pd.DataFrame({column:pd.Series(values, index=index, dtype=dtype, copy=False)
+                         for (column, values), dtype in zip(data.items(), dtypes[1:])}, copy=False)
+
+def read_compiled(source:str, read_csv:Callable[[str], pd.DataFrame], rebuild:bool=False) -> pd.DataFrame:
+    """キャッシュがあれば読み込み、無いか古ければCSVを解析してキャッシュを作成する
+
+    Args:
+        source (str): 元のCSVのパス
+        read_csv (Callable[[str], pd.DataFrame]): CSVを解析する処理(元のCSVのパスを受け取る)
+        rebuild (bool, optional): キャッシュがあっても作り直す. Defaults to False.
+
+    Returns:
+        pd.DataFrame: 解析したデータフレーム
+    """
+    logger = getLogger("Log").getChild("read_compiled")
+    if not rebuild:
+        try:
+            df = load_compiled(source)
+        except Exception as e:
+            logger.warning(f"Fault load {cache_path(source)} : {e}")
+            df = None
+        if df is not None:
+            logger.debug(f"Load {cache_path(source)}")
+            return df
+    df = read_csv(source)
+    try:
+        filename = save_compiled(df, source)
+        logger.info(f"Compile {source} -> {filename}")
+    except OSError as e:
+        # 書き込めない場合もCSVの内容で続ける
+        logger.warning(f"Fault compile {source} : {e}")
+    return df
@@ -0,0 +1,140 @@
+"""
+OCRの誤認識を考慮したポケモン名の照合
+
+normalize_name : 全角半角(NFKC)、ひらがな→カタカナ、小書き文字→通常の文字、カタカナと形の似た漢字→カタカナ、記号の削除
+weighted_distance : 誤認識しやすい文字の組み合わせの置換を安くした編集距離
+learn_confusions : ログの「Found name: X -> Y」(OCRの結果→照合したポケモン名)から文字の誤認識の回数を数える
+"""
+
+import os, sys
+import re
+import unicodedata
+from logging import getLogger
+
+import Levenshtein
+import pandas as pd
+
+# OCRの結果から削除する記号(mylib.ocr.OcrRunner.normalize_textと同じ)
+symbol_pattern = re.compile('[!"#$%&\'\\\\()*+,-./:;<=>?@[\\]^_`{|}~「」〔〕“”〈〉『』【】＆＊・（）＄＃＠。、？！｀＋￥％ 　]')
+
+# ひらがな→カタカナ、小書き文字→通常の文字、カタカナと形の似た文字→カタカナ
+name_table = str.maketrans(
+    {chr(code):chr(code + 0x60) for code in range(ord("ぁ"), ord("ゖ") + 1)} |
+    dict(zip("ァィゥェォッャュョヮヵヶ", "アイウエオツヤユヨワカケ")) |
+    dict(zip("一口力工夕卜二八才千―‐−~", "ーロカエタトニハオチーーーー")))
+
+# 誤認識しやすい文字の組み合わせの置換のコストの下限(学習した回数が多くても0にはしない)
+min_cost:float = 0.1
+
+def normalize_name(text:str) -> str:
+    """ポケモン名を照合用に正規化する
+
+    Args:
+        text (str): OCRの結果またはポケモン名
+
+    Returns:
+        str: 正規化した文字列
+    """
+    return symbol_pattern.sub("", unicodedata.normalize("NFKC", text)).translate(name_table)
+
+def weighted_distance(read:str, correct:str, costs:dict[str, dict[str, float]], limit:float=None) -> float:
+    """誤認識のコストを使った編集距離
+
+    Args:
+        read (str): OCRの結果(正規化済み)
+        correct (str): ポケモン名(正規化済み)
+        costs (dict[str, dict[str, float]]): 読んだ文字→正しい文字→置換のコスト(load_confusion_costsの結果)
+            余分な文字は正しい文字を""、読めなかった文字は読んだ文字を"". 無い組み合わせは1
+        limit (float, optional): これを超えることが分かった時点で打ち切る. Defaults to None(打ち切らない).
+
+    Returns:
+        float: 編集距離. 打ち切った場合はlimitより大きい値
+    """
+    insert_costs = costs.get("", {})
+    # 使われ得る組み合わせ(読んだ文字の削除、読んだ文字→正しい文字、正しい文字の挿入)が表に無ければ、
+    # 全てのコストが1の編集距離と同じ
+    correct_chars = set(correct)
+    if not any(char in insert_costs for char in correct_chars) and not any(
+            "" in costs[char] or not correct_chars.isdisjoint(costs[char]) for char in read if char in costs):
+        return float(Levenshtein.distance(read, correct))
+    insert_list = [insert_costs.get(char, 1.0) for char in correct]
+    previous = [0.0]
+    for cost in insert_list:
+        previous.append(previous[-1] + cost)
+    for read_char in read:
+        substitute_costs = costs.get(read_char, {})
+        delete_cost = substitute_costs.get("", 1.0)
+        current = [previous[0] + delete_cost]
+        for j, char in enumerate(correct):
+            substitute = previous[j] if read_char == char else previous[j] + substitute_costs.get(char, 1.0)
+            current.append(min(substitute, previous[j + 1] + delete_cost, current[j] + insert_list[j]))
+        # コストは負にならないため、行の最小値は最終的な距離の下限
+        if limit is not None and min(current) > limit:
+            return min(current)
+        previous = current
+    return previous[-1]
+
+def load_confusion_costs(filename:str) -> dict[str, dict[str, float]]:
+    """誤認識のコストの表を読み込む
+
+    Args:
+        filename (str): Read,Correct,Count,Costの列のCSV
+
+    Returns:
+        dict[str, dict[str, float]]: 読んだ文字→正しい文字→置換のコスト. ファイルが無い場合は空
+    """
+    if not os.path.exists(filename):
+        return {}
+    confusion_df = pd.read_csv(filename, dtype={"Read":"str","Correct":"str","Count":"int","Cost":"float"},
+                               encoding="utf-8", keep_default_na=False)
+    costs:dict[str, dict[str, float]] = {}
+    for read, correct, cost in zip(confusion_df["Read"], confusion_df["Correct"], confusion_df["Cost"]):
+        costs.setdefault(read, {})[correct] = max(min_cost, cost)
+    return costs
+
+def learn_confusions(lines:list[str], prior:int=2) -> pd.DataFrame:
+    """ログの「Found name: X -> Y」から文字の誤認識の回数とコストを求める
+    コストは1 - (XのaをYのbと照合した回数 / (Xにaが現れた回数 + prior))
+
+    Args:
+        lines (list[str]): ログの行
+        prior (int, optional): 回数が少ない組み合わせのコストを1に近づける値. Defaults to 2.
+
+    Returns:
+        pd.DataFrame: Read,Correct,Count,Costの列の表(回数の多い順)
+    """
+    logger = getLogger("Log").getChild("learn_confusions")
+    pattern = re.compile(r"Found name: (.*?) -> (.*?)\s*$")
+    pairs:dict[tuple[str, str], int] = {}
+    occurrences:dict[str, int] = {}
+    matched = 0
+    for line in lines:
+        match = pattern.search(line)
+        if match is None:
+            continue
+        read, correct = normalize_name(match.group(1)), normalize_name(match.group(2))
+        matched += 1
+        for tag, read_start, read_end, correct_start, correct_end in Levenshtein.opcodes(read, correct):
+            read_part, correct_part = read[read_start:read_end], correct[correct_start:correct_end]
+            for char in read_part:
+                occurrences[char] = occurrences.get(char, 0) + 1
+            if tag == "equal":
+                continue
+            if tag == "replace":
+                # 長さが違う場合、余った文字は挿入・削除として数える
+                charpairs = list(zip(read_part, correct_part))
+                charpairs += [(char, "") for char in read_part[len(correct_part):]]
+                charpairs += [("", char) for char in correct_part[len(read_part):]]
+            elif tag == "delete":
+                charpairs = [(char, "") for char in read_part]
+            else:
+                charpairs = [("", char) for char in correct_part]
+            for charpair in charpairs:
+                pairs[charpair] = pairs.get(charpair, 0) + 1
+    logger.info(f"Learn confusions : {matched} names, {len(pairs)} pairs")
+
+    rows = []
+    for (read, correct), count in sorted(pairs.items(), key=lambda item: -item[1]):
+        total = occurrences.get(read, count) if read else matched
+        rows.append([read, correct, count, round(max(min_cost, 1 - count / (total + prior)), 3)])
+    return pd.DataFrame(rows, columns=["Read","Correct","Count","Cost"])
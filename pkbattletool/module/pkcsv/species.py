@@ -0,0 +1,74 @@
+"""
+図鑑データの1行(ポケモン1匹分)のレコード
+
+GUIの表示や認識結果の反映のたびにpandasのSeriesを作るとインデックスの処理が重いため、
+読み込み時に全ての行をレコードにしておき、識別キーから辞書で引く
+record["Name"]のように、これまでのSeriesと同じ書き方で参照できる
+"""
+
+import pandas as pd
+
+class SpeciesRecord:
+    # 図鑑データの列(Keyはデータフレームのインデックス)
+    __slots__ = ("Key","Index","Name","Form","Type1","Type2","Ability1","Ability2","HAbility",
+                 "HP","Atk","Def","SpA","SpD","Spe","Tot","Hash")
+    stat_columns = ("HP","Atk","Def","SpA","SpD","Spe")
+
+    def __init__(self, *values):
+        """
+        図鑑データの1行(欠損値はNone)
+
+        Arg:
+            values : __slots__の順の値
+        """
+        (self.Key, self.Index, self.Name, self.Form, self.Type1, self.Type2, self.Ability1, self.Ability2, self.HAbility,
+         self.HP, self.Atk, self.Def, self.SpA, self.SpD, self.Spe, self.Tot, self.Hash) = values
+
+    def __getitem__(self, column:str):
+        try:
+            return getattr(self, column)
+        except AttributeError:
+            raise KeyError(column) from None
+
+    def __repr__(self) -> str:
+        return f"SpeciesRecord({self.Key}, {self.Name}, {self.Form})"
+
+    def get(self, column:str, default=None):
+        return getattr(self, column, default)
+
+    def stats(self) -> dict[str, int]:
+        """
+        種族値(HPからSpeまで)
+
+        Return:
+            dict[str, int] : 列名→種族値
+        """
+        return {column:getattr(self, column) for column in self.stat_columns}
+
+    def to_series(self) -> pd.Series:
+        """
+        pandasのSeriesに変換する(出力・グラフ用)
+
+        Return:
+            series : 図鑑データの1行(名前は識別キー)
+        """
+        return pd.Series({column:getattr(self, column) for column in self.__slots__[1:]}, name=self.Key, dtype=object)
+
+def build_records(pokemon_df:pd.DataFrame) -> list[SpeciesRecord]:
+    """
+    図鑑のデータフレームの全ての行をレコードにする
+
+    Arg:
+        pokemon_df[DataFrame] : 図鑑のデータフレーム(インデックスは識別キー)
+    Return:
+        list[SpeciesRecord] : データフレームの行の順のレコード
+    """
+    columns = []
+    for column in SpeciesRecord.__slots__:
+        values = pokemon_df.index if column == "Key" else pokemon_df[column]
+        if values.dtype.kind in "iub":
+            columns.append(values.tolist())
+        else:
+            # 文字列の列の欠損値(NaN)はNoneにそろえる(NaNは自身と等しくない)
+            columns.append([None if value != value else value for value in values.tolist()])
+    return [SpeciesRecord(*values) for values in zip(*columns)]
@@ -0,0 +1,269 @@
+import os, sys
+import json
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from logging import getLogger
+
+from module import config, pkcsv
+
+class PkGallery:
+    def __init__(self):
+        """
+        ポケモンアイコンのdHash値(参照画像)を識別キーごとに複数保持する
+        参照画像ごとに登録日時、元画像、認識に使われた回数を記録する
+        候補の並べ直しに使うpHash値と色ヒストグラムも保持する(無い参照画像は空文字)
+        参照画像の追加はCSVを書き直さず、追記のみの変更履歴(JSONL)に1行ずつ書き、
+        一定の数がたまったら(または保存時に)CSVへまとめて書き込む(compact)
+        """
+        self.logger = getLogger("Log").getChild("PkGallery")
+        self.logger.debug("Hello PkGallery")
+
+        # csvデータファイル
+        self.filename = f"resources/hash_gallery.csv"
+        self.journal_filename = f"resources/hash_gallery.journal.jsonl" # CSVに書き込んでいない追加の変更履歴
+        self.columns = ["Key","Hash","Date","Source","Hits","Phash","Hist"]
+        self.compact_count = int(config.get("DEFAULT","gallery_compact_count",fallback="100")) # 変更履歴がこの数になったらCSVに書き込む
+
+        self.gallery_df:pd.DataFrame = None
+        self.hits:np.ndarray = None # 認識に使われた回数(認識のたびに更新するため、書き込み時にHits列へ反映する)
+        self.lock = threading.Lock()
+        self.file_lock = threading.RLock() # 変更履歴の追記とCSVへの書き込みを同時に行わない
+        self.version:int = 0 # 参照画像を追加するたびに増やす(検索用の一覧の更新判定に使う)
+        self.base_version:int = 0 # 参照画像を削除・置き換えたバージョン(これより前の一覧は追加分のみでは更新できない)
+        self.is_dirty:bool = False # 保存していない変更がある
+        self.journal_count:int = 0 # CSVに書き込んでいない変更履歴の数
+
+        # csvの読み込み
+        self.RoadCSV()
+        self.RoadJournal()
+
+    def RoadCSV(self):
+        """
+        CSVをロード
+        ファイルが無い場合は、図鑑データのHash列から作成する
+        """
+        if os.path.exists(self.filename):
+            self.gallery_df = pd.read_csv(self.filename, dtype={
+                "Key":"object","Hash":"str","Date":"str","Source":"str","Hits":"int","Phash":"str","Hist":"str"},
+                encoding="utf-8", keep_default_na=False)
+            # 特徴量の列が無い古いファイルは空文字で補う
+            for column in self.columns:
+                if column not in self.gallery_df.columns:
+                    self.gallery_df[column] = ""
+            self.logger.debug(f"Load {self.filename} : {len(self.gallery_df)} hashes")
+        else:
+            hash_df = pkcsv.get_df().dropna(subset=["Hash"])
+            self.gallery_df = pd.DataFrame({
+                "Key":hash_df.index.astype(str),
+                "Hash":hash_df["Hash"].values,
+                "Date":"",
+                "Source":os.path.basename(pkcsv._util.filename),
+                "Hits":0,
+                "Phash":"",
+                "Hist":""}, columns=self.columns)
+            self.WriteCSV()
+            self.logger.info(f"Create {self.filename} from {pkcsv._util.filename} : {len(self.gallery_df)} hashes")
+        self.hits = self.gallery_df["Hits"].to_numpy(dtype=np.int64, copy=True)
+
+    def RoadJournal(self):
+        """
+        変更履歴を読み込み、CSVに書き込まれていない参照画像を追加する
+        書き込み途中で終了した行など、読めない行以降は捨て、CSVに書き込んで変更履歴を空にする
+        """
+        if not os.path.exists(self.filename) or not os.path.exists(self.journal_filename):
+            return
+        logger = self.logger.getChild("RoadJournal")
+        rowlist, is_broken = [], False
+        with open(self.journal_filename, mode="r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                    sample_id = int(entry["Id"])
+                    row = [str(entry["Key"]), entry["Hash"], entry["Date"], entry["Source"], 0, entry["Phash"], entry["Hist"]]
+                except (ValueError, KeyError, TypeError):
+                    is_broken = True
+                    break
+                # CSVへの書き込み後、変更履歴を空にする前に終了した場合は、書き込み済みの行が残っている
+                if sample_id < len(self.gallery_df) + len(rowlist):
+                    continue
+                if sample_id != len(self.gallery_df) + len(rowlist):
+                    is_broken = True
+                    break
+                rowlist.append(row)
+        if len(rowlist) > 0:
+            start = len(self.gallery_df)
+            rows = pd.DataFrame(rowlist, columns=self.columns, index=range(start, start + len(rowlist)))
+            self.gallery_df = pd.concat([self.gallery_df, rows])
+            self.hits = np.append(self.hits, np.zeros(len(rowlist), dtype=np.int64))
+        self.journal_count = len(rowlist)
+        logger.info(f"Load {self.journal_filename} : {len(rowlist)} hashes")
+        if is_broken:
+            logger.warning(f"Broken {self.journal_filename} after {len(self.gallery_df)} hashes")
+            self.WriteCSV()
+
+    def WriteCSV(self):
+        """
+        CSVに書き込む(書き込み途中で終了しても壊れないよう、一時ファイルを置き換える)
+        書き込んだ参照画像の変更履歴は空にする
+        """
+        with self.file_lock:
+            with self.lock:
+                gallery_df = self.gallery_df.copy()
+                if self.hits is not None:
+                    gallery_df["Hits"] = self.hits
+                self.is_dirty = False
+            tmp_filename = f"{self.filename}.tmp"
+            gallery_df.to_csv(tmp_filename, mode="w", encoding="utf-8", index=False)
+            os.replace(tmp_filename, self.filename)
+            if os.path.exists(self.journal_filename):
+                os.remove(self.journal_filename)
+            self.journal_count = 0
+
+    def AppendJournal(self, rows:pd.DataFrame):
+        """
+        追加した参照画像を変更履歴に追記する(CSVは書き直さない)
+        変更履歴が一定の数になったらCSVに書き込む
+
+        Arg:
+            rows[DataFrame] : 追加した参照画像の行(インデックスは参照画像の番号)
+        """
+        with self.file_lock:
+            lines = [json.dumps({"Id":int(sample_id), "Key":key, "Hash":dhash, "Date":date, "Source":source, "Phash":phash, "Hist":hist},
+                                ensure_ascii=False) + "\n"
+                     for sample_id, key, dhash, date, source, phash, hist in zip(
+                         rows.index, rows["Key"], rows["Hash"], rows["Date"], rows["Source"], rows["Phash"], rows["Hist"])]
+            with open(self.journal_filename, mode="a", encoding="utf-8") as journal:
+                journal.writelines(lines)
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.journal_count += len(lines)
+            if self.journal_count >= self.compact_count:
+                self.WriteCSV()
+
+    def get_updates(self, version:int, count:int) -> tuple[int, pd.DataFrame]:
+        """
+        読み込み側が持つ一覧から追加された参照画像を取得する
+
+        Arg:
+            version[int] : 読み込み側の一覧のバージョン
+            count[int] : 読み込み側の一覧の参照画像の数
+        Return:
+            int : 現在のバージョン
+            dataframe : 追加された参照画像の行. 追加分のみで更新できない場合(削除・置き換え)はNone
+        """
+        with self.lock:
+            if version < self.base_version or count > len(self.gallery_df):
+                return self.version, None
+            return self.version, self.gallery_df.iloc[count:]
+
+    def add_sample(self, key:str, dhash:str, source:str, phash:str="", hist:str="") -> int:
+        """
+        参照画像のdHash値を追加する
+
+        Arg:
+            key[str] : ポケモンの識別キー
+            dhash[str] : dHash値
+            source[str] : 元画像
+            phash[str] : pHash値(無い場合は空文字)
+            hist[str] : 色ヒストグラム(無い場合は空文字)
+        Return:
+            int : 追加した参照画像の番号
+        """
+        return self.add_samples([(key, dhash, source, phash, hist)])[0]
+
+    def add_samples(self, samplelist:list[tuple[str, str, str, str, str]], replace:bool=False) -> list[int]:
+        """
+        複数の参照画像をまとめて追加する(変更履歴への追記は1回. 置き換える場合はCSVに書き込む)
+
+        Arg:
+            samplelist[list[tuple[str, str, str, str, str]]] : (識別キー、dHash値、元画像、pHash値、色ヒストグラム)のリスト
+            replace[bool] : 既存の参照画像を全て置き換える
+        Return:
+            list[int] : 追加した参照画像の番号のリスト
+        """
+        date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.file_lock:
+            with self.lock:
+                if replace:
+                    self.gallery_df = self.gallery_df.iloc[0:0]
+                    self.hits = np.empty(0, dtype=np.int64)
+                start = len(self.gallery_df)
+                sample_ids = list(range(start, start + len(samplelist)))
+                rows = pd.DataFrame([[str(key), dhash, date, source or "", 0, phash or "", hist or ""]
+                                     for key, dhash, source, phash, hist in samplelist], columns=self.columns, index=sample_ids)
+                self.gallery_df = pd.concat([self.gallery_df, rows])
+                self.hits = np.append(self.hits, np.zeros(len(samplelist), dtype=np.int64))
+                self.version += 1
+                if replace:
+                    self.base_version = self.version
+            if replace:
+                self.WriteCSV()
+            else:
+                self.AppendJournal(rows)
+        if len(samplelist) == 1:
+            self.logger.getChild("add_sample").info(f"Add hash {samplelist[0][0]} ({samplelist[0][2]}) : {sample_ids[0]}")
+        else:
+            self.logger.getChild("add_samples").info(f"Add {len(samplelist)} hashes (replace={replace}) : {len(self.gallery_df)} hashes")
+        return sample_ids
+
+    def add_hits(self, sample_ids:list[int]):
+        """
+        認識に使われた参照画像の回数を増やす(保存はsaveで行う)
+
+        Arg:
+            sample_ids[list[int]] : 参照画像の番号のリスト
+        """
+        with self.lock:
+            np.add.at(self.hits, sample_ids, 1)
+            self.is_dirty = True
+
+    def save(self):
+        """
+        保存していない変更(認識回数、変更履歴)があればCSVに書き込む
+        """
+        if self.is_dirty or self.journal_count > 0:
+            self.WriteCSV()
+
+
+_instance:PkGallery = None
+_instance_lock = threading.Lock()
+
+def _get_util() -> PkGallery:
+    """
+    初回に呼ばれたときに読み込む(importしただけでは読み込まない)
+    """
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                _instance = PkGallery()
+    return _instance
+
+def __getattr__(name):
+    # pkgallery._utilは初回の参照で読み込む
+    if name == "_util":
+        return _get_util()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def get_df():
+    return _get_util().gallery_df
+
+def get_version():
+    return _get_util().version
+
+def get_updates(version, count):
+    return _get_util().get_updates(version, count)
+
+def add_sample(key, dhash, source=None, phash="", hist=""):
+    return _get_util().add_sample(key, dhash, source, phash, hist)
+
+def add_samples(samplelist, replace=False):
+    return _get_util().add_samples(samplelist, replace)
+
+def add_hits(sample_ids):
+    _get_util().add_hits(sample_ids)
+
+def save():
+    _get_util().save()
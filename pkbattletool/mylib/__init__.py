@@ -1,7 +1,11 @@
 # mylib/__init__.py
 from .ocr import *
+from .ocr_engine import *
 from .pkhash import *
 from .searchpbdb import *
 from .webcam_capture import *
+from .frame_source import *
+from .image_writer import *
 from .pktype import *
-from .imgforge import *
\ No newline at end of file
+from .imgforge import *
+from .region_history import *
\ No newline at end of file
@@ -0,0 +1,283 @@
+"""
+CameraCaptureにフレームを供給するソースをまとめたモジュール
+
+CameraSource:キャプチャボード(カメラ)からフレームを取得する
+VideoFileSource:録画した動画ファイルからフレームを取得する
+ImageDirectorySource:スクリーンショットのフォルダから画像を順番に取得する
+SyntheticSource:テスト用の画像を生成する
+
+いずれもcv2.VideoCaptureと同じread/get/set/isOpened/releaseを持つ
+realtime=Trueの場合は元のfpsに合わせて供給し、Falseの場合は可能な限り速く供給する
+"""
+
+import os, sys
+import glob
+import time
+from abc import ABC, abstractmethod
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+class FrameSource(ABC):
+    def __init__(self, fps:float=30.0, realtime:bool=True) -> None:
+        """フレーム供給元の基底クラス
+
+        Args:
+            fps (float, optional): 供給するフレームレート. Defaults to 30.0.
+            realtime (bool, optional): fpsに合わせて供給する→True, 待たずに供給する→False. Defaults to True.
+        """
+        self.logger = getLogger("Log").getChild(self.__class__.__name__)
+        self.logger.info(f"Called {self.__class__.__name__}")
+
+        self.fps:float = fps if fps and fps > 0 else 30.0
+        self.realtime:bool = realtime
+        self.width:int = 0
+        self.height:int = 0
+
+        self.is_opened:bool = True
+        self.frame_count:int = 0 # 供給したフレーム数
+        self.start_time:float = None # 最初のフレームを供給した時刻
+
+    @abstractmethod
+    def read_frame(self) -> tuple[bool, np.ndarray]:
+        """フレームを1枚取得する(派生クラスで実装)
+
+        Returns:
+            tuple[bool, np.ndarray]: 取得の成否、フレーム
+        """
+
+    def wait_interval(self) -> None:
+        """
+        fpsに合わせて次のフレームの供給時刻まで待つ
+        """
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+            return
+        # 累積時刻で待つことで、処理時間による遅れを蓄積させない
+        delay = self.start_time + self.frame_count / self.fps - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self) -> tuple[bool, np.ndarray]:
+        """フレームを取得する
+
+        Returns:
+            tuple[bool, np.ndarray]: 取得の成否、フレーム
+        """
+        if not self.is_opened:
+            return False, None
+        ret, frame = self.read_frame()
+        if ret:
+            if self.realtime:
+                self.wait_interval()
+            self.frame_count += 1
+        return ret, frame
+
+    def get(self, prop_id:int) -> float:
+        """プロパティの取得
+
+        Args:
+            prop_id (int): cv2.CAP_PROP_*
+
+        Returns:
+            float: プロパティの値. 対応していない場合は0
+        """
+        if prop_id == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop_id == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop_id == cv2.CAP_PROP_FPS:
+            return float(self.fps)
+        return 0.0
+
+    def set(self, prop_id:int, value:float) -> bool:
+        """プロパティの設定(ファイル系のソースでは変更できない)
+
+        Args:
+            prop_id (int): cv2.CAP_PROP_*
+            value (float): 設定値
+
+        Returns:
+            bool: 設定できた→True
+        """
+        return False
+
+    def isOpened(self) -> bool:
+        return self.is_opened
+
+    def release(self) -> None:
+        self.logger.getChild("release").info("Run release")
+        self.is_opened = False
+
+class CameraSource(FrameSource):
+    def __init__(self, camera_id:int) -> None:
+        """キャプチャボード(カメラ)のフレーム供給元
+        読み込みがカメラのフレームレートで待つため、ペース調整はしない
+
+        Args:
+            camera_id (int): カメラID
+        """
+        super().__init__(realtime=False)
+        self.camera_id = camera_id
+        self.vid = cv2.VideoCapture(camera_id)
+
+    def read_frame(self) -> tuple[bool, np.ndarray]:
+        return self.vid.read()
+
+    def get(self, prop_id:int) -> float:
+        return self.vid.get(prop_id)
+
+    def set(self, prop_id:int, value:float) -> bool:
+        return self.vid.set(prop_id, value)
+
+    def isOpened(self) -> bool:
+        return self.vid.isOpened()
+
+    def release(self) -> None:
+        super().release()
+        if self.vid.isOpened():
+            self.vid.release()
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path:str, realtime:bool=True, loop:bool=True) -> None:
+        """録画した動画ファイルのフレーム供給元
+
+        Args:
+            path (str): 動画ファイルのパス
+            realtime (bool, optional): 動画のfpsに合わせて供給する. Defaults to True.
+            loop (bool, optional): 最後まで再生したら先頭に戻る. Defaults to True.
+        """
+        self.vid = cv2.VideoCapture(path)
+        super().__init__(fps=self.vid.get(cv2.CAP_PROP_FPS), realtime=realtime)
+        self.path = path
+        self.loop = loop
+        self.width = int(self.vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.height = int(self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.is_opened = self.vid.isOpened()
+        self.logger.info(f"Open {path} : w{self.width} x h{self.height} / {self.fps:.2f}fps")
+
+    def read_frame(self) -> tuple[bool, np.ndarray]:
+        ret, frame = self.vid.read()
+        if not ret and self.loop:
+            self.logger.getChild("read_frame").debug("Rewind video")
+            self.vid.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.vid.read()
+        if not ret:
+            self.logger.getChild("read_frame").info("End of video")
+            self.is_opened = False
+        return ret, frame
+
+    def release(self) -> None:
+        super().release()
+        if self.vid.isOpened():
+            self.vid.release()
+
+class ImageDirectorySource(FrameSource):
+    def __init__(self, path:str, fps:float=30.0, realtime:bool=True, loop:bool=True) -> None:
+        """フォルダ内の画像(screenshot/battleteamなど)を名前順に供給する
+        最初に読み込めた画像とサイズが異なる画像はリサイズして揃える(先頭の読み込めない画像は除く)
+
+        Args:
+            path (str): 画像フォルダのパス
+            fps (float, optional): 供給するフレームレート. Defaults to 30.0.
+            realtime (bool, optional): fpsに合わせて供給する. Defaults to True.
+            loop (bool, optional): 最後の画像まで供給したら先頭に戻る. Defaults to True.
+        """
+        super().__init__(fps=fps, realtime=realtime)
+        self.path = path
+        self.loop = loop
+        self.filelist:list[str] = sorted(
+            file for ext in ("png", "jpg", "jpeg", "bmp", "webp")
+            for file in glob.glob(os.path.join(path, f"*.{ext}")))
+        self.index:int = 0
+
+        if len(self.filelist) == 0:
+            self.logger.error(f"Not found image in {path}")
+            self.is_opened = False
+            return
+        # 読み込める画像が見つかるまで飛ばす
+        first_frame = None
+        while len(self.filelist) > 0:
+            first_frame = cv2.imread(self.filelist[0])
+            if first_frame is not None:
+                break
+            self.logger.error(f"Fault imread {self.filelist.pop(0)}")
+        if first_frame is None:
+            self.logger.error(f"Not found readable image in {path}")
+            self.is_opened = False
+            return
+        self.height, self.width = first_frame.shape[:2]
+        self.logger.info(f"Open {path} : {len(self.filelist)} images, w{self.width} x h{self.height}")
+
+    def read_frame(self) -> tuple[bool, np.ndarray]:
+        if self.index >= len(self.filelist):
+            if not self.loop:
+                self.logger.getChild("read_frame").info("End of images")
+                self.is_opened = False
+                return False, None
+            self.index = 0
+        frame = cv2.imread(self.filelist[self.index])
+        self.index += 1
+        if frame is None:
+            self.logger.getChild("read_frame").error(f"Fault imread {self.filelist[self.index-1]}")
+            return False, None
+        if frame.shape[:2] != (self.height, self.width):
+            frame = cv2.resize(frame, (self.width, self.height))
+        return True, frame
+
+class SyntheticSource(FrameSource):
+    def __init__(self, width:int=1920, height:int=1080, fps:float=30.0, realtime:bool=True,
+                 frame_limit:int=None, static:bool=False) -> None:
+        """テスト用の画像を生成する
+        画面内を横切る帯と、フレーム番号のテキストを描画する
+
+        Args:
+            width (int, optional): 横幅. Defaults to 1920.
+            height (int, optional): 縦幅. Defaults to 1080.
+            fps (float, optional): 供給するフレームレート. Defaults to 30.0.
+            realtime (bool, optional): fpsに合わせて供給する. Defaults to True.
+            frame_limit (int, optional): 生成するフレーム数の上限. Defaults to None(無制限).
+            static (bool, optional): 毎回同じ画像を生成する(静止画面の再現). Defaults to False.
+        """
+        super().__init__(fps=fps, realtime=realtime)
+        self.width = width
+        self.height = height
+        self.frame_limit = frame_limit
+        self.static = static
+        self.background = np.full((height, width, 3), 64, dtype=np.uint8)
+
+    def read_frame(self) -> tuple[bool, np.ndarray]:
+        if self.frame_limit is not None and self.frame_count >= self.frame_limit:
+            self.is_opened = False
+            return False, None
+        frame = self.background.copy()
+        if not self.static:
+            x = int(self.frame_count * 8 % self.width)
+            frame[:, x:x+16] = 255
+            cv2.putText(frame, f"{self.frame_count}", (50, 100),
+                        cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 255, 255), 3)
+        return True, frame
+
+def create_frame_source(kind:str, camera_id:int=0, path:str="", fps:float=30.0, realtime:bool=True) -> FrameSource:
+    """種類を指定してフレーム供給元を作成する
+
+    Args:
+        kind (str): camera / video / images / synthetic
+        camera_id (int, optional): カメラID(camera). Defaults to 0.
+        path (str, optional): 動画ファイルまたは画像フォルダのパス(video, images). Defaults to "".
+        fps (float, optional): 供給するフレームレート(images, synthetic). Defaults to 30.0.
+        realtime (bool, optional): fpsに合わせて供給する(video, images, synthetic). Defaults to True.
+
+    Returns:
+        FrameSource: フレーム供給元
+    """
+    if kind == "camera":
+        return CameraSource(camera_id)
+    if kind == "video":
+        return VideoFileSource(path, realtime=realtime)
+    if kind == "images":
+        return ImageDirectorySource(path, fps=fps, realtime=realtime)
+    if kind == "synthetic":
+        return SyntheticSource(fps=fps, realtime=realtime)
+    raise ValueError(f"Unknown frame source : {kind}")
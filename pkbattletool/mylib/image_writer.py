@@ -0,0 +1,179 @@
+"""
+スクリーンショットやアイコン画像をバックグラウンドで保存する処理
+
+保存要求はキューに積み、専用スレッドで書き出すため、画面描画や認識処理を止めない
+"""
+
+import os, sys
+import queue
+import threading
+from logging import getLogger
+
+import cv2
+import numpy as np
+
+from module import config
+
+class ImageWriter:
+    # 保存形式ごとの拡張子
+    extensions = {"png":"png", "jpg":"jpg", "webp":"webp", "npy":"npy"}
+
+    def __init__(self, image_format:str=None, queue_size:int=None, policy:str=None) -> None:
+        """画像の保存キュー
+
+        Args:
+            image_format (str, optional): 保存形式(png / jpg / webp / npy). Defaults to None(config.iniの設定).
+            queue_size (int, optional): キューに積める保存要求の数. Defaults to None(config.iniの設定).
+            policy (str, optional): キューが一杯の時の動作(drop:破棄する / block:空くまで待つ). Defaults to None(config.iniの設定).
+        """
+        self.logger = getLogger("Log").getChild("ImageWriter")
+        self.logger.info("Called ImageWriter")
+
+        self.image_format:str = image_format or config.get("DEFAULT","image_format",fallback="png")
+        if self.image_format not in self.extensions:
+            self.logger.error(f"Unknown image_format : {self.image_format}")
+            self.image_format = "png"
+        self.png_compression:int = int(config.get("DEFAULT","image_png_compression",fallback="1"))
+        self.quality:int = int(config.get("DEFAULT","image_quality",fallback="90"))
+        self.policy:str = policy or config.get("DEFAULT","image_queue_policy",fallback="drop")
+        queue_size = queue_size or int(config.get("DEFAULT","image_queue_size",fallback="32"))
+
+        self.queue:queue.Queue = queue.Queue(maxsize=queue_size)
+        self.created_folders:set[str] = set() # 作成済み(確認済み)のフォルダ
+        self.drop_count:int = 0 # 破棄した保存要求の数
+
+        self.thread = threading.Thread(target=self.run_writer_thread, name="Thread ImageWriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def save(self, folder:str, name:str, frame:np.ndarray, image_format:str=None) -> bool:
+        """画像の保存を要求する
+
+        Args:
+            folder (str): 保存先フォルダ
+            name (str): ファイル名(拡張子なし)
+            frame (np.ndarray): 保存する画像
+            image_format (str, optional): 保存形式. Defaults to None(既定の保存形式).
+
+        Returns:
+            bool: 保存要求を受け付けた→True, 破棄した→False
+        """
+        return self.save_batch([(folder, name, frame)], image_format)
+
+    def save_batch(self, items:list[tuple[str, str, np.ndarray]], image_format:str=None) -> bool:
+        """複数の画像の保存をまとめて要求する
+
+        Args:
+            items (list[tuple[str, str, np.ndarray]]): (保存先フォルダ、ファイル名、画像)のリスト
+            image_format (str, optional): 保存形式. Defaults to None(既定の保存形式).
+
+        Returns:
+            bool: 保存要求を受け付けた→True, 破棄した→False
+        """
+        logger = self.logger.getChild("save_batch")
+        # 呼び出し元が画像を書き換えても影響しないようにコピーする
+        job = ([(folder, name, frame.copy()) for folder, name, frame in items if frame is not None],
+               image_format or self.image_format)
+        try:
+            if self.policy == "block":
+                self.queue.put(job)
+            else:
+                self.queue.put_nowait(job)
+        except queue.Full:
+            self.drop_count += 1
+            logger.warning(f"Drop save request ({len(items)} images, total {self.drop_count})")
+            return False
+        return True
+
+    def run_writer_thread(self) -> None:
+        """
+        キューに積まれた画像を順番に保存する
+        """
+        logger = self.logger.getChild("run_writer_thread")
+        logger.info("Run run_writer_thread")
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None: # 終了要求
+                    break
+                items, image_format = job
+                for folder, name, frame in items:
+                    self.write(folder, name, frame, image_format)
+            except Exception as e:
+                logger.error("Fault write image")
+                logger.exception(e)
+            finally:
+                self.queue.task_done()
+
+    def make_folder(self, folder:str) -> None:
+        """保存先フォルダを作成する(作成済みのフォルダは確認しない)
+
+        Args:
+            folder (str): 保存先フォルダ
+        """
+        if folder in self.created_folders:
+            return
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+            self.logger.getChild("make_folder").info(f"Success makedirs {folder}")
+        self.created_folders.add(folder)
+
+    def _write_file(self, path:str, frame:np.ndarray, image_format:str) -> bool:
+        """画像を形式に合わせてファイルに書き出す
+
+        Args:
+            path (str): 保存先のパス
+            frame (np.ndarray): 保存する画像
+            image_format (str): 保存形式
+
+        Returns:
+            bool: 保存できた→True
+        """
+        if image_format == "npy":
+            try:
+                np.save(path, frame)
+            except OSError:
+                return False
+            return True
+        if image_format == "jpg":
+            return cv2.imwrite(path, frame, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if image_format == "webp":
+            return cv2.imwrite(path, frame, [cv2.IMWRITE_WEBP_QUALITY, self.quality])
+        return cv2.imwrite(path, frame, [cv2.IMWRITE_PNG_COMPRESSION, self.png_compression])
+
+    def write(self, folder:str, name:str, frame:np.ndarray, image_format:str) -> None:
+        """画像をファイルに書き出す
+        cv2.imwriteは失敗しても例外を出さないため、戻り値を確認する
+
+        Args:
+            folder (str): 保存先フォルダ
+            name (str): ファイル名(拡張子なし)
+            frame (np.ndarray): 保存する画像
+            image_format (str): 保存形式
+        """
+        logger = self.logger.getChild("write")
+        self.make_folder(folder)
+        path = os.path.join(folder, f"{name}.{self.extensions[image_format]}")
+        if not self._write_file(path, frame, image_format):
+            # 起動中にフォルダが削除された場合に備えて、作り直してから1度だけ再試行する
+            self.created_folders.discard(folder)
+            os.makedirs(folder, exist_ok=True)
+            self.created_folders.add(folder)
+            if not self._write_file(path, frame, image_format):
+                logger.error(f"Fault write {path}")
+                return
+        logger.debug(f"Write {path}")
+
+    def flush(self) -> None:
+        """
+        キューに積まれた画像を全て保存するまで待つ
+        """
+        self.queue.join()
+
+    def close(self) -> None:
+        """
+        残りの画像を保存してスレッドを終了する
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.logger.info("Close ImageWriter")
@@ -1,11 +1,55 @@
 import os, sys
 import cv2
+import threading
 from logging import getLogger
 import numpy as np
 from .webcam_capture import CameraCapture
 
 PATH = os.path.dirname(os.path.abspath(sys.argv[0]))
 
+class RegionConsensus():
+    def __init__(self) -> None:
+        """領域ごとの共通部分(全フレームで白い画素)を逐次更新する
+        画素ごとに最後に黒(0)だったフレームの連番を保持し、
+        指定した連番以降の全フレームで白い画素をCameraFrameForge.diff_framesと同じ結果で返す
+        フレームの追加・取得ともに、参照するフレーム数によらず1回の画素演算で済む
+        """
+        self.lock = threading.Lock()
+        self.last_zero:np.ndarray = None # 画素ごとに最後に黒だったフレームの連番
+
+    def push(self, binary_frame:np.ndarray, seq:int) -> None:
+        """二値化したフレームを追加する
+
+        Args:
+            binary_frame (np.ndarray): 二値化したフレーム
+            seq (int): フレームの連番
+        """
+        with self.lock:
+            if self.last_zero is None or self.last_zero.shape != binary_frame.shape:
+                self.last_zero = np.full(binary_frame.shape, -1, dtype=np.int32)
+            np.putmask(self.last_zero, binary_frame == 0, seq)
+
+    def get_mask(self, first_seq:int) -> np.ndarray:
+        """指定した連番以降の全フレームで白い画素を抽出する
+
+        Args:
+            first_seq (int): 共通部分を求める最初のフレームの連番
+
+        Returns:
+            np.ndarray: 共通部分の画像. フレームが無い場合はNone
+        """
+        with self.lock:
+            if self.last_zero is None:
+                return None
+            return (self.last_zero < first_seq).view(np.uint8) * np.uint8(255)
+
+    def clear(self) -> None:
+        """
+        追加したフレームを破棄する
+        """
+        with self.lock:
+            self.last_zero = None
+
 class CameraFrameForge():
     def __init__(self,camera_capture:CameraCapture) -> None:
         """ゲーム画像の切抜き
@@ -71,11 +115,12 @@ class CameraFrameForge():
 
         return frame[top:bottom,left:right]
 
-    def cvt_bgr2gray(self, frame:np.ndarray) -> np.ndarray:
+    def cvt_bgr2gray(self, frame:np.ndarray, dst:np.ndarray=None) -> np.ndarray:
         """画像のグレースケール処理
 
         Args:
             frame (np.ndarray): 変換前画像
+            dst (np.ndarray, optional): 変換後画像の書込み先. Defaults to None(新しく確保する).
 
         Returns:
             np.ndarray: 変換後画像
@@ -83,21 +128,22 @@ class CameraFrameForge():
         
         logger = self.logger.getChild("cvt_bgr2gray")
         logger.debug("Run cvt_bgr2gray")
-        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=dst)
 
-    def cvt_gray2binaly(self, grayscale_frame: np.ndarray, option:str) -> np.ndarray:
+    def cvt_gray2binaly(self, grayscale_frame: np.ndarray, option:str, dst:np.ndarray=None) -> np.ndarray:
         """画像の二値化処理
 
         Args:
             grayscale_frame (np.ndarray): 変換前のグレースケール画像
             option (str): オプション
+            dst (np.ndarray, optional): 変換後画像の書込み先. Defaults to None(新しく確保する).
 
         Returns:
             np.ndarray: 変換後画像
         """
         logger = self.logger.getChild("cvt_gray2binaly")
         logger.debug("Run cvt_gray2binaly")
-        _, binaly_frame = cv2.threshold(grayscale_frame, self.options[option]["thresh"], 255, cv2.THRESH_BINARY)
+        _, binaly_frame = cv2.threshold(grayscale_frame, self.options[option]["thresh"], 255, cv2.THRESH_BINARY, dst=dst)
         return binaly_frame
     
     def diff_frames(self, frame_list:list[np.ndarray], option:str) -> np.ndarray:
@@ -113,14 +159,9 @@ class CameraFrameForge():
         logger = self.logger.getChild("diff_frames")
         logger.debug("Run diff_frames")
         
-        base_img = frame_list[0]
-        for image in frame_list[1:]:
-            # 画像の差分を計算
-            diff = cv2.absdiff(base_img, image)
-            # 共通部分のマスクを作成
-            _, mask = cv2.threshold(diff, self.options[option]["thresh"], 255, cv2.THRESH_BINARY_INV)
-            base_img = cv2.bitwise_and(base_img, base_img, mask=mask)
-        return base_img
+        # 二値化画像(0/255)同士では、差分のしきい値処理とマスク処理を順に重ねた結果は
+        # 全フレームの論理積と一致するため、まとめて計算する
+        return np.bitwise_and.reduce(np.stack(frame_list), axis=0)
     
     def save_frame(self, frame:np.ndarray, filename:str) -> None:
         """
@@ -8,18 +8,110 @@ import os, sys
 import cv2
 import numpy as np
 
-import pyocr
-from PIL import Image
-
 import threading
-import re
+import queue
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, Future
 from logging import getLogger
 
 import time
 
 from .imgforge import CameraFrameForge
 from .webcam_capture import CameraCapture
+from .region_history import RegionHistory
+from .ocr_engine import OcrEngine, create_ocr_engine
 from module import config
+from module.pkcsv.namematch import symbol_pattern # 記号の正規表現(呼び出しごとにコンパイルしない)
+
+class OcrResultCache:
+    def __init__(self, maxsize:int=128, tolerance:float=0.0):
+        """二値化画像をキーにしたOCR結果のキャッシュ(LRU)
+        画面に表示されたままのレベルや名前に対して、同じ画像でOCRを繰り返さないようにする
+
+        Args:
+            maxsize (int, optional): 保持する結果の数. Defaults to 128.
+            tolerance (float, optional): 同じ画像とみなす画素の不一致率(0で完全一致のみ). Defaults to 0.0.
+        """
+        self.logger = getLogger("Log").getChild("OcrResultCache")
+        self.logger.debug("Called OcrResultCache")
+
+        self.maxsize:int = maxsize
+        self.tolerance:float = tolerance
+        self.lock = threading.Lock()
+        # キー → (オプション、画像サイズ、ビット列に詰めた画像、テキスト)
+        self.entries:OrderedDict[bytes, tuple[str, tuple, np.ndarray, str]] = OrderedDict()
+
+        self.hits:int = 0 # 完全一致で見つかった回数
+        self.near_hits:int = 0 # 許容範囲内の画像で見つかった回数
+        self.misses:int = 0 # 見つからなかった回数
+
+    def make_key(self, frame:np.ndarray, option:str) -> bytes:
+        """画像とオプションからキーを作成する
+
+        Args:
+            frame (np.ndarray): 二値化画像
+            option (str): 認識オプション
+
+        Returns:
+            bytes: キー
+        """
+        digest = hashlib.blake2b(np.ascontiguousarray(frame).data, digest_size=16)
+        digest.update(f"{option}:{frame.shape}".encode())
+        return digest.digest()
+
+    def get(self, frame:np.ndarray, option:str) -> str:
+        """キャッシュからOCR結果を取得する
+
+        Args:
+            frame (np.ndarray): 二値化画像
+            option (str): 認識オプション
+
+        Returns:
+            str: 認識したテキスト. 見つからない場合はNone
+        """
+        key = self.make_key(frame, option)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][3]
+            if self.tolerance > 0:
+                # 同じオプション・サイズの画像と不一致の画素数を比較する
+                bits = np.packbits(frame != 0)
+                limit = self.tolerance * frame.size
+                for entry_key, (entry_option, shape, entry_bits, text) in reversed(self.entries.items()):
+                    if entry_option == option and shape == frame.shape and int(np.bitwise_count(bits ^ entry_bits).sum()) <= limit:
+                        self.entries.move_to_end(entry_key)
+                        self.near_hits += 1
+                        return text
+            self.misses += 1
+            return None
+
+    def put(self, frame:np.ndarray, option:str, text:str) -> None:
+        """OCR結果をキャッシュに登録する
+
+        Args:
+            frame (np.ndarray): 二値化画像
+            option (str): 認識オプション
+            text (str): 認識したテキスト
+        """
+        key = self.make_key(frame, option)
+        bits = np.packbits(frame != 0) if self.tolerance > 0 else None
+        with self.lock:
+            self.entries[key] = (option, frame.shape, bits, text)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        """キャッシュの利用状況
+
+        Returns:
+            dict: 件数とヒット数、ミス数
+        """
+        with self.lock:
+            return {"size":len(self.entries), "hits":self.hits, "near_hits":self.near_hits, "misses":self.misses}
 
 class OcrRunner:
     def __init__(self, camera_capture:CameraCapture):
@@ -40,12 +132,9 @@ class OcrRunner:
         if self.tesserac_path not in os.environ["PATH"].split(os.pathsep):
             os.environ["PATH"] += os.pathsep + self.tesserac_path
         
-        self.tools = pyocr.get_available_tools()
-        self.tool = self.tools[0]
-        
         self.frame = None
-        self.framelist = []
-        self.grayscale_framelist = []
+        self.framelist_size = 10 # マスク処理に使うフレーム枚数
+        self.framelist_max_age = 0.5 # マスク処理に使うフレームの経過時間の上限(秒)
 
 
         self.width = int(self.camera_capture.vid.get(cv2.CAP_PROP_FRAME_WIDTH))
@@ -72,6 +161,28 @@ class OcrRunner:
                 }
             }
 
+        # 領域ごとの履歴(OCR領域はグレースケール、パーティ画像はカラーで保持する)
+        self.region_history = RegionHistory(
+            self.frame_forge, gray_options=list(self.list_ocr_option), color_options=["pokemonbox"],
+            gray_size=self.framelist_size + 2, color_size=3)
+
+        # OCRエンジン(常駐させて使い回す)
+        langs = sorted({option["lang"] for option in self.list_ocr_option.values()}) # jpn / eng / jpn+eng
+        self.engine:OcrEngine = create_ocr_engine(
+            config.get("DEFAULT","ocr_backend",fallback="auto"), self.tesserac_path, langs)
+        if self.engine is None:
+            # Tesseractが無い環境でもキャプチャ処理は動かせるようにする
+            self.logger.error("Not found OCR engine")
+        else:
+            self.logger.info(f"Use OCR engine : {self.engine.name}")
+            # 言語データの読み込みで起動を待たせないよう、別スレッドで実行する
+            threading.Thread(target=self.engine.warmup, args=(langs,), name="Thread OCR Warmup", daemon=True).start()
+
+        # OCR結果のキャッシュ
+        self.ocr_cache = OcrResultCache(
+            maxsize=int(config.get("DEFAULT","ocr_cache_size",fallback="128")),
+            tolerance=float(config.get("DEFAULT","ocr_cache_tolerance",fallback="0.0")))
+
         self.text = None
 
         self.is_ocr_running = False
@@ -83,6 +194,9 @@ class OcrRunner:
         終了時の処理
         """
         self.stop_ocr_thread()
+        if self.engine is not None:
+            self.engine.close()
+        self.logger.info(f"OCR cache : {self.ocr_cache.stats()}")
         self.logger.info("Close OcrRunner")
         
     def start_ocr_thread(self) -> None:
@@ -104,8 +218,7 @@ class OcrRunner:
         self.logger.getChild("stop_ocr_thread").info("Run stop_ocr_thread")
         self.is_ocr_running = False
         
-        self.framelist = []
-        self.grayscale_framelist = []
+        self.region_history.clear()
     
 
     def get_frame(self) -> np.ndarray:
@@ -117,32 +230,37 @@ class OcrRunner:
         """
         return  self.camera_capture.get_frame()
     
-    def get_framelist(self) -> list[np.ndarray]:
-        """フレームリストの取得
+    def get_region_frame(self, option:str) -> np.ndarray:
+        """領域の最新の切抜き画像の取得
+
+        Args:
+            option (str): 領域のオプション(RegionHistoryで保持している領域)
 
         Returns:
-            list[np.ndarray]: カメラフレームが入ったリスト
+            np.ndarray: 切抜き画像(読み取り専用のビュー). 無い場合はNone
         """
-        self.logger.getChild("get_framelist").info("Run get_frame")
-        return self.framelist
+        self.logger.getChild("get_region_frame").debug(f"Run get_region_frame({option})")
+        return self.region_history.get_latest(option)
 
-    def get_grayscale_framelist(self) -> list[np.ndarray]:
+    def get_grayscale_framelist(self, option:str) -> list[np.ndarray]:
         """グレースケールフレームリストの取得
 
+        Args:
+            option (str): OCR領域のオプション
+
         Returns:
-            list[np.ndarray]: グレースケール変換されたフレームが入ったリスト
+            list[np.ndarray]: グレースケール変換されたOCR領域の画像が入ったリスト
         """
         self.logger.getChild("get_grayscale_framelist").info("Run get_grayscale_frame")
 
-        return self.grayscale_framelist
+        return [frame for _, _, frame in self.region_history.get_recent(option, self.framelist_size, self.framelist_max_age)]
 
     
-    # for文実施時に処理が重くなる(画面描画が止まる)
     def get_masked_frame(self, grayscale_framelist:list[np.ndarray],  option:str) -> np.ndarray:
         """画像の共通部分を抽出したフレームの取得
 
         Args:
-            grayscale_framelist (list[np.ndarray]): グレースケール変換されたフレームリスト
+            grayscale_framelist (list[np.ndarray]): グレースケール変換されたOCR領域の画像リスト
             option (str): 変換オプション
 
         Returns:
@@ -153,15 +271,27 @@ class OcrRunner:
         binary_framelist = []
         
         for grayscale_frame in grayscale_framelist:
-            crop_frame = self.frame_forge.crop_frame(grayscale_frame, option)
             # 二値化
-            binary_frame = self.frame_forge.cvt_gray2binaly(crop_frame, option)
+            binary_frame = self.frame_forge.cvt_gray2binaly(grayscale_frame, option)
             
             binary_framelist.append(binary_frame)
         # フレームの差を求める
         frame = self.frame_forge.diff_frames(binary_framelist, option)
         return frame
 
+    def get_consensus_frame(self, option:str) -> np.ndarray:
+        """直近のフレームリストの共通部分を抽出したフレームの取得
+        get_masked_frame(get_grayscale_framelist(option), option)と同じ結果を、逐次更新した共通部分から取得する
+
+        Args:
+            option (str): 変換オプション
+
+        Returns:
+            np.ndarray: マスク処理をした画像. フレームが無い場合はNone
+        """
+        self.logger.getChild("get_consensus_frame").debug(f"Run get_consensus_frame({option})")
+        return self.region_history.get_consensus(option, self.framelist_size, self.framelist_max_age)
+
     def run_ocr_thread(self) -> None:
         """
         OCRスレッドの開始処理
@@ -169,24 +299,25 @@ class OcrRunner:
         logger = self.logger.getChild("run_ocr_thread")
         
         logger.info("Run run_ocr_thread")
+        last_seq = -1 # 処理済みフレームの連番
+        frame_buffer = self.camera_capture.frame_buffer
         while self.is_ocr_running:
-            # 画像の取得と加工
-            frame = self.get_frame() # CameraCaptureからフレームの取得
-            if frame is None:
+            # 新しいフレームが届くまで待つ(重複フレームでは通知されない)
+            if not frame_buffer.wait_for_frame(last_seq, timeout=0.1):
                 logger.debug("Frame is None")
                 continue
-            # グレースケール変換
-            gratscale_frame = self.frame_forge.cvt_bgr2gray(frame)
-        
-            logger.debug("Append framelist")
-            self.framelist.append(frame)
-            self.grayscale_framelist.append(gratscale_frame)
-            
-            if len(self.framelist) > 10: # 規定以上の枚数になったら古いフレームから削除
-                self.framelist.pop(0)
-                self.grayscale_framelist.pop(0)
-            
-            time.sleep(0.01)
+            # 前回以降に取得されたフレームのみを処理する
+            entries = frame_buffer.get_since(last_seq)
+
+            for seq, timestamp, frame in entries:
+                # 変換中にキャプチャがスロットを上書きした場合は、崩れた画像を公開せずに破棄する
+                self.region_history.convert(frame)
+                if frame_buffer.is_valid(seq):
+                    logger.debug("Push region_history")
+                    self.region_history.publish(timestamp)
+                else:
+                    logger.debug(f"Discard overwritten frame({seq})")
+                last_seq = seq
 
     # 参考:https://qiita.com/ganyariya/items/42fc0ed3dcebecb6b117
     def normalize_text(self, text:str) -> str:
@@ -201,9 +332,8 @@ class OcrRunner:
         """
 
         self.logger.getChild("normalize_text").debug("Run normalize_text")
-        return re.compile('[!"#$%&\'\\\\()*+,-./:;<=>?@[\\]^_`{|}~「」〔〕“”〈〉『』【】＆＊・（）＄＃＠。、？！｀＋￥％ 　]').sub("",text)
+        return symbol_pattern.sub("",text)
 
-    # FIXME: 実行時に動作が重くなる
     def get_ocr_text(self, frame:np.ndarray, option:str) -> str:
         """画像に対してOCRでテキストを取得する
 
@@ -218,12 +348,101 @@ class OcrRunner:
         logger = self.logger.getChild("get_ocr_text")
         logger.info(f"Run get_ocr_text : {option}")
 
-        PIL_Image = Image.fromarray(frame)
-        text = self.tool.image_to_string(
-            PIL_Image,
-            lang=self.list_ocr_option[option]["lang"],
-            builder=pyocr.builders.TextBuilder(tesseract_layout=6))
+        # 同じ画像のOCR結果があればそのまま返す
+        text = self.ocr_cache.get(frame, option)
+        if text is not None:
+            logger.debug(f"Hit OCR cache : {option}")
+            return text
+
+        text = self.engine.image_to_string(frame, self.list_ocr_option[option]["lang"])
         
         text = self.normalize_text(text)
+        self.ocr_cache.put(frame, option, text)
         
         return text
+
+class OcrScheduler:
+    def __init__(self, ocr_runner:OcrRunner, max_workers:int=None):
+        """OCRをワーカースレッドで実行するスケジューラ
+        Tesseractの処理中も画面描画(mainloop)を止めないよう、切抜き・マスク処理・OCRをまとめてワーカーで実行する
+        結果はFutureと、依頼元が指定したキューで受け取る
+
+        Args:
+            ocr_runner (OcrRunner): OCR処理のクラス
+            max_workers (int, optional): ワーカースレッド数. Defaults to None(config.iniの設定).
+        """
+        self.logger = getLogger("Log").getChild("OcrScheduler")
+        self.logger.info("Called OcrScheduler")
+
+        self.ocr_runner = ocr_runner
+        if max_workers is None:
+            max_workers = int(config.get("DEFAULT","ocr_workers",fallback="2"))
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="Thread OCR Worker")
+        self.futures:dict[str, Future] = {} # オプションごとの実行中のジョブ
+        self.lock = threading.Lock()
+
+    def is_pending(self, option:str) -> bool:
+        """同じオプションのジョブが実行中か確認する
+
+        Args:
+            option (str): 認識オプション
+
+        Returns:
+            bool: 実行中→True
+        """
+        with self.lock:
+            future = self.futures.get(option)
+            return future is not None and not future.done()
+
+    def submit(self, option:str, result_queue:queue.Queue=None, crop_option:str=None) -> Future:
+        """OCRのジョブを登録する
+
+        Args:
+            option (str): 認識オプション(level / namebox / rankbattle / message)
+            result_queue (queue.Queue, optional): 結果を受け取るキュー. Defaults to None.
+            crop_option (str, optional): OCRと同じタイミングのフレームから切り抜く領域. Defaults to None.
+
+        Returns:
+            Future: 結果(dict)を返すFuture. {"option":オプション, "text":認識したテキスト, "crop_frame":切抜き画像}
+        """
+        self.logger.getChild("submit").debug(f"Submit {option}")
+        future = self.executor.submit(self.run_job, option, result_queue, crop_option)
+        with self.lock:
+            self.futures[option] = future
+        return future
+
+    def run_job(self, option:str, result_queue:queue.Queue, crop_option:str) -> dict:
+        """ワーカースレッドでOCRを実行する
+
+        Args:
+            option (str): 認識オプション
+            result_queue (queue.Queue): 結果を受け取るキュー
+            crop_option (str): 同時に切り抜く領域
+
+        Returns:
+            dict: 認識結果
+        """
+        logger = self.logger.getChild("run_job")
+        result = {"option":option, "text":None, "crop_frame":None}
+        try:
+            if crop_option is not None:
+                # リングバッファの画像は上書きされるため、切抜き画像はコピーする
+                crop_frame = self.ocr_runner.get_region_frame(crop_option)
+                if crop_frame is not None:
+                    result["crop_frame"] = crop_frame.copy()
+            masked_frame = self.ocr_runner.get_consensus_frame(option)
+            if masked_frame is not None:
+                result["text"] = self.ocr_runner.get_ocr_text(masked_frame, option)
+        except Exception as e:
+            logger.error(f"Fault OCR job : {option}")
+            logger.exception(e)
+        if result_queue is not None:
+            result_queue.put(result)
+        return result
+
+    def close(self) -> None:
+        """
+        終了時の処理
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.logger.info("Close OcrScheduler")
@@ -0,0 +1,147 @@
+"""
+OCRエンジン(Tesseractの呼び出し方法)をまとめたモジュール
+
+TesserocrEngine:libtesseractを常駐させて呼び出す(言語ごとにハンドルを保持し、言語データの再読込をしない)
+PyocrEngine:pyocr経由で呼び出す(tesseractコマンドを毎回起動する)
+
+tesserocrがインストールされていない場合はpyocrを使う
+"""
+
+import os, sys
+import threading
+from abc import ABC, abstractmethod
+from logging import getLogger
+
+import numpy as np
+from PIL import Image
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+try:
+    import pyocr
+    import pyocr.builders
+except ImportError:
+    pyocr = None
+
+class OcrEngine(ABC):
+    name = "base"
+
+    def __init__(self) -> None:
+        """
+        OCRエンジンの基底クラス
+        """
+        self.logger = getLogger("Log").getChild(self.__class__.__name__)
+        self.logger.info(f"Called {self.__class__.__name__}")
+
+    @abstractmethod
+    def image_to_string(self, frame:np.ndarray, lang:str) -> str:
+        """画像からテキストを取得する(派生クラスで実装)
+
+        Args:
+            frame (np.ndarray): テキストを取得したい画像
+            lang (str): 言語(jpn / eng / jpn+eng)
+
+        Returns:
+            str: 認識したテキスト
+        """
+
+    def warmup(self, langs:list[str]) -> None:
+        """言語データを読み込ませるため、空の画像でOCRを実行する
+
+        Args:
+            langs (list[str]): 使用する言語のリスト
+        """
+        logger = self.logger.getChild("warmup")
+        frame = np.full((32, 64), 255, dtype=np.uint8)
+        for lang in langs:
+            try:
+                self.image_to_string(frame, lang)
+            except Exception as e:
+                logger.error(f"Fault warmup : {lang}")
+                logger.exception(e)
+        logger.info(f"Complete warmup : {langs}")
+
+    def close(self) -> None:
+        pass
+
+class TesserocrEngine(OcrEngine):
+    name = "tesserocr"
+
+    def __init__(self, tessdata_path:str, langs:list[str]) -> None:
+        """libtesseractを常駐させて呼び出すOCRエンジン
+        ハンドルはスレッドセーフではないため、言語ごとにロックをかけて使う
+
+        Args:
+            tessdata_path (str): 言語データ(tessdata)のフォルダ
+            langs (list[str]): 使用する言語のリスト(jpn / eng / jpn+eng)
+        """
+        super().__init__()
+        self.apis:dict = {}
+        self.locks:dict[str, threading.Lock] = {}
+        for lang in langs:
+            if os.path.exists(tessdata_path):
+                api = tesserocr.PyTessBaseAPI(path=tessdata_path, lang=lang, psm=tesserocr.PSM.SINGLE_BLOCK)
+            else:
+                api = tesserocr.PyTessBaseAPI(lang=lang, psm=tesserocr.PSM.SINGLE_BLOCK)
+            self.apis[lang] = api
+            self.locks[lang] = threading.Lock()
+
+    def image_to_string(self, frame:np.ndarray, lang:str) -> str:
+        with self.locks[lang]:
+            api = self.apis[lang]
+            api.SetImage(Image.fromarray(frame))
+            return api.GetUTF8Text()
+
+    def close(self) -> None:
+        for lang, api in self.apis.items():
+            with self.locks[lang]:
+                api.End()
+        self.logger.info("Close TesserocrEngine")
+
+class PyocrEngine(OcrEngine):
+    name = "pyocr"
+
+    def __init__(self) -> None:
+        """
+        pyocr経由でtesseractを呼び出すOCRエンジン
+        """
+        super().__init__()
+        tools = pyocr.get_available_tools() if pyocr is not None else []
+        if len(tools) == 0:
+            raise RuntimeError("Not found OCR tool")
+        self.tool = tools[0]
+
+    def image_to_string(self, frame:np.ndarray, lang:str) -> str:
+        return self.tool.image_to_string(
+            Image.fromarray(frame),
+            lang=lang,
+            builder=pyocr.builders.TextBuilder(tesseract_layout=6))
+
+def create_ocr_engine(backend:str, tesseract_path:str, langs:list[str]) -> OcrEngine:
+    """OCRエンジンを作成する
+
+    Args:
+        backend (str): auto(tesserocrがあれば使う) / tesserocr / pyocr
+        tesseract_path (str): Tesseractのインストールフォルダ
+        langs (list[str]): 使用する言語のリスト
+
+    Returns:
+        OcrEngine: OCRエンジン. 使えるエンジンが無い場合はNone
+    """
+    logger = getLogger("Log").getChild("create_ocr_engine")
+    if backend in ("auto", "tesserocr") and tesserocr is not None:
+        try:
+            return TesserocrEngine(os.path.join(tesseract_path, "tessdata"), langs)
+        except Exception as e:
+            logger.error("Fault create TesserocrEngine")
+            logger.exception(e)
+    if backend in ("auto", "pyocr", "tesserocr"):
+        try:
+            return PyocrEngine()
+        except Exception as e:
+            logger.error("Fault create PyocrEngine")
+            logger.exception(e)
+    return None
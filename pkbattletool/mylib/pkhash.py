@@ -5,14 +5,386 @@ dHash値を使ってポケモンアイコン画像の類似検索を行う処理
 作者：暇士
 """
 import os, sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
 from logging import getLogger
 
-from module import pkcsv
+from module import config, pkcsv, pkgallery
+
+def pack_dhash(dhash:str) -> np.uint64:
+    """'0'/'1'の64文字のdHash値を64bit整数にまとめる
+
+    Args:
+        dhash (str): dHash値
+
+    Returns:
+        np.uint64: 先頭の文字を最上位ビットとした64bit整数
+    """
+    return np.uint64(int(dhash, 2))
+
+def pack_hist(hist:str) -> np.ndarray:
+    """16進数の色ヒストグラムを、合計が1になる配列に戻す
+
+    Args:
+        hist (str): 各ビンの割合を0-255で表した値を16進数2文字ずつ並べた文字列
+
+    Returns:
+        np.ndarray: 各ビンの割合(float32)
+    """
+    return np.frombuffer(bytes.fromhex(hist), dtype=np.uint8).astype(np.float32) / np.float32(255)
+
+class HashGallery:
+    chunk_count:int = 4 # dHash値(64bit)の分割数
+    chunk_bits:int = 16 # 分割した1つあたりのビット数
+    max_chunk_radius:int = 2 # 分割ごとに探索する距離の上限(超える場合は全件の距離を求める)
+    linear_scan_size:int = 32768 # 参照画像がこの数以下の場合は全件の距離を求める(索引を引くより速い)
+    hist_bins:int = 64 # 色ヒストグラムのビン数(色相16 x 彩度4)
+    hist_weight:float = 8.0 # 並べ直す際の色ヒストグラムの距離(0-2)の重み(ハミング距離に換算)
+
+    # 16bitの値をビット数ごとにまとめたもの(分割ごとの近傍の列挙に使う)
+    chunk_masks:list[np.ndarray] = [
+        np.flatnonzero(np.bitwise_count(np.arange(1 << 16, dtype=np.uint32)) == weight).astype(np.uint64)
+        for weight in range(max_chunk_radius + 1)]
+
+    def __init__(self) -> None:
+        """dHash値の検索用の一覧
+        dHash値を連続したuint64配列にまとめ、XORとビット数の計算で距離を求める
+        参照画像が多い場合は、64bitを16bitずつ4つに分けた索引(Multi-Index Hashing)で候補を絞る
+        距離がr以下の参照画像は、4つのうち少なくとも1つの分割で距離がr/4以下になることを使う
+        """
+        self.logger = getLogger("Log").getChild("HashGallery")
+        self.logger.debug("Called HashGallery")
+
+        self.lock = threading.Lock()
+        self.update_lock = threading.Lock() # 一覧の作成・追加を1つずつ行う(検索はlockのみ)
+        self.keys:np.ndarray = np.empty(0, dtype=object) # 識別キー(1つのキーに複数の参照画像がある)
+        self.key_codes:np.ndarray = np.empty(0, dtype=np.int64) # 識別キーの番号(キーごとの集計用)
+        self.hashes:np.ndarray = np.empty(0, dtype=np.uint64) # dHash値
+        self.sample_ids:np.ndarray = np.empty(0, dtype=np.int64) # 参照画像の番号
+        self.chunk_values:list[np.ndarray] = [] # 分割ごとの値(昇順)
+        self.chunk_orders:list[np.ndarray] = [] # 分割ごとの値の昇順に並べた一覧の位置
+        self.phashes:np.ndarray = np.empty(0, dtype=np.uint64) # pHash値(並べ直し用)
+        self.hists:np.ndarray = np.empty((0, self.hist_bins), dtype=np.float32) # 色ヒストグラム(並べ直し用)
+        self.has_descriptor:np.ndarray = np.empty(0, dtype=bool) # pHash値と色ヒストグラムがあるか
+        self.positions:dict[int, int] = {} # 参照画像の番号→一覧の位置
+        self.version:int = -1 # 作成元のデータのバージョン
+
+    def build(self, keylist:list[str], hashlist:list[str], version:int, idlist:list[int]=None,
+              phashlist:list[str]=None, histlist:list[str]=None) -> None:
+        """一覧を作成する
+
+        Args:
+            keylist (list[str]): 識別キーのリスト
+            hashlist (list[str]): dHash値('0'/'1'の64文字)のリスト
+            version (int): 作成元のデータのバージョン
+            idlist (list[int], optional): 参照画像の番号のリスト. Defaults to None(一覧の順番).
+            phashlist (list[str], optional): pHash値('0'/'1'の64文字、無い場合は空文字)のリスト. Defaults to None.
+            histlist (list[str], optional): 色ヒストグラム(16進数、無い場合は空文字)のリスト. Defaults to None.
+        """
+        keys = np.asarray(keylist, dtype=object)
+        sample_ids = np.arange(len(keys), dtype=np.int64) if idlist is None else np.asarray(idlist, dtype=np.int64)
+        hashes, phashes, hists, has_descriptor = self.parse(hashlist, phashlist, histlist)
+        with self.update_lock:
+            self.set_samples(keys, hashes, sample_ids, phashes, hists, has_descriptor, version)
+        self.logger.getChild("build").info(f"Build gallery : {len(keys)} hashes, {int(has_descriptor.sum())} descriptors (version {version})")
+
+    def append(self, keylist:list[str], hashlist:list[str], version:int, idlist:list[int],
+               phashlist:list[str]=None, histlist:list[str]=None) -> bool:
+        """一覧に参照画像を追加する(追加分のみ文字列を変換し、既存の参照画像は変換し直さない)
+        参照画像の番号は一覧の位置と同じため、追加分の先頭の番号が一覧の数と異なる場合は追加しない
+
+        Args:
+            keylist (list[str]): 識別キーのリスト
+            hashlist (list[str]): dHash値('0'/'1'の64文字)のリスト
+            version (int): 追加後のデータのバージョン
+            idlist (list[int]): 参照画像の番号のリスト
+            phashlist (list[str], optional): pHash値('0'/'1'の64文字、無い場合は空文字)のリスト. Defaults to None.
+            histlist (list[str], optional): 色ヒストグラム(16進数、無い場合は空文字)のリスト. Defaults to None.
+
+        Returns:
+            bool: 追加した(反映済みを含む)→True, 一覧と追加分が続いていない(作り直しが必要)→False
+        """
+        hashes, phashes, hists, has_descriptor = self.parse(hashlist, phashlist, histlist)
+        with self.update_lock:
+            with self.lock:
+                # 別のスレッドで反映済み
+                if self.version >= version:
+                    return True
+                # 差分を取得した後に別のスレッドで一覧が変わった
+                if len(idlist) > 0 and idlist[0] != len(self.keys):
+                    self.logger.getChild("append").warning(f"Mismatch gallery : {len(self.keys)} hashes, append from {idlist[0]}")
+                    return False
+                current = self.keys, self.hashes, self.sample_ids, self.phashes, self.hists, self.has_descriptor
+            added = np.asarray(keylist, dtype=object), hashes, np.asarray(idlist, dtype=np.int64), phashes, hists, has_descriptor
+            self.set_samples(*(np.concatenate([old, new]) for old, new in zip(current, added)), version)
+        self.logger.getChild("append").info(f"Append gallery : {len(hashes)} hashes (version {version})")
+        return True
+
+    def parse(self, hashlist:list[str], phashlist:list[str]=None, histlist:list[str]=None) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """dHash値と並べ直し用の特徴量の文字列を配列に変換する
+
+        Args:
+            hashlist (list[str]): dHash値('0'/'1'の64文字)のリスト
+            phashlist (list[str], optional): pHash値('0'/'1'の64文字、無い場合は空文字)のリスト. Defaults to None.
+            histlist (list[str], optional): 色ヒストグラム(16進数、無い場合は空文字)のリスト. Defaults to None.
+
+        Returns:
+            np.ndarray: dHash値
+            np.ndarray: pHash値
+            np.ndarray: 色ヒストグラム
+            np.ndarray: pHash値と色ヒストグラムがあるか
+        """
+        hashes = np.fromiter((pack_dhash(dhash) for dhash in hashlist), dtype=np.uint64, count=len(hashlist))
+        # 並べ直し用の特徴量(pHash値と色ヒストグラムの両方がある参照画像のみ使う)
+        phashes = np.zeros(len(hashes), dtype=np.uint64)
+        hists = np.zeros((len(hashes), self.hist_bins), dtype=np.float32)
+        has_descriptor = np.zeros(len(hashes), dtype=bool)
+        if phashlist is not None and histlist is not None:
+            for i, (phash, hist) in enumerate(zip(phashlist, histlist)):
+                if phash and hist and len(hist) == self.hist_bins * 2:
+                    phashes[i] = pack_dhash(phash)
+                    hists[i] = pack_hist(hist)
+                    has_descriptor[i] = True
+        return hashes, phashes, hists, has_descriptor
+
+    def set_samples(self, keys:np.ndarray, hashes:np.ndarray, sample_ids:np.ndarray, phashes:np.ndarray,
+                    hists:np.ndarray, has_descriptor:np.ndarray, version:int) -> None:
+        """変換済みの参照画像から索引を作り、一覧を置き換える
+
+        Args:
+            keys (np.ndarray): 識別キー
+            hashes (np.ndarray): dHash値
+            sample_ids (np.ndarray): 参照画像の番号
+            phashes (np.ndarray): pHash値
+            hists (np.ndarray): 色ヒストグラム
+            has_descriptor (np.ndarray): pHash値と色ヒストグラムがあるか
+            version (int): 作成元のデータのバージョン
+        """
+        _, key_codes = np.unique(keys.astype(str), return_inverse=True)
+        chunk_values, chunk_orders = [], []
+        for chunk in range(self.chunk_count):
+            values = (hashes >> np.uint64(chunk * self.chunk_bits)) & np.uint64(0xFFFF)
+            order = np.argsort(values, kind="stable")
+            chunk_values.append(values[order])
+            chunk_orders.append(order)
+        positions = {int(sample_id):i for i, sample_id in enumerate(sample_ids)}
+        with self.lock:
+            self.keys, self.key_codes, self.hashes, self.sample_ids = keys, key_codes.astype(np.int64), hashes, sample_ids
+            self.chunk_values, self.chunk_orders = chunk_values, chunk_orders
+            self.phashes, self.hists, self.has_descriptor, self.positions = phashes, hists, has_descriptor, positions
+            self.version = version
+
+    def distances(self, dhash:np.uint64) -> np.ndarray:
+        """全件とのハミング距離を求める
+
+        Args:
+            dhash (np.uint64): 検索するdHash値
+
+        Returns:
+            np.ndarray: 一覧の順のハミング距離
+        """
+        with self.lock:
+            hashes = self.hashes
+        return np.bitwise_count(np.bitwise_xor(hashes, np.uint64(dhash)))
+
+    def probe(self, dhash:np.uint64, weight:int) -> np.ndarray:
+        """いずれかの分割で、ちょうどweightビット異なる参照画像を列挙する
+
+        Args:
+            dhash (np.uint64): 検索するdHash値
+            weight (int): 分割ごとの距離
+
+        Returns:
+            np.ndarray: 一覧の位置(重複あり)
+        """
+        indexlist = []
+        for chunk in range(self.chunk_count):
+            value = (np.uint64(dhash) >> np.uint64(chunk * self.chunk_bits)) & np.uint64(0xFFFF)
+            probes = np.bitwise_xor(self.chunk_masks[weight], value)
+            starts = np.searchsorted(self.chunk_values[chunk], probes, side="left")
+            ends = np.searchsorted(self.chunk_values[chunk], probes, side="right")
+            lengths = ends - starts
+            hit = lengths > 0
+            starts, lengths = starts[hit], lengths[hit]
+            if len(starts) == 0:
+                continue
+            # 複数の範囲[start, end)の位置をまとめて並べる
+            offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            indexlist.append(self.chunk_orders[chunk][offsets])
+        if len(indexlist) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate(indexlist)
+
+    def rank(self, indexes:np.ndarray, distances:np.ndarray, k:int=None) -> list[tuple[str, int, int]]:
+        """識別キーごとに最も近い参照画像を距離の近い順に並べる
+
+        Args:
+            indexes (np.ndarray): 一覧の位置
+            distances (np.ndarray): ハミング距離
+            k (int, optional): 返す識別キーの数. Defaults to None(全て).
+
+        Returns:
+            list[tuple[str, int, int]]: (識別キー、ハミング距離、参照画像の番号)のリスト
+        """
+        # 距離が同じ場合は一覧の先頭側を優先する
+        order = np.lexsort((indexes, distances))
+        indexes, distances = indexes[order], distances[order]
+        _, first = np.unique(self.key_codes[indexes], return_index=True)
+        first.sort()
+        if k is not None:
+            first = first[:k]
+        return [(self.keys[indexes[i]], int(distances[i]), int(self.sample_ids[indexes[i]])) for i in first]
+
+    def nearest(self, dhash:np.uint64, k:int=1) -> list[tuple[str, int, int]]:
+        """ハミング距離が近い順に識別キーを探す(識別キーごとに最も近い参照画像で比べる)
+
+        Args:
+            dhash (np.uint64): 検索するdHash値
+            k (int, optional): 返す識別キーの数. Defaults to 1.
+
+        Returns:
+            list[tuple[str, int, int]]: (識別キー、ハミング距離、参照画像の番号)のリスト. 一覧が空の場合は空のリスト
+        """
+        with self.lock:
+            if len(self.hashes) == 0:
+                return []
+            # 2番目以降の候補は距離が遠く索引で絞れないことが多いため、索引は最も近い1件を探す場合のみ使う
+            if len(self.hashes) > self.linear_scan_size and k == 1:
+                candidates = np.empty(0, dtype=np.int64)
+                for weight in range(self.max_chunk_radius + 1):
+                    candidates = np.union1d(candidates, self.probe(dhash, weight))
+                    distances = np.bitwise_count(np.bitwise_xor(self.hashes[candidates], np.uint64(dhash)))
+                    # 距離がboundまでの参照画像は全て候補に含まれている
+                    bound = self.chunk_count * (weight + 1) - 1
+                    found = self.rank(candidates[distances <= bound], distances[distances <= bound], k)
+                    if len(found) >= k:
+                        return found
+            # 近い参照画像が少ない場合は全件の距離を求める
+            distances = np.bitwise_count(np.bitwise_xor(self.hashes, np.uint64(dhash)))
+            return self.rank_all(distances, k)
+
+    def rank_all(self, distances:np.ndarray, k:int) -> list[tuple[str, int, int]]:
+        """全件の距離から、距離の近い順にk個の識別キーを並べる
+
+        Args:
+            distances (np.ndarray): 一覧の順のハミング距離
+            k (int): 返す識別キーの数
+
+        Returns:
+            list[tuple[str, int, int]]: (識別キー、ハミング距離、参照画像の番号)のリスト
+        """
+        # 距離の度数分布から、k個の識別キーが見つかる距離まで絞ってから並べる
+        cumulative = np.cumsum(np.bincount(distances, minlength=65))
+        for bound in range(int(np.searchsorted(cumulative, k)), 65):
+            indexes = np.flatnonzero(distances <= bound)
+            found = self.rank(indexes, distances[indexes], k)
+            if len(found) >= k or len(indexes) == len(distances):
+                return found
+        return found
+
+    def nearest_batch(self, dhashes:np.ndarray, k:int=1) -> list[list[tuple[str, int, int]]]:
+        """複数のdHash値について、ハミング距離が近い順に識別キーを探す
+        全件との距離は(検索数 x 参照画像数)の行列としてまとめて求める
+
+        Args:
+            dhashes (np.ndarray): 検索するdHash値(uint64)の配列
+            k (int, optional): 返す識別キーの数. Defaults to 1.
+
+        Returns:
+            list[list[tuple[str, int, int]]]: dHash値ごとの(識別キー、ハミング距離、参照画像の番号)のリスト
+        """
+        dhashes = np.asarray(dhashes, dtype=np.uint64)
+        with self.lock:
+            if len(self.hashes) == 0:
+                return [[] for _ in range(len(dhashes))]
+            use_index = len(self.hashes) > self.linear_scan_size and k == 1
+        if use_index:
+            return [self.nearest(dhash, k) for dhash in dhashes]
+        with self.lock:
+            distance_matrix = np.bitwise_count(np.bitwise_xor(self.hashes[np.newaxis, :], dhashes[:, np.newaxis]))
+            return [self.rank_all(distances, k) for distances in distance_matrix]
+
+    def within(self, dhash:np.uint64, radius:int) -> list[tuple[str, int, int]]:
+        """ハミング距離がradius以下の識別キーを探す(識別キーごとに最も近い参照画像で比べる)
+
+        Args:
+            dhash (np.uint64): 検索するdHash値
+            radius (int): ハミング距離の上限
+
+        Returns:
+            list[tuple[str, int, int]]: (識別キー、ハミング距離、参照画像の番号)のリスト(距離の近い順)
+        """
+        with self.lock:
+            if len(self.hashes) == 0:
+                return []
+            chunk_radius = radius // self.chunk_count
+            if len(self.hashes) > self.linear_scan_size and chunk_radius <= self.max_chunk_radius:
+                indexes = np.unique(np.concatenate([self.probe(dhash, weight) for weight in range(chunk_radius + 1)]))
+            else:
+                indexes = np.arange(len(self.hashes))
+            distances = np.bitwise_count(np.bitwise_xor(self.hashes[indexes], np.uint64(dhash)))
+            return self.rank(indexes[distances <= radius], distances[distances <= radius])
+
+    def rerank(self, candidatelist:list[list[tuple[str, int, int]]], phashes:np.ndarray, hists:np.ndarray, k:int) -> list[list[tuple[str, int, int]]]:
+        """dHash値で絞った候補を、pHash値と色ヒストグラムを加えた距離で並べ直す
+        並べ直す距離は(dHashの距離 + pHashの距離) / 2 + 色ヒストグラムのL1距離 x hist_weight
+        特徴量の無い参照画像とは距離の尺度が違うため、候補の全てに特徴量がある画像のみ並べ直し、それ以外はdHashの距離の順のまま
+        返す距離は並べ直しても元のdHashの距離(確からしさの判定やチームの割り当ては、dHashのビット数で調整しているため)
+
+        Args:
+            candidatelist (list[list[tuple[str, int, int]]]): nearest_batchの結果(画像ごとの距離の近い順の候補)
+            phashes (np.ndarray): 検索する画像のpHash値(uint64)の配列
+            hists (np.ndarray): 検索する画像の色ヒストグラム(画像の数 x hist_bins)
+            k (int): 返す識別キーの数
+
+        Returns:
+            list[list[tuple[str, int, int]]]: 画像ごとの(識別キー、dHashの距離、参照画像の番号)のリスト(並べ直した順)
+        """
+        # 全ての画像の候補をまとめて計算する
+        counts = [len(candidates) for candidates in candidatelist]
+        queries = np.repeat(np.arange(len(candidatelist)), counts)
+        with self.lock:
+            positions = np.fromiter((self.positions[sample_id] for candidates in candidatelist for _, _, sample_id in candidates),
+                                    dtype=np.int64, count=len(queries))
+            has_descriptor = self.has_descriptor[positions]
+            phash_distances = np.bitwise_count(np.bitwise_xor(self.phashes[positions], np.asarray(phashes, dtype=np.uint64)[queries]))
+            hist_distances = np.abs(self.hists[positions] - hists[queries]).sum(axis=1)
+        distances = np.fromiter((distance for candidates in candidatelist for _, distance, _ in candidates), dtype=np.float32, count=len(queries))
+        scores = (distances + phash_distances) / 2 + hist_distances * self.hist_weight
+
+        resultlist = []
+        start = 0
+        for candidates, count in zip(candidatelist, counts):
+            if count > 0 and has_descriptor[start:start + count].all():
+                # 距離が同じ場合は元の順(dHashの距離が近い順)を優先する
+                order = np.argsort(scores[start:start + count], kind="stable")[:k].tolist()
+                resultlist.append([candidates[i] for i in order])
+            else:
+                resultlist.append(list(candidates[:k]))
+            start += count
+        return resultlist
+
+    @staticmethod
+    def margin(candidates:list[tuple[str, int, int]]) -> int:
+        """最も近い識別キーと2番目に近い識別キーの距離の差
+
+        Args:
+            candidates (list[tuple[str, int, int]]): nearestの結果
+
+        Returns:
+            int: 距離の差(大きいほど確からしい). 候補が1つの場合は64との差
+        """
+        if len(candidates) == 0:
+            return 0
+        second = candidates[1][1] if len(candidates) > 1 else 64
+        return second - candidates[0][1]
 
 class PkHash:
+    border_ratio:float = 0.9 # 幅(高さ)のこの割合以上を占める行(列)は枠線とみなす
+
     def __init__(self):
         """
         dHash比較で類似画像を調べる処理
@@ -21,6 +393,16 @@ class PkHash:
         self.logger.info("Called PkHash")
 
         self.crop_frame = None # ポケモン一覧画像
+        self.gallery = HashGallery() # 参照画像のdHash値の一覧
+        self.species:dict[str, int] = {} # 識別キー→図鑑番号
+        self.species_version:int = -1 # 図鑑番号の辞書の作成元のデータのバージョン
+        self.team_margin:int = 0 # 直前に認識したチームの組み合わせの確からしさ
+        # dHash値で絞る候補の数(pHash値と色ヒストグラムで並べ直す. 0は並べ直さない)
+        self.rerank_count = int(config.get("DEFAULT","hash_rerank_count",fallback="10"))
+
+        # 6匹分の輪郭切り抜きを並列に行うスレッド数(0は並列にしない)
+        workers = int(config.get("DEFAULT","hash_workers",fallback="0"))
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Thread PkHash") if workers > 0 else None
 
     # ポケモン画像解析
     def RecognitionPokemonImages(self, crop_frame:np.ndarray) -> tuple[list[str], list[int], list[np.ndarray], list[np.ndarray]]:
@@ -34,33 +416,148 @@ class PkHash:
             cutframelist (np.ndarray): 6分割した切り出し画像リスト
             outline_iconlist (np.ndarray): 輪郭切り出し画像リスト
         """
-        logger = self.logger.getChild("RecognitionPokemonImages") # loggerの設定
-        logger.debug("Execute RecognitionPokemonImages")
-        height, width, _ = crop_frame.shape[:3]
+        candidatelist, cutframelist, outline_iconllist = self.RecognitionPokemonCandidates(crop_frame)
+        keylist: list[str] = [candidates[0][0] if candidates else None for candidates in candidatelist] # キーリスト
+        dislist:list[int] = [candidates[0][1] if candidates else 64 for candidates in candidatelist] # 編集距離のリスト
+        return keylist, dislist, cutframelist, outline_iconllist
+
+    def RecognitionPokemonCandidates(self, crop_frame:np.ndarray, k:int=5) -> tuple[list[list[tuple[str, int, int]]], list[np.ndarray], list[np.ndarray]]:
+        """選出時の手持ちポケモンの画像を6枚に分割し、それぞれの候補を距離の近い順に取得する
+        6匹分の輪郭切り抜きとdHash値をまとめて求め、参照画像の一覧は1回の距離行列の計算で検索する
+
+        Args:
+            crop_frame (np.ndarray): 手持ちポケモンの切り抜き画像
+            k (int, optional): 1匹あたりの候補の数. Defaults to 5.
+
+        Returns:
+            candidatelist (list[list[tuple[str, int, int]]]): (識別キー、ハミング距離、参照画像の番号)の候補リスト
+            cutframelist (np.ndarray): 6分割した切り出し画像リスト
+            outline_iconlist (np.ndarray): 輪郭切り出し画像リスト
+        """
+        logger = self.logger.getChild("RecognitionPokemonCandidates") # loggerの設定
+        logger.debug("Execute RecognitionPokemonCandidates")
+        # 切り抜き画像(枠)
+        cutframelist:list[np.ndarray] = self.SplitTeamFrame(crop_frame)
+        # 切り抜きリスト(輪郭)
+        if self.executor is not None:
+            outline_iconllist:list[np.ndarray] = list(self.executor.map(self.GetImageByAllContours, cutframelist))
+        else:
+            outline_iconllist:list[np.ndarray] = [self.GetImageByAllContours(cut_frame) for cut_frame in cutframelist]
+
+        # 候補リスト
+        dhashes = self.CalcPerceptualDhashValues(outline_iconllist)
+        candidatelist:list[list[tuple[str, int, int]]] = self.SearchCandidates(dhashes, outline_iconllist, k)
+        # 同じポケモンが重複しないように、チーム全体で候補を選び直す(選んだ候補を先頭に並べる)
+        candidatelist, total_distance, self.team_margin = self.AssignTeam(candidatelist)
+
+        # 選んだ参照画像の認識回数を記録する
+        pkgallery.add_hits([candidates[0][2] for candidates in candidatelist if candidates])
+        logger.info(f"Complete CutFrame : {[candidates[0][:2] for candidates in candidatelist if candidates]} (total={total_distance}/margin={self.team_margin})")
+        return candidatelist, cutframelist, outline_iconllist
+
+    def SearchCandidates(self, dhashes:np.ndarray, framelist:list[np.ndarray], k:int) -> list[list[tuple[str, int, int]]]:
+        """dHash値で候補を絞り、pHash値と色ヒストグラムで並べ直す
+
+        Args:
+            dhashes (np.ndarray): 輪郭切り抜き画像のdHash値
+            framelist (list[np.ndarray]): 輪郭切り抜き画像のリスト
+            k (int): 1枚あたりの候補の数
 
+        Returns:
+            list[list[tuple[str, int, int]]]: 画像ごとの(識別キー、距離、参照画像の番号)の候補リスト
+        """
+        gallery = self.GetGallery()
+        if self.rerank_count <= 0 or not gallery.has_descriptor.any():
+            return gallery.nearest_batch(dhashes, k)
+        candidatelist = gallery.nearest_batch(dhashes, max(k, self.rerank_count))
+        phashes, hists = self.CalcDescriptorValues(framelist)
+        hists = hists.astype(np.float32) / np.float32(255)
+        return gallery.rerank(candidatelist, phashes, hists, k)
+
+    def SplitTeamFrame(self, crop_frame:np.ndarray) -> list[np.ndarray]:
+        """手持ちポケモンの切り抜き画像を縦に6等分する
+
+        Args:
+            crop_frame (np.ndarray): 手持ちポケモンの切り抜き画像
+
+        Returns:
+            list[np.ndarray]: 6分割した切り出し画像リスト(コピーしないビュー)
+        """
+        height, width = crop_frame.shape[:2]
         img_pokemon_height = int(height / 6)
+        return [crop_frame[int(height / 6 * i):int(height / 6 * i)+img_pokemon_height, 0:width] for i in range(0, 6)]
 
-        # リストの初期化
-        keylist: list[str] = [] # キーリスト
-        dislist:list[int] = [] # 編集距離のリスト
-        cutframelist:list[np.ndarray] = [] # 切り抜き画像(枠)
-        outline_iconllist:list[np.ndarray] = [] # 切り抜きリスト(輪郭)
-        
-        for i in range(0, 6):
-            y = int(height / 6 * i)
-            cut_frame = crop_frame[y:y+img_pokemon_height, 0:width]
-            cutframelist.append(cut_frame)
-            
-            outline_frame = self.GetImageByAllContours(cut_frame)
-            outline_iconllist.append(outline_frame)
-            key, distance = self.GetPokemonNameFromImage(outline_frame)
-            keylist.append(key)
-            logger.debug(f"Success keylist.append({key})")
-            dislist.append(distance)
-            logger.debug(f"Success dislist.append({distance})")
-            logger.info(f"Complete CutFrame : {key}")
-        logger.error("Fault to run cut_frame")
-        return keylist, dislist, cutframelist, outline_iconllist
+    def AssignTeam(self, candidatelist:list[list[tuple[str, int, int]]]) -> tuple[list[list[tuple[str, int, int]]], int, int]:
+        """6匹の候補から、同じポケモン(図鑑番号)が重複しない組み合わせのうち距離の合計が最小のものを選ぶ
+        枠ごとの候補(上位k件)の中から分枝限定法で探す
+
+        Args:
+            candidatelist (list[list[tuple[str, int, int]]]): 枠ごとの(識別キー、ハミング距離、参照画像の番号)の候補リスト(距離の近い順)
+
+        Returns:
+            candidatelist (list[list[tuple[str, int, int]]]): 選んだ候補を先頭に並べ替えた候補リスト
+            total_distance (int): 選んだ組み合わせの距離の合計
+            margin (int): 2番目に良い組み合わせとの距離の合計の差(大きいほど確からしい)
+        """
+        logger = self.logger.getChild("AssignTeam")
+        species = self.GetSpecies()
+        # 最も近い候補の距離が小さい(確かな)枠から決めると枝刈りが効く
+        slots = sorted((i for i, candidates in enumerate(candidatelist) if candidates), key=lambda i: candidatelist[i][0][1])
+        # 残りの枠の距離の合計の下限
+        lower_bounds = [0] * (len(slots) + 1)
+        for depth in range(len(slots) - 1, -1, -1):
+            lower_bounds[depth] = lower_bounds[depth + 1] + candidatelist[slots[depth]][0][1]
+
+        best_cost, second_cost = None, None
+        best_choice:list[int] = None
+        choice = [0] * len(slots)
+
+        def search(depth:int, cost:int, used:set) -> None:
+            nonlocal best_cost, second_cost, best_choice
+            # 2番目に良い組み合わせより良くならない場合は探さない
+            if second_cost is not None and cost + lower_bounds[depth] >= second_cost:
+                return
+            if depth == len(slots):
+                if best_cost is None or cost < best_cost:
+                    best_cost, second_cost, best_choice = cost, best_cost, list(choice)
+                elif second_cost is None or cost < second_cost:
+                    second_cost = cost
+                return
+            for index, (key, distance, _) in enumerate(candidatelist[slots[depth]]):
+                pokemon_index = species.get(key, key)
+                if pokemon_index in used:
+                    continue
+                choice[depth] = index
+                used.add(pokemon_index)
+                search(depth + 1, cost + distance, used)
+                used.discard(pokemon_index)
+
+        search(0, 0, set())
+        if best_choice is None:
+            # 候補内で重複しない組み合わせが無い場合は、枠ごとに最も近い候補を使う
+            logger.warning("Not found team assignment without duplicates")
+            return candidatelist, lower_bounds[0], 0
+
+        assigned = list(candidatelist)
+        for depth, slot in enumerate(slots):
+            index = best_choice[depth]
+            candidates = candidatelist[slot]
+            assigned[slot] = [candidates[index]] + candidates[:index] + candidates[index+1:]
+        margin = (second_cost if second_cost is not None else 64 * len(slots)) - best_cost
+        return assigned, best_cost, margin
+
+    def GetSpecies(self) -> dict[str, int]:
+        """識別キーから図鑑番号を引く辞書を取得する(図鑑データが更新されていれば作り直す)
+
+        Returns:
+            dict[str, int]: 識別キー→図鑑番号
+        """
+        version = pkcsv.get_version()
+        if self.species_version != version:
+            pokemon_df = pkcsv.get_df()
+            self.species = dict(zip(pokemon_df.index, pokemon_df["Index"].tolist()))
+            self.species_version = version
+        return self.species
 
     def GetPokemonNameFromImage(self, frame:np.ndarray) -> tuple[str,int]:
         """輪郭短形で切り出したポケモン画像と最もdHash値が近い画像を探す
@@ -71,25 +568,47 @@ class PkHash:
             index (str): 類似度が最初の識別キー
             distance (int): Hash値の編集距離
         """
-        logger = self.logger.getChild("GetPokemonNameFromImage")
-        logger.debug("Execute GetPokemonNameFromImage")
-
-        dhash: str = self.CalcPerceptualDhash(frame)
-        dic: dict[str, int] = {}
-        pokemon_df = pkcsv.get_df()
-        for index, row in pokemon_df.dropna(subset=["Hash"]).iterrows():
-            # 差分の計算
-            distance = self.CalcHammingDistance(dhash, row["Hash"])
-            dic[index] = distance
-            # 違う画像の類似度が低くなったときに、正しい画像を認識しないため削除
-            # if distance <= 8:
-            #     logger.debug(f"Found key={index}/distance={distance}")
-            #     return index, distance
-
-        # 距離が最小の物を返す
-        min_key = min(dic.items(), key=lambda x: x[1])[0]
-        logger.debug(f"Nearly key={min_key}/distance={dic[min_key]}")
-        return min_key, dic[min_key]
+        candidates = self.GetPokemonCandidatesFromImage(frame, k=1)
+        if len(candidates) == 0:
+            return None, 64
+        min_key, distance, _ = candidates[0]
+        return min_key, distance
+
+    def GetPokemonCandidatesFromImage(self, frame:np.ndarray, k:int=5) -> list[tuple[str, int, int]]:
+        """輪郭短形で切り出したポケモン画像とdHash値が近い順に識別キーを探す
+
+        Args:
+            frame (np.ndarray): ポケモン1匹の輪郭切り抜き画像
+            k (int, optional): 候補の数. Defaults to 5.
+
+        Returns:
+            list[tuple[str, int, int]]: (識別キー、ハミング距離、参照画像の番号)のリスト
+        """
+        logger = self.logger.getChild("GetPokemonCandidatesFromImage")
+        logger.debug("Execute GetPokemonCandidatesFromImage")
+
+        candidates = self.SearchCandidates(self.CalcPerceptualDhashValues([frame]), [frame], k)[0]
+        if len(candidates) > 0:
+            # 最も近い参照画像の認識回数を記録する
+            pkgallery.add_hits([candidates[0][2]])
+            logger.debug(f"Nearly key={candidates[0][0]}/distance={candidates[0][1]}/margin={HashGallery.margin(candidates)}")
+        return candidates
+
+    def GetGallery(self) -> HashGallery:
+        """dHash値の一覧を取得する(参照画像が追加されていれば反映する)
+
+        Returns:
+            HashGallery: dHash値の一覧
+        """
+        if self.gallery.version != pkgallery.get_version():
+            # 追加された参照画像のみ反映する(削除・置き換えがあれば作り直す)
+            version, added_df = pkgallery.get_updates(self.gallery.version, len(self.gallery.keys))
+            if added_df is None or not self.gallery.append(added_df["Key"].tolist(), added_df["Hash"].tolist(), version, added_df.index.tolist(),
+                                                           added_df["Phash"].tolist(), added_df["Hist"].tolist()):
+                gallery_df = pkgallery.get_df()
+                self.gallery.build(gallery_df["Key"].tolist(), gallery_df["Hash"].tolist(), version, gallery_df.index.tolist(),
+                                   gallery_df["Phash"].tolist(), gallery_df["Hist"].tolist())
+        return self.gallery
 
     def CalcHammingDistance(self, hash1: str, hash2: str) -> int:
         """dHash差分を計算
@@ -102,12 +621,7 @@ class PkHash:
         """
         # ループ内処理のためログ出力を省略
         # self.logger.debug("Execute CalcHammingDistance")
-        # print(f"hash1={type(hash1)}/hash2={type(hash2)}")
-        # print(hash2)
-        result: int = 0
-        for i in range(len(hash1)):
-            if hash1[i] != hash2[i]:
-                result += 1
+        result: int = int(np.bitwise_count(pack_dhash(hash1) ^ pack_dhash(hash2)))
         return result
 
     def CalcPerceptualDhash(self, frame: np.ndarray) -> str:
@@ -121,16 +635,64 @@ class PkHash:
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         resized = cv2.resize(src=gray, dsize=(9, 8), interpolation=cv2.INTER_AREA)
 
-        dhash:str = ""
-        for y in range(0, 8):
-            for x in range(0, 8):
-                dhash += "1" if resized[y, x] > resized[y, x+1] else "0"
+        # 右隣の画素より明るい→1
+        bits = resized[:, :-1] > resized[:, 1:]
+        dhash:str = "".join("1" if bit else "0" for bit in bits.ravel())
 
         return dhash
 
+    def CalcPerceptualDhashValues(self, framelist:list[np.ndarray]) -> np.ndarray:
+        """複数の画像のdHashをまとめて算出する
+        Args:
+            framelist[list[np.ndarray]]:dHash値を算出したい画像のリスト
+        Returns:
+            dhashes[np.ndarray]:算出したdHash値(pack_dhashと同じビット順のuint64)の配列
+        """
+        self.logger.debug("Execute CalcPerceptualDhashValues")
+        resized = np.stack([cv2.resize(src=cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), dsize=(9, 8), interpolation=cv2.INTER_AREA)
+                            for frame in framelist])
+        # 右隣の画素より明るい→1 を、先頭を最上位ビットとして64bitにまとめる
+        bits = (resized[:, :, :-1] > resized[:, :, 1:]).reshape(len(framelist), 64)
+        dhashes:np.ndarray = np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+        return dhashes
+
+    def CalcDescriptorValues(self, framelist:list[np.ndarray]) -> tuple[np.ndarray, np.ndarray]:
+        """複数の画像の並べ直し用の特徴量をまとめて算出する
+        pHash : 32x32の離散コサイン変換の低周波8x8成分が、直流成分を除いた中央値より大きいか
+        色ヒストグラム : HSVの色相16 x 彩度4の割合(保存する値と同じく各ビンを0-255に丸める)
+        どちらも32x32に縮小した画像から求める
+        Args:
+            framelist[list[np.ndarray]]:特徴量を算出したい画像のリスト
+        Returns:
+            phashes[np.ndarray]:算出したpHash値(pack_dhashと同じビット順のuint64)の配列
+            hists[np.ndarray]:(画像の数 x 64)の色ヒストグラム(uint8)
+        """
+        lowlist, histlist = [], []
+        for frame in framelist:
+            # INTER_AREAは縮小率が整数でない場合に遅いため、双線形補間で縮小する
+            resized = cv2.resize(src=frame, dsize=(32, 32), interpolation=cv2.INTER_LINEAR)
+            lowlist.append(cv2.dct(np.float32(cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)))[:8, :8])
+            histlist.append(cv2.calcHist([cv2.cvtColor(resized, cv2.COLOR_BGR2HSV)], [0, 1], None, [16, 4], [0, 180, 0, 256]).ravel())
+        low = np.stack(lowlist).reshape(len(framelist), 64)
+        bits = low > np.median(low[:, 1:], axis=1, keepdims=True)
+        phashes:np.ndarray = np.packbits(bits, axis=1).view(">u8").ravel().astype(np.uint64)
+        # 32x32の画素数(1024)を0-255に丸める
+        hists:np.ndarray = np.rint(np.stack(histlist) * np.float32(255 / 1024)).astype(np.uint8)
+        return phashes, hists
+
+    def CalcDescriptors(self, frame:np.ndarray) -> tuple[str, str]:
+        """画像の並べ直し用の特徴量を保存用の文字列で算出する
+        Args:
+            frame[np.ndarray]:特徴量を算出したい画像
+        Returns:
+            phash[str]:pHash値('0'/'1'の64文字)
+            hist[str]:色ヒストグラム(各ビンの割合を0-255で表した値を16進数2文字ずつ並べた文字列)
+        """
+        phashes, hists = self.CalcDescriptorValues([frame])
+        return format(int(phashes[0]), "064b"), hists[0].tobytes().hex()
+
     def GetImageByAllContours(self, frame: np.ndarray) -> np.ndarray:
-        # FIXME: フレーム上下の境界ラインが接触してしまい、トリミングに失敗する場合がある
-        """ 画像内の全ての輪郭に外接する長方形を切り出す
+        """ 画像内のポケモンのアイコンに外接する長方形を切り出す
         Args:
             frame[np.ndarray]: 6分割したポケモンのアイコン画像
         Returns:
@@ -138,28 +700,61 @@ class PkHash:
         """
         logger = self.logger.getChild("GetImageByAllContours")
         logger.debug("Execute GetImageByAllContours")
-        
+
+        x1, y1, x2, y2 = self.GetIconRect(frame)
+        return frame[y1:y2, x1:x2]
+
+    def GetIconRect(self, frame: np.ndarray) -> tuple[int, int, int, int]:
+        """ 画像内のポケモンのアイコンに外接する長方形を求める
+        2値化した画像の行・列ごとの画素数から求める(全ての輪郭に外接する長方形と同じ)
+        画像の端にある枠線(幅または高さのほとんどを占める行・列)は除く
+        Args:
+            frame[np.ndarray]: 6分割したポケモンのアイコン画像
+        Returns:
+            rect[tuple[int, int, int, int]]: (x1, y1, x2, y2). アイコンが無い場合は画像全体
+        """
+        height, width = frame.shape[:2]
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
         # 閾値が低いと、輝度の高いポケモンのアイコンを認識しなくなる
-        try:
-            _, binary_img = cv2.threshold(gray, 170, 255, cv2.THRESH_BINARY_INV)
-            cv2.waitKey(0)
-            contours = self.FindContours(binary_img)
-        except:
-            _, binary_img = cv2.threshold(gray, 170, 255, cv2.THRESH_BINARY_INV)
-            cv2.waitKey(0)
-            contours = self.FindContours(binary_img)
-
-        rect = {"x1": 999999, "x2": -1, "y1": 999999, "y2": -1}
-        for i, contour in enumerate(contours):
-            x, y, w, h = cv2.boundingRect(contour)
-            rect = {"x1": min(rect["x1"], x),
-                    "x2": max(rect["x2"], x + w),
-                    "y1": min(rect["y1"], y),
-                    "y2": max(rect["y2"], y + h),
-                    }
-
-        return frame[rect["y1"]:rect["y2"], rect["x1"]:rect["x2"]]
+        _, binary_img = cv2.threshold(gray, 170, 1, cv2.THRESH_BINARY_INV)
+
+        # 行・列ごとの画素数
+        row_counts = cv2.reduce(binary_img, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        col_counts = cv2.reduce(binary_img, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+        top, bottom = self.GetBorderRange(row_counts >= width * self.border_ratio)
+        left, right = self.GetBorderRange(col_counts >= height * self.border_ratio)
+        if (top, bottom, left, right) != (0, height, 0, width):
+            # 枠線を除いた範囲で数え直す
+            binary_img = binary_img[top:bottom, left:right]
+            if binary_img.size == 0:
+                return 0, 0, width, height
+            row_counts = cv2.reduce(binary_img, 1, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+            col_counts = cv2.reduce(binary_img, 0, cv2.REDUCE_SUM, dtype=cv2.CV_32S).ravel()
+
+        rows = np.flatnonzero(row_counts)
+        cols = np.flatnonzero(col_counts)
+        if len(rows) == 0:
+            self.logger.getChild("GetIconRect").debug("Not found icon")
+            return 0, 0, width, height
+        return left + int(cols[0]), top + int(rows[0]), left + int(cols[-1]) + 1, top + int(rows[-1]) + 1
+
+    @staticmethod
+    def GetBorderRange(is_line:np.ndarray) -> tuple[int, int]:
+        """ 画像の端から連続する線を枠線として、枠線を除いた範囲を求める(アイコン内部の線は残す)
+        Args:
+            is_line[np.ndarray]: 行(列)ごとの線かどうか
+        Returns:
+            range[tuple[int, int]]: (開始, 終了). 枠線が無い場合は(0, 行(列)数)
+        """
+        size = len(is_line)
+        if not (is_line[0] or is_line[-1]):
+            return 0, size
+        if is_line.all():
+            return 0, 0
+        # 端から最初に線でない行(列)まで
+        start = int(np.argmin(is_line))
+        end = size - int(np.argmin(is_line[::-1]))
+        return start, end
 
     def FindContours(self, binary_img:np.ndarray):
         """輪郭抽出
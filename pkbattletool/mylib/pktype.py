@@ -1,13 +1,32 @@
 import os, sys
+import threading
 import pandas as pd
 from logging import getLogger
 
 class PkTypeCompatibility:
+    filename = f"resources/poketype.csv"
+    _typedf:pd.DataFrame = None # タイプ相性表(全てのインスタンスで共有し、読み込みは1回のみ)
+    _typedf_lock = threading.Lock()
+
     def __init__(self):
-        filename = f"resources/poketype.csv"
-        self.typedf = pd.read_csv(filename, index_col="atacktype")
+        self.typedf = self.load_table()
         self.logger = getLogger("Log").getChild("PkTypeCompatibility")
         self.logger.debug("Called PkTypeCompatibility")
+
+    @classmethod
+    def load_table(cls, reload:bool=False) -> pd.DataFrame:
+        """タイプ相性表を読み込む(初回のみ)
+
+        Args:
+            reload (bool, optional): 読み込み済みでもCSVから読み直す. Defaults to False.
+
+        Returns:
+            pd.DataFrame: タイプ相性表(行が攻撃側、列が防御側のタイプ)
+        """
+        with cls._typedf_lock:
+            if cls._typedf is None or reload:
+                cls._typedf = pd.read_csv(cls.filename, index_col="atacktype")
+            return cls._typedf
     
     def type_compatibility(self, atacktype:str, diffencetype:str) -> float:
         """タイプ相性の参照
@@ -0,0 +1,188 @@
+"""
+認識に使う領域のみの履歴を保持する処理
+
+フレーム全体ではなく、CameraFrameForge.optionsの領域を切り抜いた画像のみを保持するため、
+メモリ使用量と確保し直しの量はキャプチャ解像度ではなく、使う領域の大きさに比例する
+"""
+
+import os, sys
+import threading
+from logging import getLogger
+
+import numpy as np
+
+from .imgforge import CameraFrameForge, RegionConsensus
+from .webcam_capture import FrameRingBuffer
+
+class RegionHistory:
+    def __init__(self, frame_forge:CameraFrameForge, gray_options:list[str], color_options:list[str],
+                 gray_size:int=12, color_size:int=3) -> None:
+        """領域ごとの履歴
+
+        Args:
+            frame_forge (CameraFrameForge): 領域の切抜きと変換
+            gray_options (list[str]): グレースケールで保持する領域(OCR用、共通部分も更新する)
+            color_options (list[str]): カラー(BGR)のまま保持する領域(パーティ画像など)
+            gray_size (int, optional): グレースケール画像を保持する枚数. Defaults to 12.
+            color_size (int, optional): カラー画像を保持する枚数. Defaults to 3.
+        """
+        self.logger = getLogger("Log").getChild("RegionHistory")
+        self.logger.info("Called RegionHistory")
+
+        self.frame_forge = frame_forge
+        self.gray_options = list(gray_options)
+        self.color_options = list(color_options)
+
+        self.buffers:dict[str, FrameRingBuffer] = {}
+        for option in self.gray_options:
+            self.buffers[option] = FrameRingBuffer(capacity=gray_size)
+        for option in self.color_options:
+            self.buffers[option] = FrameRingBuffer(capacity=color_size)
+        # 二値化画像の共通部分(フレームの取得ごとに逐次更新する)
+        self.consensus:dict[str, RegionConsensus] = {option:RegionConsensus() for option in self.gray_options}
+        # 履歴と共通部分を同じフレームまでそろえて更新・参照するためのロック
+        self.consensus_locks:dict[str, threading.Lock] = {option:threading.Lock() for option in self.gray_options}
+        # 変換用バッファ(グレースケール、二値化)
+        self.work:dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        # 切抜き用バッファ(カラー)
+        self.color_work:dict[str, np.ndarray] = {}
+
+    def get_work(self, option:str, shape:tuple[int, int]) -> tuple[np.ndarray, np.ndarray]:
+        """変換用バッファを取得する(サイズが変わった場合のみ確保し直す)
+
+        Args:
+            option (str): 領域のオプション
+            shape (tuple[int, int]): 領域の(高さ、幅)
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: グレースケール画像、二値化画像の書込み先
+        """
+        work = self.work.get(option)
+        if work is None or work[0].shape != shape:
+            work = (np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint8))
+            self.work[option] = work
+        return work
+
+    def get_color_work(self, option:str, shape:tuple[int, ...]) -> np.ndarray:
+        """切抜き用バッファを取得する(サイズが変わった場合のみ確保し直す)
+
+        Args:
+            option (str): 領域のオプション
+            shape (tuple[int, ...]): 領域の(高さ、幅、チャンネル数)
+
+        Returns:
+            np.ndarray: カラー画像の書込み先
+        """
+        work = self.color_work.get(option)
+        if work is None or work.shape != shape:
+            work = np.empty(shape, dtype=np.uint8)
+            self.color_work[option] = work
+        return work
+
+    def convert(self, frame:np.ndarray) -> None:
+        """フレームから各領域を切り抜いて変換用バッファに書き込む(履歴には公開しない)
+        元のフレームを参照するのはここのみのため、この後にフレームが上書きされていないか確認すれば、
+        変換中の上書きで崩れた画像を公開せずに済む
+
+        Args:
+            frame (np.ndarray): カメラフレーム(BGR)
+        """
+        for option in self.gray_options:
+            # 領域を切り抜いて(コピーせずに)から、その画素のみを変換する
+            crop_frame = self.frame_forge.crop_frame(frame, option)
+            grayscale_frame, binary_frame = self.get_work(option, crop_frame.shape[:2])
+            self.frame_forge.cvt_bgr2gray(crop_frame, dst=grayscale_frame)
+            self.frame_forge.cvt_gray2binaly(grayscale_frame, option, dst=binary_frame)
+        for option in self.color_options:
+            crop_frame = self.frame_forge.crop_frame(frame, option)
+            np.copyto(self.get_color_work(option, crop_frame.shape), crop_frame)
+
+    def publish(self, timestamp:float) -> None:
+        """変換用バッファの画像を履歴に追加する
+
+        Args:
+            timestamp (float): フレームの取得時刻
+        """
+        for option in self.gray_options:
+            grayscale_frame, binary_frame = self.work[option]
+            # 共通部分の取得が、履歴に無いフレームを含めないよう両方をまとめて更新する
+            with self.consensus_locks[option]:
+                seq = self.buffers[option].push(grayscale_frame, timestamp)
+                self.consensus[option].push(binary_frame, seq)
+        for option in self.color_options:
+            self.buffers[option].push(self.color_work[option], timestamp)
+
+    def push(self, frame:np.ndarray, timestamp:float) -> None:
+        """フレームから各領域を切り抜いて履歴に追加する
+
+        Args:
+            frame (np.ndarray): カメラフレーム(BGR)
+            timestamp (float): フレームの取得時刻
+        """
+        self.convert(frame)
+        self.publish(timestamp)
+
+    def get_recent(self, option:str, count:int, max_age:float) -> list[tuple[int, float, np.ndarray]]:
+        """領域の直近の画像を取得する
+
+        Args:
+            option (str): 領域のオプション
+            count (int): 取得する最大枚数
+            max_age (float): 現在時刻からの経過時間の上限(秒). 最新の画像は経過時間に関わらず含める
+
+        Returns:
+            list[tuple[int, float, np.ndarray]]: (連番、取得時刻、画像)のリスト(古い順)
+        """
+        return self.buffers[option].get_recent(count, max_age)
+
+    def get_latest(self, option:str) -> np.ndarray:
+        """領域の最新の画像を取得する
+
+        Args:
+            option (str): 領域のオプション
+
+        Returns:
+            np.ndarray: 最新の画像(読み取り専用のビュー). 無い場合はNone
+        """
+        entry = self.buffers[option].get_latest()
+        if entry is None:
+            return None
+        return entry[2]
+
+    def get_consensus(self, option:str, count:int, max_age:float) -> np.ndarray:
+        """直近の画像の共通部分を取得する
+
+        Args:
+            option (str): 領域のオプション(グレースケールで保持する領域)
+            count (int): 共通部分を求める最大枚数
+            max_age (float): 現在時刻からの経過時間の上限(秒). 最新の画像は経過時間に関わらず含める
+
+        Returns:
+            np.ndarray: 共通部分の画像. 画像が無い場合はNone
+        """
+        with self.consensus_locks[option]:
+            entries = self.buffers[option].get_recent(count, max_age)
+            if len(entries) == 0:
+                return None
+            return self.consensus[option].get_mask(entries[0][0])
+
+    def nbytes(self) -> int:
+        """
+        履歴と変換用バッファの確保済みメモリ量(バイト)
+        """
+        total = sum(buffer.buffer.nbytes for buffer in self.buffers.values() if buffer.buffer is not None)
+        total += sum(gray.nbytes + binary.nbytes for gray, binary in self.work.values())
+        total += sum(work.nbytes for work in self.color_work.values())
+        total += sum(consensus.last_zero.nbytes for consensus in self.consensus.values() if consensus.last_zero is not None)
+        return total
+
+    def clear(self) -> None:
+        """
+        履歴を破棄する
+        """
+        for option in self.gray_options:
+            with self.consensus_locks[option]:
+                self.buffers[option].clear()
+                self.consensus[option].clear()
+        for option in self.color_options:
+            self.buffers[option].clear()
@@ -1,30 +1,221 @@
 import os, sys
 import cv2
 
-from threading import Thread
+from threading import Thread, Lock, Condition
 import datetime
+import time
 from logging import getLogger
 
 from module import config
 
 import numpy as np
 
-class CameraCapture:
-    def __init__(self) -> None:
+from .frame_source import FrameSource, create_frame_source
+from .image_writer import ImageWriter
+
+class FrameRingBuffer:
+    def __init__(self, capacity:int=12) -> None:
+        """固定長のフレームリングバッファ
+
+        フレームごとに単調増加する連番(seq)と取得時刻を付与して保持する
+        領域は最初のフレーム格納時にまとめて確保し、以降は古いスロットを上書きして再利用する
+        取得したフレームは読み取り専用のビューのため、capacity枚以上の新しいフレームが
+        格納されるまでの間のみ有効(長く保持する場合はis_validで確認するかコピーする)
+
+        Args:
+            capacity (int, optional): 保持するフレーム数. Defaults to 12.
+        """
+        self.logger = getLogger("Log").getChild("FrameRingBuffer")
+        self.logger.debug("Called FrameRingBuffer")
+
+        self.capacity:int = capacity
+        self.lock = Lock()
+        self.condition = Condition(self.lock) # 新しいフレームの通知
+
+        self.buffer:np.ndarray = None # (capacity, height, width, channel)の確保済み領域
+        self.seqlist = np.full(capacity, -1, dtype=np.int64) # 各スロットの連番(-1は無効)
+        self.timelist = np.zeros(capacity, dtype=np.float64) # 各スロットの取得時刻
+        self.latest_seq:int = -1 # 最後に格納したフレームの連番
+
+    def allocate(self, frame:np.ndarray) -> None:
+        """フレームの形状に合わせてバッファ領域を確保する
+
+        Args:
+            frame (np.ndarray): 格納するフレーム
+        """
+        self.logger.getChild("allocate").info(f"Allocate {self.capacity}x{frame.shape} {frame.dtype}")
+        self.buffer = np.empty((self.capacity, *frame.shape), dtype=frame.dtype)
+        self.seqlist.fill(-1)
+
+    def push(self, frame:np.ndarray, timestamp:float=None) -> int:
+        """フレームを格納する
+
+        Args:
+            frame (np.ndarray): 格納するフレーム
+            timestamp (float, optional): 取得時刻. Defaults to None(現在時刻).
+
+        Returns:
+            int: 格納したフレームの連番
+        """
+        if timestamp is None:
+            timestamp = time.time()
+
+        with self.lock:
+            if self.buffer is None or self.buffer.shape[1:] != frame.shape or self.buffer.dtype != frame.dtype:
+                self.allocate(frame)
+            seq = self.latest_seq + 1
+            index = seq % self.capacity
+            # 書き込み中のスロットを読み出し対象から外す
+            self.seqlist[index] = -1
+
+        np.copyto(self.buffer[index], frame)
+
+        with self.lock:
+            self.seqlist[index] = seq
+            self.timelist[index] = timestamp
+            self.latest_seq = seq
+            self.condition.notify_all()
+        return seq
+
+    def wait_for_frame(self, seq:int, timeout:float=None) -> bool:
+        """指定した連番より新しいフレームが格納されるまで待つ
+
+        Args:
+            seq (int): 処理済みのフレームの連番
+            timeout (float, optional): 最大待ち時間(秒). Defaults to None(無制限).
+
+        Returns:
+            bool: 新しいフレームがある→True, タイムアウト→False
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.latest_seq > seq, timeout=timeout)
+
+    def get_entry(self, index:int) -> tuple[int, float, np.ndarray]:
+        """スロットの内容を取得する(ロック取得済みで呼ぶ)
+
+        Args:
+            index (int): スロット番号
+
+        Returns:
+            tuple[int, float, np.ndarray]: 連番、取得時刻、フレーム(読み取り専用ビュー)
+        """
+        frame = self.buffer[index].view()
+        frame.flags.writeable = False
+        return int(self.seqlist[index]), float(self.timelist[index]), frame
+
+    def get_latest(self) -> tuple[int, float, np.ndarray]:
+        """最新のフレームを取得する
+
+        Returns:
+            tuple[int, float, np.ndarray]: 連番、取得時刻、フレーム. フレームが無い場合はNone
+        """
+        with self.lock:
+            if self.latest_seq < 0:
+                return None
+            index = self.latest_seq % self.capacity
+            if self.seqlist[index] != self.latest_seq:
+                return None
+            return self.get_entry(index)
+
+    def get_since(self, seq:int) -> list[tuple[int, float, np.ndarray]]:
+        """指定した連番より新しいフレームを古い順に取得する
+
+        Args:
+            seq (int): 基準となる連番
+
+        Returns:
+            list[tuple[int, float, np.ndarray]]: (連番、取得時刻、フレーム)のリスト
+        """
+        with self.lock:
+            return self.collect_entries(seq + 1)
+
+    def get_last(self, count:int) -> list[tuple[int, float, np.ndarray]]:
+        """最新から指定枚数の異なるフレームを古い順に取得する
+
+        Args:
+            count (int): 取得する枚数
+
+        Returns:
+            list[tuple[int, float, np.ndarray]]: (連番、取得時刻、フレーム)のリスト
+        """
+        with self.lock:
+            return self.collect_entries(self.latest_seq - count + 1)
+
+    def collect_entries(self, first:int) -> list[tuple[int, float, np.ndarray]]:
+        """指定した連番以降の有効なフレームを集める(ロック取得済みで呼ぶ)
+
+        Args:
+            first (int): 取得を開始する連番
+
+        Returns:
+            list[tuple[int, float, np.ndarray]]: (連番、取得時刻、フレーム)のリスト
+        """
+        first = max(first, self.latest_seq - self.capacity + 1, 0)
+        return [self.get_entry(seq % self.capacity) for seq in range(first, self.latest_seq + 1)
+                if self.seqlist[seq % self.capacity] == seq]
+
+    def get_recent(self, count:int, max_age:float) -> list[tuple[int, float, np.ndarray]]:
+        """最新から指定枚数以内、かつ指定時間以内に取得したフレームを古い順に取得する
+        最新のフレームは取得時刻に関わらず含める(静止画面で新しいフレームが来ない場合)
+
+        Args:
+            count (int): 取得する最大枚数
+            max_age (float): 取得するフレームの経過時間の上限(秒)
+
+        Returns:
+            list[tuple[int, float, np.ndarray]]: (連番、取得時刻、フレーム)のリスト
         """
-        カメラキャプチャの管理
+        limit_time = time.time() - max_age
+        with self.lock:
+            entries = self.collect_entries(self.latest_seq - count + 1)
+        return [entry for entry in entries[:-1] if entry[1] >= limit_time] + entries[-1:]
+
+    def is_valid(self, seq:int) -> bool:
+        """取得済みのフレームがまだ上書きされていないか確認する
+
+        Args:
+            seq (int): フレームの連番
+
+        Returns:
+            bool: 有効→True, 上書き済み→False
+        """
+        with self.lock:
+            return seq >= 0 and self.seqlist[seq % self.capacity] == seq
+
+    def clear(self) -> None:
+        """
+        格納したフレームを無効にする(連番は引き継ぐ)
+        """
+        with self.lock:
+            self.seqlist.fill(-1)
+
+class CameraCapture:
+    def __init__(self, frame_source:FrameSource=None, image_writer:ImageWriter=None) -> None:
+        """カメラキャプチャの管理
+
+        Args:
+            frame_source (FrameSource, optional): フレームの供給元. Defaults to None(config.iniの設定から作成).
+            image_writer (ImageWriter, optional): スクリーンショットの保存キュー. Defaults to None(新しく作成).
         """
         self.logger = getLogger("Log").getChild("CameraCapture")
         self.logger.info("Called CameraCapture")
 
         self.video_source:int = int(config.get("DEFAULT","camera_id"))
-        self.vid = cv2.VideoCapture(self.video_source)
+        if frame_source is None:
+            frame_source = create_frame_source(
+                config.get("DEFAULT","frame_source",fallback="camera"),
+                camera_id=self.video_source,
+                path=config.get("DEFAULT","frame_source_path",fallback=""),
+                fps=float(config.get("DEFAULT","display_fps")),
+                realtime=config.get("DEFAULT","frame_source_realtime",fallback="True") == "True")
+        self.vid:FrameSource = frame_source
 
         self.vid.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
         self.vid.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
         self.vid.set(cv2.CAP_PROP_FPS, int(config.get("DEFAULT","display_fps")))
         
         self.screenshot_folder_path = config.get("DEFAULT","screenshot_folder")
+        self.image_writer = image_writer if image_writer is not None else ImageWriter()
 
         self.width = self.vid.get(cv2.CAP_PROP_FRAME_WIDTH)
         self.height = self.vid.get(cv2.CAP_PROP_FRAME_HEIGHT)
@@ -34,7 +225,19 @@ class CameraCapture:
 
         self.is_capturing:bool = False
         self.capture_thread:Thread = None
-        self.frame:cv2.typing.MatLike = None
+        # 認識処理は領域の履歴(RegionHistory)を使うため、フレーム全体は描画と処理待ちの分のみ保持する
+        self.frame_buffer = FrameRingBuffer(capacity=4)
+
+        # 重複フレームの判定
+        # 縮小画像の画素値の差の最大値がしきい値以下なら同じフレームとみなす(負の値で無効)
+        # 縮小画像は1920x1080で10px四方の平均(文字1つの変化を見落とさない大きさ)
+        self.frame_diff_threshold:int = int(config.get("DEFAULT","frame_diff_threshold",fallback="2"))
+        self.fingerprint_size:tuple[int, int] = (192, 108)
+        self.fingerprint:np.ndarray = None # 最後に格納したフレームの縮小画像
+        # 重複と判定しても、最後に格納してからこの時間(秒)が経っていれば格納する(見落とした変化を後段に渡す)
+        self.force_interval:float = int(config.get("DEFAULT","frame_force_interval",fallback="500")) / 1000
+        self.last_push_time:float = 0.0 # 最後にフレームを格納した時刻
+        self.duplicate_count:int = 0 # 破棄した重複フレームの数
     
     
     def start_capture(self) -> None:
@@ -43,6 +246,7 @@ class CameraCapture:
         """
         self.logger.getChild("start_capture").info("Run start_capture")
         self.is_capturing= True
+        self.fingerprint = None
         self.capture_thread = Thread(target=self.capture_video)
         self.capture_thread.daemon = True
         self.capture_thread.start()
@@ -64,16 +268,52 @@ class CameraCapture:
             logger.debug("VideoCapture.read")
             ret, frame = self.vid.read()
             if ret:
+                now = time.time()
+                if self.is_duplicate_frame(frame) and now - self.last_push_time < self.force_interval:
+                    logger.debug("skip duplicate frame")
+                    self.duplicate_count += 1
+                    continue
                 logger.debug("save frame")
-                self.frame = frame
+                self.frame_buffer.push(frame, now)
+                self.last_push_time = now
+            elif not self.vid.isOpened():
+                # ファイル系のソースを最後まで読み込んだ場合など
+                logger.info("Frame source is closed")
+                self.is_capturing = False
+            else:
+                # 読み込みに失敗した場合に空回りしないよう待つ
+                time.sleep(0.01)
+
+    def is_duplicate_frame(self, frame:np.ndarray) -> bool:
+        """直前に格納したフレームとほぼ同じ画像か判定する
+        縮小画像(指紋)同士の画素値の差で比較する
+
+        Args:
+            frame (np.ndarray): 取得したフレーム
+
+        Returns:
+            bool: 重複→True
+        """
+        if self.frame_diff_threshold < 0:
+            return False
+        # 間引くと小さな変化を見落とすため、全画素を平均して縮小する
+        fingerprint = cv2.resize(frame, self.fingerprint_size, interpolation=cv2.INTER_AREA)
+        if self.fingerprint is not None and self.fingerprint.shape == fingerprint.shape:
+            if int(cv2.absdiff(self.fingerprint, fingerprint).max()) <= self.frame_diff_threshold:
+                return True
+        self.fingerprint = fingerprint
+        return False
             
     def get_frame(self) -> np.ndarray:
         """カメラの画像を取得する
         
         Returns:
-            ndarray: 画像
+            ndarray: 最新の画像(読み取り専用). 未取得の場合はNone
         """
-        return self.frame
+        entry = self.frame_buffer.get_latest()
+        if entry is None:
+            return None
+        return entry[2]
 
     def save_frame(self) -> None:
         """
@@ -81,21 +321,23 @@ class CameraCapture:
         """
         logger = self.logger.getChild("save_frame")
         logger.debug("Run save_frame")
-        # screenshot保存フォルダがなかった場合にフォルダを作成する
-        try:
-            if not os.path.exists(f"{self.screenshot_folder_path}"):
-                os.mkdir(f"{self.screenshot_folder_path}")
-                logger.info(f"Success makedir {self.screenshot_folder_path}")
-        except Exception as e:
-            logger.error(f"Fault makedir {self.screenshot_folder_path}")
-            logger.exception(e)
+        # コピーの途中でスロットが上書きされた場合は、新しいフレームで取り直す
+        for _ in range(3):
+            entry = self.frame_buffer.get_latest()
+            if entry is None:
+                logger.info("Frame is None")
+                return
+            seq, _, frame = entry
+            frame = frame.copy()
+            if self.frame_buffer.is_valid(seq):
+                break
+        else:
+            logger.warning("Frame was overwritten while copying")
+            return
         file_name = f"screenshot_{datetime.datetime.now().strftime('%y%m%d%H%M%S')}"
-        try:
-            cv2.imwrite(f"{self.screenshot_folder_path}/{file_name}.png", self.frame)
+        # 書き出しは保存キューのスレッドで行う
+        if self.image_writer.save(self.screenshot_folder_path, file_name, frame):
             logger.info(f"save as {file_name}")
-        except Exception as e:
-            self.logger.error(f"Fault save image")
-            self.logger.exception(e)
 
     def release_camera(self) -> None:
         """
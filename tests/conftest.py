@@ -0,0 +1,11 @@
+"""
+テストの共通設定
+
+module.configはsys.argv[0]のフォルダのconfig.iniを読むため、pytestから実行してもリポジトリの設定を読むようにする
+"""
+
+import os, sys
+
+ROOT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "pkbattletool")
+sys.path.insert(0, ROOT)
+sys.argv[0] = os.path.join(ROOT, "main.py")
@@ -0,0 +1,41 @@
+"""
+ImageWriterの保存キューのテスト
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from mylib.image_writer import ImageWriter
+
+def make_frame() -> np.ndarray:
+    frame = np.zeros((12, 16, 3), dtype=np.uint8)
+    frame[2:6, 3:9] = (0, 128, 255)
+    return frame
+
+def test_save_round_trip(tmp_path):
+    writer = ImageWriter(image_format="png", policy="block")
+    frame = make_frame()
+    try:
+        assert writer.save(str(tmp_path), "default", frame)
+        assert writer.save(str(tmp_path / "sub"), "png", frame, image_format="png")
+        writer.flush()
+    finally:
+        writer.close()
+    for path in (tmp_path / "default.png", tmp_path / "sub" / "png.png"):
+        assert np.array_equal(cv2.imread(str(path)), frame)
+
+def test_save_recreates_removed_folder(tmp_path):
+    writer = ImageWriter(image_format="png", policy="block")
+    folder = tmp_path / "icon"
+    try:
+        writer.save(str(folder), "first", make_frame())
+        writer.flush()
+        os.remove(folder / "first.png")
+        os.rmdir(folder)
+        writer.save(str(folder), "second", make_frame())
+        writer.flush()
+    finally:
+        writer.close()
+    assert os.path.exists(folder / "second.png")